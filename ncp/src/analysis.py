@@ -7,9 +7,40 @@ from sklearn.pipeline import make_pipeline
 from sklearn.model_selection import GroupKFold
 from sklearn.metrics import accuracy_score
 
+from scipy import special
 from scipy import stats as ss
 import statsmodels.stats.multitest
+import hashlib
+import json
 import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from consensus import aggregate_features
+from instrumentation import stage
+
+# Feature and target data of the cross-validation worker processes
+_fold_data = None
+
+# Prepared cross-validation folds of the permutation worker processes
+_permutation_folds = None
+
+# Sorted feature columns of the bootstrap worker processes
+_bootstrap_ranked = None
+
+# Parquet metadata key of the category summary stored with its test results
+SUMMARY_METADATA_KEY = b"ncp_category_summary"
+
+# Version of the analysis code and of its results; bump it whenever a change
+# alters the results of `analyze_category`, so that cached results are redone
+ANALYSIS_VERSION = 1
+
+# Units of the U-tests: every well, or the median of each cell line
+TEST_MODES = ("well", "line")
 
 
 def logistic_regression(X, y):
@@ -34,53 +65,182 @@ def logistic_regression(X, y):
     return pipeline
 
 
+def _sort_columns(X):
+    """
+    Sort every column of X once so that per-fold medians can be read off.
+
+    Parameters:
+    - X: ndarray, shape (n_samples, n_features), may contain NaN.
+
+    Returns:
+    - order: ndarray, the row order that sorts each column (NaNs last).
+    - X_sorted: ndarray, X with each column sorted.
+    """
+    order = np.argsort(X, axis=0, kind="mergesort")
+    return order, np.take_along_axis(X, order, axis=0)
+
+
+def _fold_medians(order, X_sorted, train_mask):
+    """
+    Compute the NaN-ignoring median of each column over the training rows.
+
+    Equivalent to `SimpleImputer(strategy="median")` fitted on the training
+    rows, but derived from the presorted columns instead of rescanning X.
+    Columns without any observed training value get a median of 0.
+
+    Parameters:
+    - order: ndarray, row order of each sorted column, from `_sort_columns`.
+    - X_sorted: ndarray, the sorted columns, from `_sort_columns`.
+    - train_mask: ndarray of bool, shape (n_samples,), the training rows.
+
+    Returns:
+    - medians: ndarray, shape (n_features,).
+    """
+    keep = train_mask[order] & ~np.isnan(X_sorted)
+    counts = keep.sum(axis=0)
+    seen = np.cumsum(keep, axis=0, dtype=np.int32)
+
+    # Positions (in sorted order) of the two middle training values
+    cols = np.arange(X_sorted.shape[1])
+    lower = np.argmax(seen > (counts - 1) // 2, axis=0)
+    upper = np.argmax(seen > counts // 2, axis=0)
+    medians = (X_sorted[lower, cols] + X_sorted[upper, cols]) / 2
+
+    return np.where(counts > 0, medians, 0.0)
+
+
+def _impute(X, medians):
+    """
+    Replace NaNs in X by the per-column medians.
+    """
+    return np.where(np.isnan(X), medians, X)
+
+
+def _fit_fold(X, y, train_index, test_index, medians, init=None):
+    """
+    Fit and evaluate the logistic regression of one cross-validation fold.
+
+    Parameters:
+    - X: ndarray, the feature data.
+    - y: ndarray, the target data.
+    - train_index: ndarray, the training rows.
+    - test_index: ndarray, the test rows.
+    - medians: ndarray, the imputation values computed on the training rows.
+    - init: tuple, optional (coef, intercept) to warm-start the solver from.
+
+    Returns:
+    - accuracy: float, the accuracy on the test rows.
+    - coef: ndarray, the fitted coefficients.
+    - intercept: ndarray, the fitted intercept.
+    - fit_time: float, the wall time of the fold in seconds.
+    """
+    start = time.perf_counter()
+
+    logistic_regr = LogisticRegression(max_iter=10000, warm_start=init is not None)
+    if init is not None:
+        logistic_regr.coef_ = init[0].copy()
+        logistic_regr.intercept_ = init[1].copy()
+
+    logistic_regr.fit(_impute(X[train_index], medians), y[train_index])
+
+    # Predict on the test data and calculate accuracy
+    y_pred = logistic_regr.predict(_impute(X[test_index], medians))
+    accuracy = accuracy_score(y[test_index], y_pred)
+
+    fit_time = time.perf_counter() - start
+
+    return accuracy, logistic_regr.coef_, logistic_regr.intercept_, fit_time
+
+
+def _init_fold_worker(X, y):
+    """
+    Store the feature and target data once per worker process.
+    """
+    global _fold_data
+
+    _fold_data = X, y
+
+
+def _fit_fold_worker(train_index, test_index, medians):
+    return _fit_fold(*_fold_data, train_index, test_index, medians)
+
+
 def group_kfold_cross_validate_logistic_regression(
-    df, feature_cols, target_col, group_col, n_splits=5
+    df,
+    feature_cols,
+    target_col,
+    group_col,
+    n_splits=5,
+    n_jobs=1,
+    warm_start=False,
+    return_fold_times=False,
 ):
     """
     Perform Group K-Fold cross-validation on logistic regression and return the mean accuracy.
 
+    Each fold fits the same model as `logistic_regression` (median imputation
+    followed by logistic regression). The columns are sorted once so that the
+    median imputation of each fold is derived without rescanning X. With
+    `n_jobs` > 1 the folds are fitted in a process pool.
+
     Parameters:
     - df: DataFrame, the data.
     - feature_cols: list, the feature columns.
     - target_col: str, the target column.
     - group_col: str, the column to group by for cross-validation.
     - n_splits: int, number of folds for Group K-Fold cross-validation.
+    - n_jobs: int, number of worker processes fitting folds concurrently.
+    - warm_start: bool, whether to start each fold's solver from the
+      coefficients of the previous fold. The folds are then fitted one after
+      the other, and the results depend on the fold order.
+    - return_fold_times: bool, whether to also return the wall time of each fold.
 
     Returns:
     - mean_accuracy: float, the mean accuracy across all folds.
     - std_accuracy: float, the std accuracy across all folds.
     - feature_importances: DataFrame, the feature importances averaged over all folds.
+    - fold_times: list, the wall time of each fold in seconds (only if `return_fold_times`).
     """
     # Initialize the Group K-Fold
     gkf = GroupKFold(n_splits=n_splits)
 
     # Prepare features, target, and groups
-    X = df[feature_cols]
-    y = df[target_col]
-    groups = df[group_col]
+    X = df[feature_cols].to_numpy(dtype=float)
+    y = df[target_col].to_numpy()
+    groups = df[group_col].to_numpy()
 
-    # Store each fold's accuracy and feature importances
-    accuracies = []
-    feature_importances = []
+    # Sort the columns once; every fold's imputation is read off from it
+    order, X_sorted = _sort_columns(X)
 
-    # Perform cross-validation
+    folds = []
     for train_index, test_index in gkf.split(X, y, groups=groups):
-        # Split the data
-        X_train, X_test = X.iloc[train_index], X.iloc[test_index]
-        y_train, y_test = y.iloc[train_index], y.iloc[test_index]
-
-        # Fit logistic regression
-        pipeline = logistic_regression(X_train, y_train)
+        train_mask = np.zeros(len(X), dtype=bool)
+        train_mask[train_index] = True
+        folds.append(
+            (train_index, test_index, _fold_medians(order, X_sorted, train_mask))
+        )
 
-        # Predict on the test data and calculate accuracy
-        y_pred = pipeline.predict(X_test)
-        accuracy = accuracy_score(y_test, y_pred)
-        accuracies.append(accuracy)
+    # Perform cross-validation
+    if warm_start:
+        results = []
+        init = None
+        for fold in folds:
+            results.append(_fit_fold(X, y, *fold, init=init))
+            init = results[-1][1], results[-1][2]
+    elif n_jobs > 1:
+        with ProcessPoolExecutor(
+            max_workers=min(n_jobs, len(folds)),
+            initializer=_init_fold_worker,
+            initargs=(X, y),
+        ) as executor:
+            results = list(executor.map(_fit_fold_worker, *zip(*folds)))
+    else:
+        results = [_fit_fold(X, y, *fold) for fold in folds]
 
-        # Get feature importances
-        logistic_regr = pipeline.named_steps["logisticregression"]
-        feature_importances.append(logistic_regr.coef_[0])
+    # Store each fold's accuracy and feature importances
+    accuracies = [result[0] for result in results]
+    feature_importances = [result[1][0] for result in results]
+    fold_times = [result[3] for result in results]
 
     # Calculate the mean and std accuracy across all folds
     mean_accuracy = np.mean(accuracies)
@@ -92,9 +252,307 @@ def group_kfold_cross_validate_logistic_regression(
         mean_feature_importances, index=feature_cols, columns=["importance"]
     ).sort_values(by="importance", ascending=False)
 
+    if return_fold_times:
+        return mean_accuracy, std_accuracy, feature_importances_df, fold_times
+
     return mean_accuracy, std_accuracy, feature_importances_df
 
 
+def _prepare_permutation_folds(X, groups, n_splits):
+    """
+    Split and impute the cross-validation folds once.
+
+    The folds and their imputed matrices are those of
+    `group_kfold_cross_validate_logistic_regression`, so the observed labels
+    give its accuracy. They only depend on the groups, so they are shared by
+    the observed labels and every permutation.
+
+    Returns:
+    - folds: list of (train_index, test_index, X_train, X_test) tuples.
+    """
+    gkf = GroupKFold(n_splits=n_splits)
+    order, X_sorted = _sort_columns(X)
+
+    folds = []
+    for train_index, test_index in gkf.split(X, groups=groups):
+        train_mask = np.zeros(len(X), dtype=bool)
+        train_mask[train_index] = True
+        medians = _fold_medians(order, X_sorted, train_mask)
+
+        folds.append(
+            (
+                train_index,
+                test_index,
+                _impute(X[train_index], medians),
+                _impute(X[test_index], medians),
+            )
+        )
+
+    return folds
+
+
+def _cross_validated_accuracy(folds, y):
+    """
+    Mean accuracy of logistic regression over prepared folds.
+    """
+    accuracies = []
+    for train_index, test_index, X_train, X_test in folds:
+        y_train = y[train_index]
+        if len(np.unique(y_train)) < 2:
+            # A permutation can leave a single class in the training rows
+            y_pred = np.full(len(test_index), y_train[0])
+        else:
+            logistic_regr = LogisticRegression(max_iter=10000)
+            y_pred = logistic_regr.fit(X_train, y_train).predict(X_test)
+        accuracies.append(accuracy_score(y[test_index], y_pred))
+
+    return np.mean(accuracies)
+
+
+def _permute_labels(y, group_codes, rng):
+    """
+    Permute the labels, keeping all rows of a group together when the label is
+    constant within groups.
+    """
+    n_groups = group_codes.max() + 1
+    group_labels = np.empty(n_groups, dtype=y.dtype)
+    group_labels[group_codes] = y
+
+    if np.array_equal(group_labels[group_codes], y):
+        return rng.permutation(group_labels)[group_codes]
+
+    return rng.permutation(y)
+
+
+def _null_accuracies(folds, y, group_codes, seeds):
+    """
+    Cross-validated accuracies for one permutation per seed.
+    """
+    return [
+        _cross_validated_accuracy(
+            folds, _permute_labels(y, group_codes, np.random.default_rng(seed))
+        )
+        for seed in seeds
+    ]
+
+
+def _init_permutation_worker(folds):
+    """
+    Store the prepared folds once per worker process.
+    """
+    global _permutation_folds
+
+    _permutation_folds = folds
+
+
+def _null_accuracies_worker(y, group_codes, seeds):
+    return _null_accuracies(_permutation_folds, y, group_codes, seeds)
+
+
+def permutation_test_logistic_regression(
+    df,
+    feature_cols,
+    target_col,
+    group_col,
+    n_splits=5,
+    n_permutations=1000,
+    n_jobs=1,
+    seed=0,
+):
+    """
+    Label-permutation test of the Group K-Fold logistic regression accuracy.
+
+    The fold splits and the median-imputed fold matrices are computed once
+    and reused for the observed labels and every permutation. When the
+    target is constant within groups, whole groups are permuted so that the
+    null respects the grouping used by the cross-validation.
+
+    Parameters:
+    - df: DataFrame, the data.
+    - feature_cols: list, the feature columns.
+    - target_col: str, the target column.
+    - group_col: str, the column to group by for cross-validation.
+    - n_splits: int, number of folds for Group K-Fold cross-validation.
+    - n_permutations: int, number of label permutations.
+    - n_jobs: int, number of worker processes for the permutations.
+    - seed: int, seed of the permutations.
+
+    Returns:
+    - observed_accuracy: float, the mean accuracy with the observed labels.
+    - null_accuracies: ndarray, the mean accuracy of each permutation.
+    - p_value: float, the empirical p-value of the observed accuracy.
+    """
+    X = df[feature_cols].to_numpy(dtype=float)
+    y = df[target_col].to_numpy()
+    group_codes, _ = pd.factorize(df[group_col])
+
+    # Split on the group values, as the reported cross-validation does
+    folds = _prepare_permutation_folds(X, df[group_col].to_numpy(), n_splits)
+    observed_accuracy = _cross_validated_accuracy(folds, y)
+
+    seeds = np.random.default_rng(seed).integers(2**32, size=n_permutations)
+
+    if n_jobs > 1:
+        chunks = np.array_split(seeds, min(n_permutations, n_jobs * 4))
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_permutation_worker,
+            initargs=(folds,),
+        ) as executor:
+            null_accuracies = [
+                accuracy
+                for chunk_accuracies in executor.map(
+                    _null_accuracies_worker,
+                    [y] * len(chunks),
+                    [group_codes] * len(chunks),
+                    chunks,
+                )
+                for accuracy in chunk_accuracies
+            ]
+    else:
+        null_accuracies = _null_accuracies(folds, y, group_codes, seeds)
+
+    null_accuracies = np.asarray(null_accuracies)
+    p_value = (1 + np.sum(null_accuracies >= observed_accuracy)) / (n_permutations + 1)
+
+    return observed_accuracy, null_accuracies, p_value
+
+
+def _sorted_runs(sorted_data):
+    """
+    Find the runs of tied values of every column of a column-wise sorted array.
+
+    Returns:
+    - first: ndarray, the position of the first row of each row's run.
+    - last: ndarray, the position of the last row of each row's run.
+    """
+    n = sorted_data.shape[0]
+
+    # Mark the first and last row of every run of tied values
+    run_starts = np.ones(sorted_data.shape, dtype=bool)
+    run_starts[1:] = sorted_data[1:] != sorted_data[:-1]
+    run_ends = np.ones(sorted_data.shape, dtype=bool)
+    run_ends[:-1] = run_starts[1:]
+
+    positions = np.arange(n)[:, None]
+    first = np.maximum.accumulate(np.where(run_starts, positions, 0), axis=0)
+    last = np.where(run_ends, positions, n - 1)[::-1]
+    last = np.minimum.accumulate(last, axis=0)[::-1]
+
+    return first, last
+
+
+def _tie_term(first, last):
+    """Sum of (t**3 - t) over the tied runs of each column, see `_sorted_runs`."""
+    # Every member of a run of length t contributes t**2 - 1, i.e. t**3 - t per run
+    run_lengths = last - first + 1
+    return (run_lengths**2 - 1).sum(axis=0).astype(float)
+
+
+def _rank_columns(data, n_first):
+    """
+    Rank every column of a 2-D array at once, assigning average ranks to ties.
+
+    Parameters:
+    - data: ndarray, shape (n_samples, n_features).
+    - n_first: int, number of leading rows whose rank sum is returned.
+
+    Returns:
+    - rank_sum: ndarray, sum of the ranks of the first `n_first` rows per column.
+    - tie_term: ndarray, sum of (t**3 - t) over the tied runs of each column.
+    """
+    # Sort each column once; NaNs end up last and are handled by the caller
+    order = np.argsort(data, axis=0, kind="mergesort")
+    sorted_data = np.take_along_axis(data, order, axis=0)
+    first, last = _sorted_runs(sorted_data)
+
+    # Average rank (1-based) of each run, in sorted order
+    sorted_ranks = (first + last) / 2 + 1
+    rank_sum = np.where(order < n_first, sorted_ranks, 0).sum(axis=0)
+
+    return rank_sum, _tie_term(first, last)
+
+
+def mann_whitney_p_values(u1, tie_term, data_cond1, data_cond2):
+    """
+    Two-sided p-values of Mann-Whitney U statistics, as `scipy.stats.mannwhitneyu`.
+
+    The normal approximation with tie and continuity correction is used,
+    except for columns where one group has at most 8 samples and there are no
+    ties, which get the exact distribution.
+
+    Parameters:
+    - u1: ndarray, the U statistic of the first group per feature.
+    - tie_term: ndarray, sum of (t**3 - t) over the tied runs of each feature.
+    - data_cond1: ndarray, shape (n1, n_features), samples of the first group.
+    - data_cond2: ndarray, shape (n2, n_features), samples of the second group.
+
+    Returns:
+    - p_value: ndarray, two-sided p-values per feature.
+    """
+    n1, n2 = data_cond1.shape[0], data_cond2.shape[0]
+    n = n1 + n2
+
+    u = np.maximum(u1, n1 * n2 - u1)
+
+    # Normal approximation with tie and continuity correction
+    s = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (u - n1 * n2 / 2 - 0.5) / s
+    p = 2 * special.ndtr(-z)
+
+    # Small samples without ties use the exact null distribution
+    if n1 <= 8 or n2 <= 8:
+        exact = tie_term == 0
+        if exact.any():
+            _, p[exact] = ss.mannwhitneyu(
+                data_cond1[:, exact],
+                data_cond2[:, exact],
+                alternative="two-sided",
+                method="exact",
+                axis=0,
+            )
+
+    return np.clip(p, 0.0, 1.0)
+
+
+def batch_mann_whitney_u(data_cond1, data_cond2):
+    """
+    Two-sided Mann-Whitney U-test for all feature columns at once.
+
+    Matches `scipy.stats.mannwhitneyu(x, y, alternative="two-sided")` applied
+    column by column: the normal approximation with tie and continuity
+    correction is used, except for columns where one group has at most 8
+    samples and there are no ties, which get the exact distribution. Columns
+    containing NaN yield NaN.
+
+    Parameters:
+    - data_cond1: ndarray, shape (n1, n_features), samples of the first group.
+    - data_cond2: ndarray, shape (n2, n_features), samples of the second group.
+
+    Returns:
+    - u_statistic: ndarray, the U statistic of the first group per feature.
+    - p_value: ndarray, two-sided p-values per feature.
+    """
+    data_cond1 = np.asarray(data_cond1, dtype=float)
+    data_cond2 = np.asarray(data_cond2, dtype=float)
+
+    n1 = data_cond1.shape[0]
+
+    data = np.concatenate([data_cond1, data_cond2], axis=0)
+    rank_sum, tie_term = _rank_columns(data, n1)
+
+    u1 = rank_sum - n1 * (n1 + 1) / 2
+    p = mann_whitney_p_values(u1, tie_term, data_cond1, data_cond2)
+
+    # Propagate NaNs the same way scipy does
+    has_nan = np.isnan(data).any(axis=0)
+    u1[has_nan] = np.nan
+    p[has_nan] = np.nan
+
+    return u1, p
+
+
 def mann_whitney_u_test(df, feature_cols, target_col):
     """
     Conduct the Mann-Whitney U-test and return p-values and test statistics.
@@ -114,19 +572,23 @@ def mann_whitney_u_test(df, feature_cols, target_col):
     if not all(cond in df[target_col].unique() for cond in (0, 1)):
         raise ValueError("One or more target_groups do not exist in the group column.")
 
-    # Filter the data for both target_groups once before the loop
-    data_cond1 = df[df[target_col] == 0][feature_cols]
-    data_cond2 = df[df[target_col] == 1][feature_cols]
+    # Filter the data for both target_groups
+    data_cond1 = df.loc[df[target_col] == 0, feature_cols].to_numpy(dtype=float)
+    data_cond2 = df.loc[df[target_col] == 1, feature_cols].to_numpy(dtype=float)
 
-    list_u = []
-    list_p = []
-    for feat in feature_cols:
-        u, p = ss.mannwhitneyu(
-            data_cond1[feat], data_cond2[feat], alternative="two-sided"
-        )
-        list_u.append(u)
-        list_p.append(p)
+    # Test all features in one pass
+    list_u, list_p = batch_mann_whitney_u(data_cond1, data_cond2)
+
+    return mann_whitney_results(feature_cols, list_u, list_p)
+
+
+def mann_whitney_results(feature_cols, list_u, list_p):
+    """
+    Apply the FDR correction to U-test p-values and gather the test results.
 
+    Returns:
+    - results: DataFrame, test statistics, p-values and q-values for each feature.
+    """
     # Apply FDR correction
     _, p_values_fdr = statsmodels.stats.multitest.fdrcorrection(list_p, alpha=0.05)
 
@@ -143,8 +605,713 @@ def mann_whitney_u_test(df, feature_cols, target_col):
     return results
 
 
+def _line_strata(y, group_codes):
+    """
+    Stratify the groups of a two-sample comparison by the samples they hold.
+
+    Returns:
+    - numpy.ndarray, per group: 1 if it only holds first-sample rows, 2 if it
+      only holds second-sample rows, 3 if it holds both.
+    """
+    n_groups = group_codes.max() + 1
+    in_first = np.bincount(group_codes[y == 0], minlength=n_groups) > 0
+    in_second = np.bincount(group_codes[y == 1], minlength=n_groups) > 0
+    return in_first + 2 * in_second
+
+
+def _resample_group_weights(strata, rng):
+    """
+    Draw a cluster bootstrap resample, returning how many times each group is drawn.
+
+    Groups are drawn with replacement within each stratum (see `_line_strata`),
+    so that both samples keep their number of groups.
+    """
+    weights = np.zeros(len(strata), dtype=np.int64)
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        weights += np.bincount(
+            rng.choice(members, size=len(members)), minlength=len(strata)
+        )
+    return weights
+
+
+def _weighted_median(sorted_data, weights):
+    """
+    Median of each column of a column-wise sorted array whose rows are
+    repeated `weights` times; columns without weight are NaN.
+    """
+    cum = np.cumsum(weights, axis=0)
+    total = cum[-1]
+
+    # The k-th (0-based) value of the repeated column is the first row whose
+    # cumulative weight exceeds k
+    lo = np.argmax(cum > ((total - 1) // 2)[None, :], axis=0)
+    hi = np.argmax(cum > (total // 2)[None, :], axis=0)
+    median = (
+        np.take_along_axis(sorted_data, lo[None, :], axis=0)[0]
+        + np.take_along_axis(sorted_data, hi[None, :], axis=0)[0]
+    ) / 2
+
+    return np.where(total > 0, median, np.nan)
+
+
+def _weighted_effect_sizes(ranked, row_weights, chunk_size=256):
+    """
+    Effect sizes of the rows of `ranked` repeated `row_weights` times.
+
+    The columns were sorted once by `_rank_for_effect_sizes`; a resample only
+    changes the row weights, so each chunk of columns is reduced with
+    cumulative sums in sorted order, without sorting again.
+
+    Returns:
+    - rank_biserial: ndarray, per feature.
+    - median_difference: ndarray, per feature.
+    """
+    order, sorted_data, first, last, second, present = ranked
+    n_features = sorted_data.shape[1]
+
+    rank_biserial = np.empty(n_features)
+    median_difference = np.empty(n_features)
+    for start in range(0, n_features, chunk_size):
+        cols = slice(start, start + chunk_size)
+        weights = row_weights[order[:, cols]] * present[:, cols]
+        weights_2 = np.where(second[:, cols], weights, 0)
+        weights_1 = weights - weights_2
+
+        # Second-sample weight below each value, counting ties as half
+        cum_2 = np.zeros((len(weights) + 1, weights.shape[1]), dtype=np.int64)
+        np.cumsum(weights_2, axis=0, out=cum_2[1:])
+        below = (
+            np.take_along_axis(cum_2, first[:, cols], axis=0)
+            + np.take_along_axis(cum_2, last[:, cols] + 1, axis=0)
+        ) / 2
+
+        u1 = (weights_1 * below).sum(axis=0)
+        n1, n2 = weights_1.sum(axis=0), weights_2.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rank_biserial[cols] = 1 - 2 * u1 / (n1 * n2)
+
+        median_difference[cols] = _weighted_median(
+            sorted_data[:, cols], weights_2
+        ) - _weighted_median(sorted_data[:, cols], weights_1)
+
+    # Propagate NaNs as the U-test does
+    rank_biserial[~present.all(axis=0)] = np.nan
+
+    return rank_biserial, median_difference
+
+
+def _rank_for_effect_sizes(data, y):
+    """
+    Sort every column once and record its tied runs for `_weighted_effect_sizes`.
+    """
+    order = np.argsort(data, axis=0, kind="mergesort")
+    sorted_data = np.take_along_axis(data, order, axis=0)
+    first, last = _sorted_runs(sorted_data)
+
+    return (
+        order.astype(np.int32),
+        sorted_data,
+        first.astype(np.int32),
+        last.astype(np.int32),
+        y[order] == 1,
+        ~np.isnan(sorted_data),
+    )
+
+
+def _bootstrap_effect_sizes(ranked, group_codes, strata, seeds):
+    """
+    Effect sizes of one cluster bootstrap resample per seed.
+    """
+    resamples = [
+        _weighted_effect_sizes(
+            ranked,
+            _resample_group_weights(strata, np.random.default_rng(seed))[group_codes],
+        )
+        for seed in seeds
+    ]
+    return [np.stack(effect_sizes) for effect_sizes in zip(*resamples)]
+
+
+def _init_bootstrap_worker(ranked):
+    """
+    Store the sorted columns once per worker process.
+    """
+    global _bootstrap_ranked
+
+    _bootstrap_ranked = ranked
+
+
+def _bootstrap_effect_sizes_worker(group_codes, strata, seeds):
+    return _bootstrap_effect_sizes(_bootstrap_ranked, group_codes, strata, seeds)
+
+
+def effect_sizes(
+    df,
+    feature_cols,
+    target_col,
+    group_col="Metadata_line_ID",
+    n_bootstrap=0,
+    confidence_level=0.95,
+    n_jobs=1,
+    seed=0,
+):
+    """
+    Effect sizes of every feature between the two target groups, with cluster
+    bootstrap confidence intervals.
+
+    The rank-biserial correlation, 1 - 2 * U / (n1 * n2) with U the statistic
+    of `mann_whitney_u_test`, is the probability that a value of the second
+    group (target 1) is above a value of the first minus the converse, i.e.
+    Cliff's delta. The median difference is the second group's median minus
+    the first's, ignoring missing values.
+
+    The bootstrap resamples whole groups (cell lines, as in the Group K-Fold
+    cross-validation), within the lines holding only one or both target
+    values. Every column is sorted once; a resample only reweights the rows,
+    so all the features are reduced together without sorting again. The
+    resamples run in `n_jobs` worker processes, each seeded from `seed`, so
+    the intervals do not depend on `n_jobs`.
+
+    Parameters:
+    - df: DataFrame, the data.
+    - feature_cols: list, the feature columns.
+    - target_col: str, the target column, encoded as 0/1.
+    - group_col: str, the column of the resampled groups.
+    - n_bootstrap: int, number of bootstrap resamples. No intervals are
+      computed if 0.
+    - confidence_level: float, the coverage of the percentile intervals.
+    - n_jobs: int, number of worker processes for the resamples.
+    - seed: int, seed of the resamples.
+
+    Returns:
+    - DataFrame, the feature, rank_biserial and median_difference, and with
+      `n_bootstrap` their `_ci_low` and `_ci_high` interval bounds.
+    """
+    data = df[feature_cols].to_numpy(dtype=float)
+    y = df[target_col].to_numpy()
+    group_codes, _ = pd.factorize(df[group_col])
+
+    ranked = _rank_for_effect_sizes(data, y)
+    estimates = dict(
+        zip(
+            ["rank_biserial", "median_difference"],
+            _weighted_effect_sizes(ranked, np.ones(len(data), dtype=np.int64)),
+        )
+    )
+    results = pd.DataFrame({"feature": feature_cols, **estimates})
+
+    if n_bootstrap == 0:
+        return results
+
+    strata = _line_strata(y, group_codes)
+    seeds = np.random.default_rng(seed).integers(2**32, size=n_bootstrap)
+
+    if n_jobs > 1:
+        chunks = np.array_split(seeds, min(n_bootstrap, n_jobs * 4))
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=_init_bootstrap_worker,
+            initargs=(ranked,),
+        ) as executor:
+            chunk_results = list(
+                executor.map(
+                    _bootstrap_effect_sizes_worker,
+                    [group_codes] * len(chunks),
+                    [strata] * len(chunks),
+                    chunks,
+                )
+            )
+        resamples = [
+            np.concatenate(chunk_effect_sizes)
+            for chunk_effect_sizes in zip(*chunk_results)
+        ]
+    else:
+        resamples = _bootstrap_effect_sizes(ranked, group_codes, strata, seeds)
+
+    alpha = (1 - confidence_level) / 2
+    for name, distribution in zip(estimates, resamples):
+        with warnings.catch_warnings():
+            # Features missing from every resample stay NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            low, high = np.nanquantile(distribution, [alpha, 1 - alpha], axis=0)
+        results[f"{name}_ci_low"] = low
+        results[f"{name}_ci_high"] = high
+
+    return results
+
+
+def _average_ranks(data):
+    """
+    Rank every column of a 2-D array, assigning average ranks (1-based) to ties.
+    """
+    order = np.argsort(data, axis=0, kind="mergesort")
+    first, last = _sorted_runs(np.take_along_axis(data, order, axis=0))
+
+    ranks = np.empty(data.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2 + 1, axis=0)
+    return ranks
+
+
+def _line_permutations(y, pairs, seeds):
+    """
+    Target indicators of the units under one permutation per seed.
+
+    Without pairs, the labels of the units (one per line) are permuted.
+    With pairs, i.e. lines holding both targets, each line swaps the labels
+    of its two units with probability 1/2; the other units keep theirs.
+
+    Returns:
+    - numpy.ndarray, (len(seeds), n_units) indicators of the second target.
+    """
+    indicators = np.empty((len(seeds), len(y)))
+    for i, seed in enumerate(seeds):
+        rng = np.random.default_rng(seed)
+        if pairs is None:
+            indicators[i] = rng.permutation(y)
+        else:
+            swap = rng.random(len(pairs[0])) < 0.5
+            indicators[i] = y
+            indicators[i, pairs[0][swap]] = 1
+            indicators[i, pairs[1][swap]] = 0
+    return indicators
+
+
+def _line_permutation_exceedances(ranks, y, pairs, null_mean, observed, seeds):
+    """
+    Count the permutations whose rank-sum deviation reaches the observed one.
+
+    The permutations are shared by all the features: the rank sums of the
+    second target under every permutation are one matrix product.
+    """
+    # Rank sums are multiples of 1/2, far above this rounding tolerance
+    threshold = observed - 1e-8
+
+    exceedances = np.zeros(ranks.shape[1], dtype=np.int64)
+    for chunk in np.array_split(seeds, max(1, len(seeds) // 1000)):
+        indicators = _line_permutations(y, pairs, chunk)
+        deviations = np.abs((indicators - null_mean) @ ranks)
+        exceedances += (deviations >= threshold).sum(axis=0)
+    return exceedances
+
+
+def line_level_test(
+    df,
+    feature_cols,
+    target_col,
+    group_col="Metadata_line_ID",
+    n_permutations=0,
+    n_jobs=1,
+    seed=0,
+):
+    """
+    Mann-Whitney U-test of every feature between the cell lines of the two
+    target groups, instead of between their wells.
+
+    The wells are reduced to the median profile of each (line, target) unit,
+    so that each line counts once per target. Without permutations the units
+    are compared with `batch_mann_whitney_u`.
+
+    With `n_permutations`, the p-values come from a permutation test of the
+    rank sum of the second target over the units, in which whole lines are
+    exchangeable: line labels are permuted when the target is constant within
+    lines, otherwise the two units of each line holding both targets swap
+    labels. The units are ranked once, the permutations are drawn once and
+    shared by all the features, and they run in `n_jobs` worker processes,
+    each seeded from `seed`.
+
+    Parameters:
+    - df: DataFrame, the data.
+    - feature_cols: list, the feature columns.
+    - target_col: str, the target column, encoded as 0/1.
+    - group_col: str, the column of the cell lines.
+    - n_permutations: int, number of line permutations, or 0 for the U-test
+      p-values of the line medians.
+    - n_jobs: int, number of worker processes for the permutations.
+    - seed: int, seed of the permutations.
+
+    Returns:
+    - results: DataFrame, test statistics (of the line medians), p-values and
+      q-values for each feature.
+    """
+    profiles, _, units = aggregate_features(
+        df[[group_col, target_col]],
+        df[feature_cols].to_numpy(dtype=float),
+        [group_col, target_col],
+        operation="median",
+        dtype=np.float64,
+    )
+    y = units[target_col].to_numpy(dtype=float)
+
+    if not ((y == 0).any() and (y == 1).any()):
+        raise ValueError("One or more target_groups do not exist in the group column.")
+
+    list_u, list_p = batch_mann_whitney_u(profiles[y == 0], profiles[y == 1])
+
+    if n_permutations > 0:
+        ranks = _average_ranks(profiles)
+
+        # Expected target indicator of each unit under the permutations
+        line_codes, _ = pd.factorize(units[group_col])
+        paired = np.bincount(line_codes, minlength=line_codes.max() + 1) == 2
+        if paired.any():
+            pair_units = np.flatnonzero(paired[line_codes])
+            pairs = (
+                pair_units[y[pair_units] == 0],
+                pair_units[y[pair_units] == 1],
+            )
+            null_mean = np.where(paired[line_codes], 0.5, y)
+        else:
+            pairs = None
+            null_mean = np.full(len(y), y.mean())
+
+        observed = np.abs((y - null_mean) @ ranks)
+        seeds = np.random.default_rng(seed).integers(2**32, size=n_permutations)
+
+        if n_jobs > 1:
+            chunks = np.array_split(seeds, min(n_permutations, n_jobs * 4))
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                exceedances = sum(
+                    executor.map(
+                        _line_permutation_exceedances,
+                        [ranks] * len(chunks),
+                        [y] * len(chunks),
+                        [pairs] * len(chunks),
+                        [null_mean] * len(chunks),
+                        [observed] * len(chunks),
+                        chunks,
+                    )
+                )
+        else:
+            exceedances = _line_permutation_exceedances(
+                ranks, y, pairs, null_mean, observed, seeds
+            )
+
+        # Features missing from a unit stay NaN, as in the U-test
+        list_p = np.where(
+            np.isnan(list_u), np.nan, (1 + exceedances) / (n_permutations + 1)
+        )
+
+    return mann_whitney_results(feature_cols, list_u, list_p)
+
+
+def write_parquet_atomic(df, path, metadata=None):
+    """
+    Write a DataFrame to Parquet so that readers never see a partial file.
+
+    The data is written to a temporary file in the same directory, which is
+    then renamed over `path`.
+
+    Parameters:
+    - df: DataFrame, the data to write.
+    - path: str, the destination Parquet file.
+    - metadata: dict, optional key-value metadata added to the file schema.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        table = pa.Table.from_pandas(df)
+        if metadata:
+            table = table.replace_schema_metadata(
+                {**(table.schema.metadata or {}), **metadata}
+            )
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def analysis_input_hash(
+    category_df,
+    category,
+    target_col,
+    feature_cols,
+    n_permutations,
+    n_bootstrap=0,
+    test_mode="well",
+    n_test_permutations=0,
+    group_col="Metadata_line_ID",
+):
+    """
+    Hash everything the results of `analyze_category` depend on.
+
+    The hash covers `ANALYSIS_VERSION`, the category, the ordered feature
+    list, the number of permutations and of bootstrap resamples, the test
+    mode, and the ordered rows of the feature, target (already encoded by the
+    mapping) and group columns.
+
+    Returns:
+    - str, the SHA-256 hex digest.
+    """
+    params = [
+        ANALYSIS_VERSION,
+        str(category),
+        group_col,
+        target_col,
+        list(feature_cols),
+        n_permutations,
+    ]
+    if n_bootstrap > 0:
+        # Results without effect sizes keep their hash
+        params.append(n_bootstrap)
+    if test_mode != "well":
+        params += [test_mode, n_test_permutations]
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps(params).encode())
+
+    columns = [group_col, target_col] + list(feature_cols)
+    row_hashes = pd.util.hash_pandas_object(category_df[columns], index=False)
+    digest.update(row_hashes.to_numpy().tobytes())
+
+    return digest.hexdigest()
+
+
+def read_cached_summary(test_results_file, input_hash):
+    """
+    Return the summary stored with existing test results if they were computed
+    from the same input, else None.
+    """
+    if not os.path.exists(test_results_file):
+        return None
+
+    try:
+        metadata = pq.read_schema(test_results_file).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return None
+
+    if SUMMARY_METADATA_KEY not in metadata:
+        return None
+
+    summary = json.loads(metadata[SUMMARY_METADATA_KEY])
+    if summary.get("input_hash") != input_hash:
+        return None
+
+    return summary
+
+
+def analyze_category(
+    category_df,
+    category,
+    target_col,
+    feature_cols,
+    output_dir,
+    n_permutations=0,
+    n_jobs=1,
+    use_cache=True,
+    test_results=None,
+    n_bootstrap=0,
+    test_mode="well",
+    n_test_permutations=0,
+    group_col="Metadata_line_ID",
+):
+    """
+    Run the classifier and the U-test for one category and save the test results.
+
+    The summary is stored in the metadata of the test results file together
+    with the hash of the inputs (see `analysis_input_hash`). With `use_cache`,
+    a category whose test results were computed from the same inputs is not
+    analyzed again.
+
+    Parameters:
+    - category_df: DataFrame, the rows of one category, with `target_col` encoded as 0/1.
+    - category: str, the category name, used in the output file name.
+    - target_col: str, the encoded target column.
+    - feature_cols: list, the list of feature columns to use for analysis.
+    - output_dir: str, the directory to save the results to.
+    - n_permutations: int, number of label permutations for the classifier
+      accuracy p-value. No permutation test is run if 0.
+    - n_jobs: int, number of worker processes for the classifier folds, the
+      permutation test and the bootstrap.
+    - use_cache: bool, whether to reuse the results of an identical analysis.
+    - test_results: DataFrame, U-test results computed beforehand (e.g. by
+      `GroupStatsIndex.mann_whitney_u_test`), or None to test `category_df`.
+    - n_bootstrap: int, number of cell line bootstrap resamples for the effect
+      size intervals (see `effect_sizes`). No effect sizes are added if 0.
+    - test_mode: str, one of `TEST_MODES`: "well" tests the wells as
+      independent samples, "line" tests the cell lines (see `line_level_test`).
+    - n_test_permutations: int, number of line permutations for the p-values
+      of the "line" mode; 0 uses the U-test of the line medians.
+    - group_col: str, the cell line column the folds, line tests and
+      bootstrap resample by.
+
+    Returns:
+    - category_summary: dict, the summary row for this category.
+    """
+    if test_mode not in TEST_MODES:
+        raise ValueError(
+            f"Unknown test mode {test_mode!r}, expected one of {TEST_MODES}."
+        )
+
+    test_results_file = os.path.join(output_dir, f"test_results_{category}.parquet")
+    input_hash = analysis_input_hash(
+        category_df,
+        category,
+        target_col,
+        feature_cols,
+        n_permutations,
+        n_bootstrap,
+        test_mode,
+        n_test_permutations,
+        group_col=group_col,
+    )
+
+    if use_cache:
+        category_summary = read_cached_summary(test_results_file, input_hash)
+        if category_summary is not None:
+            print(f"Skipping category {category}: results are up to date")
+            return category_summary
+
+    counts = {
+        "n_rows": len(category_df),
+        "n_features": len(feature_cols),
+        "category": str(category),
+    }
+
+    # Perform logistic regression with Group K-Fold cross-validation
+    with stage("classification", **counts):
+        (
+            mean_accuracy,
+            std_accuracy,
+            feature_importances,
+        ) = group_kfold_cross_validate_logistic_regression(
+            category_df,
+            feature_cols=feature_cols,
+            target_col=target_col,
+            group_col=group_col,
+            n_splits=5,
+            n_jobs=n_jobs,
+        )
+
+    # Perform Mann-Whitney U-test
+    if test_results is None and test_mode == "line":
+        with stage(
+            "statistical_testing",
+            test_mode=test_mode,
+            n_permutations=n_test_permutations,
+            **counts,
+        ):
+            test_results = line_level_test(
+                category_df,
+                feature_cols=feature_cols,
+                target_col=target_col,
+                group_col=group_col,
+                n_permutations=n_test_permutations,
+                n_jobs=n_jobs,
+            )
+    elif test_results is None:
+        with stage("statistical_testing", **counts):
+            test_results = mann_whitney_u_test(
+                category_df, feature_cols=feature_cols, target_col=target_col
+            )
+
+    # Add the effect sizes and their cell line bootstrap intervals
+    if n_bootstrap > 0:
+        with stage(
+            "statistical_testing.effect_sizes", n_bootstrap=n_bootstrap, **counts
+        ):
+            test_results = test_results.merge(
+                effect_sizes(
+                    category_df,
+                    feature_cols=feature_cols,
+                    target_col=target_col,
+                    group_col=group_col,
+                    n_bootstrap=n_bootstrap,
+                    n_jobs=n_jobs,
+                ),
+                on="feature",
+            )
+
+    # Filter for significant features
+    significant_features = test_results.query("q_value < 0.05")["feature"].tolist()
+
+    # Convert the list of significant features to a string for saving
+    significant_features_str = ",".join(significant_features)
+
+    # Store the summary of results, including the significant features
+    category_summary = {
+        "category": category,
+        "logistic_regression_accuracy_mean": mean_accuracy,
+        "logistic_regression_accuracy_std": std_accuracy,
+        "num_significant_features": len(significant_features),
+        "significant_features": significant_features_str,
+        "full_test_results_file": test_results_file,  # Add the path of the full results file
+    }
+
+    # Compare the accuracy against a label-permutation null
+    if n_permutations > 0:
+        with stage(
+            "classification.permutation_test", n_permutations=n_permutations, **counts
+        ):
+            _, _, p_value = permutation_test_logistic_regression(
+                category_df,
+                feature_cols=feature_cols,
+                target_col=target_col,
+                group_col=group_col,
+                n_splits=5,
+                n_permutations=n_permutations,
+                n_jobs=n_jobs,
+            )
+        category_summary["logistic_regression_p_value"] = p_value
+
+    if test_mode != "well":
+        category_summary["test_mode"] = test_mode
+
+    # Record the inputs the results were computed from
+    category_summary["input_hash"] = input_hash
+
+    # Save the full test results to a Parquet file within the specified directory
+    summary_json = json.dumps(
+        category_summary, default=lambda value: value.item()
+    ).encode()
+    write_parquet_atomic(
+        test_results,
+        test_results_file,
+        metadata={SUMMARY_METADATA_KEY: summary_json},
+    )
+
+    return category_summary
+
+
+def save_summary_results(category_summaries, output_dir):
+    """
+    Assemble the per-category summaries and save them to `summary_results.parquet`.
+
+    Parameters:
+    - category_summaries: list, the summary dicts returned by `analyze_category`.
+    - output_dir: str, the directory to save the results to.
+
+    Returns:
+    - summary_results_file: str, the path of the saved file.
+    """
+    all_summary_results = pd.DataFrame(category_summaries)
+
+    # Save all summary results to a Parquet file, unless they did not change
+    summary_results_file = os.path.join(output_dir, "summary_results.parquet")
+    if not (
+        os.path.exists(summary_results_file)
+        and pd.read_parquet(summary_results_file).equals(all_summary_results)
+    ):
+        write_parquet_atomic(all_summary_results, summary_results_file)
+
+    print(f"Analysis complete. Summary results saved to {summary_results_file}")
+
+    return summary_results_file
+
+
 def perform_and_save_analysis(
-    df, category_col, target_col, target_col_mapping_dict, feature_cols, output_dir
+    df,
+    category_col,
+    target_col,
+    target_col_mapping_dict,
+    feature_cols,
+    output_dir,
+    n_permutations=0,
+    n_jobs=1,
+    use_cache=True,
+    n_bootstrap=0,
+    test_mode="well",
+    n_test_permutations=0,
 ):
     """
     Perform analysis and save results to a Parquet file.
@@ -156,14 +1323,25 @@ def perform_and_save_analysis(
     - target_col_mapping_dict: dict, a dictionary mapping target_col values to integers.
     - feature_cols: list, the list of feature columns to use for analysis.
     - output_dir: str, the directory to save the results to.
+    - n_permutations: int, number of label permutations for the classifier
+      accuracy p-value. No permutation test is run if 0.
+    - n_jobs: int, number of worker processes for the classifier folds, the
+      permutation test and the bootstrap.
+    - use_cache: bool, whether to skip the categories whose inputs did not change
+      since their results were saved.
+    - n_bootstrap: int, number of cell line bootstrap resamples for the effect
+      size intervals added to the test results. No effect sizes are added if 0.
+    - test_mode: str, "well" to test the wells or "line" to test the cell
+      lines, see `analyze_category`.
+    - n_test_permutations: int, number of line permutations of the "line" mode.
     """
 
     # Create a directory to store the results if it doesn't exist
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # Create a DataFrame to store all summary results
-    all_summary_results = pd.DataFrame()
+    # Store the summary of each category
+    category_summaries = []
 
     categories = df[category_col].unique()
 
@@ -186,54 +1364,20 @@ def perform_and_save_analysis(
         print(f"Analyzing category: {category}")
         category_df = df[df[category_col] == category]
 
-        # Perform logistic regression with Group K-Fold cross-validation
-        (
-            mean_accuracy,
-            std_accuracy,
-            feature_importances,
-        ) = group_kfold_cross_validate_logistic_regression(
-            category_df,
-            feature_cols=feature_cols,
-            target_col=target_col_encoded,
-            group_col="Metadata_line_ID",  # your group column here
-            n_splits=5,
-        )
-
-        # Perform Mann-Whitney U-test
-        test_results = mann_whitney_u_test(
-            category_df, feature_cols=feature_cols, target_col=target_col_encoded
+        category_summaries.append(
+            analyze_category(
+                category_df,
+                category=category,
+                target_col=target_col_encoded,
+                feature_cols=feature_cols,
+                output_dir=output_dir,
+                n_permutations=n_permutations,
+                n_jobs=n_jobs,
+                use_cache=use_cache,
+                n_bootstrap=n_bootstrap,
+                test_mode=test_mode,
+                n_test_permutations=n_test_permutations,
+            )
         )
 
-        # Save the full test results to a Parquet file within the specified directory
-        test_results_file = os.path.join(output_dir, f"test_results_{category}.parquet")
-        test_results.to_parquet(test_results_file)
-
-        # Filter for significant features
-        significant_features = test_results.query("q_value < 0.05")["feature"].tolist()
-
-        # Convert the list of significant features to a string for saving
-        significant_features_str = ",".join(significant_features)
-
-        # Store the summary of results, including the significant features
-        category_summary = {
-            "category": category,
-            "logistic_regression_accuracy_mean": mean_accuracy,
-            "logistic_regression_accuracy_std": std_accuracy,
-            "num_significant_features": len(significant_features),
-            "significant_features": significant_features_str,
-            "full_test_results_file": test_results_file,  # Add the path of the full results file
-        }
-
-        # Convert to DataFrame
-        category_summary_df = pd.DataFrame([category_summary])
-
-        # Append to all summary results
-        all_summary_results = pd.concat(
-            [all_summary_results, category_summary_df], ignore_index=True
-        )
-
-    # Save all summary results to a Parquet file
-    summary_results_file = os.path.join(output_dir, "summary_results.parquet")
-    all_summary_results.to_parquet(summary_results_file)
-
-    print(f"Analysis complete. Summary results saved to {summary_results_file}")
+    save_summary_results(category_summaries, output_dir)
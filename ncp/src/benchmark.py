@@ -0,0 +1,351 @@
+"""
+Benchmark the analysis hot paths on synthetic profiles.
+
+Each (benchmark, scale) case runs in a fresh process, so that its peak
+resident memory is measured on its own. Results can be saved as a JSON
+baseline and compared with a later run, e.g.
+
+    python ncp/src/benchmark.py --scale small medium --save baseline.json
+    python ncp/src/benchmark.py --scale small medium --compare baseline.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from analysis import (
+    effect_sizes,
+    group_kfold_cross_validate_logistic_regression,
+    line_level_test,
+    mann_whitney_u_test,
+)
+from data_management import process_dataframes_by_cell_type
+from feature_selection import feature_select
+from instrumentation import peak_rss_mb
+from my_run_pipeline import my_run_pipeline
+from normalization import mad_robustize_by_group
+from synthetic import synthetic_profiles
+
+# Arguments of `synthetic_profiles` at each scale
+SCALES = {
+    "small": {"n_plates": 2, "n_wells": 96, "n_features": 300},
+    "medium": {"n_plates": 6, "n_wells": 384, "n_features": 1000},
+    "large": {"n_plates": 12, "n_wells": 384, "n_features": 2000},
+}
+
+
+def _feature_cols(profiles):
+    return [col for col in profiles.columns if not col.startswith("Metadata_")]
+
+
+def _encode_condition(profiles):
+    return profiles.assign(
+        Metadata_line_condition_encoded=profiles["Metadata_line_condition"].map(
+            {"control": 0, "deletion": 1}
+        )
+    )
+
+
+def _mann_whitney_u_test(profiles):
+    return (
+        mann_whitney_u_test,
+        (
+            _encode_condition(profiles),
+            _feature_cols(profiles),
+            "Metadata_line_condition_encoded",
+        ),
+        {},
+    )
+
+
+def _effect_sizes(profiles):
+    return (
+        effect_sizes,
+        (
+            _encode_condition(profiles),
+            _feature_cols(profiles),
+            "Metadata_line_condition_encoded",
+            "Metadata_line_ID",
+        ),
+        {"n_bootstrap": 100},
+    )
+
+
+def _line_level_test(profiles):
+    return (
+        line_level_test,
+        (
+            _encode_condition(profiles),
+            _feature_cols(profiles),
+            "Metadata_line_condition_encoded",
+            "Metadata_line_ID",
+        ),
+        {"n_permutations": 1000},
+    )
+
+
+def _group_kfold(profiles):
+    return (
+        group_kfold_cross_validate_logistic_regression,
+        (
+            _encode_condition(profiles),
+            _feature_cols(profiles),
+            "Metadata_line_condition_encoded",
+            "Metadata_line_ID",
+        ),
+        {},
+    )
+
+
+# Normalization of 2.transform-data
+MAD_ROBUSTIZE_KWARGS = {"group_col": "Metadata_Plate", "epsilon": 1e-6}
+
+
+def _mad_robustize_by_group(profiles):
+    return mad_robustize_by_group, (profiles,), MAD_ROBUSTIZE_KWARGS
+
+
+def _feature_select(profiles):
+    # Features are selected from the normalized profiles
+    normalized = mad_robustize_by_group(profiles, **MAD_ROBUSTIZE_KWARGS)
+    return feature_select, (normalized,), {}
+
+
+def _process_all_cell_types(dfs, cell_types_data):
+    return {
+        cell_type: process_dataframes_by_cell_type(dfs, cell_type_data)
+        for cell_type, cell_type_data in cell_types_data.items()
+    }
+
+
+def _process_dataframes_by_cell_type(profiles):
+    # One frame per plate, with the columns the loading notebook drops and adds
+    dfs = {}
+    cell_types_data = {}
+    for (cell_type, plate), df in profiles.groupby(
+        ["Metadata_cell_type", "Metadata_Plate"]
+    ):
+        dfs[plate] = df.assign(
+            Cytoplasm_Parent_Cells=1,
+            Cytoplasm_Parent_Nuclei=1,
+            Metadata_well_position=df["Metadata_Well"],
+        ).drop(columns="Metadata_Object_Count")
+        cell_types_data.setdefault(
+            cell_type,
+            {
+                "keys": [],
+                "columns_to_drop": [
+                    "Cytoplasm_Parent_Cells",
+                    "Cytoplasm_Parent_Nuclei",
+                    "Metadata_well_position",
+                ],
+                "columns_to_add": {"Cells_Number_Object_Number": 200},
+                "columns_to_compute": {
+                    "Metadata_Object_Count": "2 * Metadata_Site_Count * Cells_Number_Object_Number",
+                },
+            },
+        )["keys"].append(plate)
+
+    return _process_all_cell_types, (dfs, cell_types_data), {}
+
+
+def _my_run_pipeline(profiles):
+    feature_cols = _feature_cols(profiles)
+    meta = profiles.drop(columns=feature_cols)
+    feats = profiles[feature_cols].fillna(0).to_numpy(dtype=np.float32)
+
+    return (
+        my_run_pipeline,
+        (
+            meta,
+            feats,
+            [
+                "Metadata_Plate",
+                "Metadata_cell_type",
+                "Metadata_line_ID",
+                "Metadata_line_source",
+            ],
+            [],
+            ["Metadata_Plate", "Metadata_cell_type"],
+            ["Metadata_line_ID"],
+            1000,
+        ),
+        {"null_cache_dir": None},
+    )
+
+
+# Setup of each benchmark: profiles -> (function, args, kwargs)
+BENCHMARKS = {
+    "mann_whitney_u_test": _mann_whitney_u_test,
+    "effect_sizes": _effect_sizes,
+    "line_level_test": _line_level_test,
+    "group_kfold_cross_validate_logistic_regression": _group_kfold,
+    "mad_robustize_by_group": _mad_robustize_by_group,
+    "feature_select": _feature_select,
+    "process_dataframes_by_cell_type": _process_dataframes_by_cell_type,
+    "my_run_pipeline": _my_run_pipeline,
+}
+
+
+def _run_case(name, scale, repeat):
+    """Time one benchmark at one scale; runs in its own process."""
+    profiles = synthetic_profiles(**SCALES[scale])
+    func, args, kwargs = BENCHMARKS[name](profiles)
+    setup_rss = peak_rss_mb()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+
+    peak_rss = peak_rss_mb()
+    return {
+        "benchmark": name,
+        "scale": scale,
+        "n_rows": len(profiles),
+        "n_features": SCALES[scale]["n_features"],
+        "repeat": repeat,
+        "wall_time_s": min(times),
+        "wall_time_median_s": float(np.median(times)),
+        "peak_rss_mb": peak_rss,
+        "peak_rss_increase_mb": peak_rss - setup_rss,
+    }
+
+
+def run_benchmarks(names=None, scales=("small",), repeat=3):
+    """
+    Run benchmarks at several scales.
+
+    Parameters:
+    - names: list of benchmark names (all of `BENCHMARKS` by default).
+    - scales: list of scale names (keys of `SCALES`).
+    - repeat: int, the number of timed calls of each case.
+
+    Returns:
+    - list of dicts, the best and median wall time and the peak resident
+      memory (total, and above the memory held after setup) of each case.
+    """
+    names = list(BENCHMARKS) if names is None else names
+    spawn = multiprocessing.get_context("spawn")
+
+    results = []
+    for scale in scales:
+        for name in names:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+                result = executor.submit(_run_case, name, scale, repeat).result()
+            print(
+                f"{name} [{scale}]: {result['wall_time_s']:.3f} s, "
+                f"{result['peak_rss_mb']:.0f} MB peak RSS"
+            )
+            results.append(result)
+
+    return results
+
+
+def environment():
+    """Describe the machine and library versions of a benchmark run."""
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def save_baseline(results, path):
+    """Save benchmark results and their environment as a JSON baseline."""
+    with open(path, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+
+def compare_to_baseline(results, path, tolerance=0.2):
+    """
+    Compare benchmark results with a JSON baseline.
+
+    Parameters:
+    - results: list of dicts, as returned by `run_benchmarks`.
+    - path: str, the baseline file.
+    - tolerance: float, the relative slowdown flagged as a regression.
+
+    Returns:
+    - pandas.DataFrame, the baseline and current wall time and peak memory of
+      the cases present in both, with their ratios and a `regression` flag.
+    """
+    with open(path) as f:
+        baseline = pd.DataFrame(json.load(f)["results"])
+
+    keys = ["benchmark", "scale"]
+    columns = ["wall_time_s", "peak_rss_mb"]
+    comparison = baseline[keys + columns].merge(
+        pd.DataFrame(results)[keys + columns],
+        on=keys,
+        suffixes=("_baseline", ""),
+    )
+    for col in columns:
+        comparison[f"{col}_ratio"] = comparison[col] / comparison[f"{col}_baseline"]
+    comparison["regression"] = comparison["wall_time_s_ratio"] > 1 + tolerance
+
+    return comparison
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=list(BENCHMARKS),
+        help="benchmarks to run (all by default)",
+    )
+    parser.add_argument(
+        "--scale",
+        nargs="+",
+        choices=list(SCALES),
+        default=["small"],
+        help="scales to run",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="number of timed calls of each case"
+    )
+    parser.add_argument("--save", metavar="PATH", help="save the results as a baseline")
+    parser.add_argument(
+        "--compare", metavar="PATH", help="compare the results with a baseline"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative slowdown reported as a regression",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    results = run_benchmarks(args.only, args.scale, args.repeat)
+
+    if args.save:
+        save_baseline(results, args.save)
+
+    if args.compare:
+        comparison = compare_to_baseline(results, args.compare, args.tolerance)
+        print(comparison.to_string(index=False))
+        if comparison["regression"].any():
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
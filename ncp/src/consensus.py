@@ -0,0 +1,174 @@
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from data_management import ColumnIndex
+from instrumentation import timed
+from normalization import infer_features
+
+CONSENSUS_OPERATIONS = ("mean", "median", "trimmed_mean")
+
+
+def stratum_offsets(meta, strata):
+    """
+    Sort rows by stratum so that each stratum occupies a contiguous range.
+
+    Strata are ordered as in `DataFrame.groupby(strata, dropna=False)`, so
+    missing values form their own strata.
+
+    Parameters:
+    - meta: pandas.DataFrame, the metadata.
+    - strata: list, the columns defining the strata.
+
+    Returns:
+    - order: numpy.ndarray, the row positions sorted by stratum.
+    - offsets: numpy.ndarray, the start of each stratum in `order`, followed by the number of rows.
+    - keys: pandas.DataFrame, the strata columns of each stratum.
+    """
+    grouped = meta.groupby(strata, dropna=False, sort=True)
+    codes = grouped.ngroup().to_numpy()
+    order = np.argsort(codes, kind="stable")
+
+    counts = np.bincount(codes, minlength=grouped.ngroups)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    keys = grouped.size().index.to_frame(index=False)
+    return order, offsets, keys
+
+
+def _trimmed_mean(block, trim):
+    """Trimmed mean of each column, over its present values, as `scipy.stats.trim_mean`."""
+    block = np.sort(block, axis=0)  # missing values sort last
+    n = (~np.isnan(block)).sum(axis=0)
+    cut = (trim * n).astype(np.int64)
+
+    cumsum = np.zeros((len(block) + 1, block.shape[1]), dtype=np.float64)
+    np.cumsum(np.nan_to_num(block), axis=0, dtype=np.float64, out=cumsum[1:])
+
+    lo = np.take_along_axis(cumsum, cut[None, :], axis=0)[0]
+    hi = np.take_along_axis(cumsum, (n - cut)[None, :], axis=0)[0]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (hi - lo) / (n - 2 * cut)
+
+
+def aggregate_features(
+    meta, X, strata, operation="median", trim=0.1, dtype=np.float32, n_jobs=1
+):
+    """
+    Reduce the feature matrix to one consensus profile per stratum.
+
+    The rows are sorted by stratum once. Means are reduced for all strata in
+    a single pass; medians and trimmed means are reduced per stratum block,
+    concurrently with `n_jobs` threads. Missing values are ignored.
+
+    Parameters:
+    - meta: pandas.DataFrame, the metadata, aligned with the rows of X.
+    - X: numpy.ndarray, (n_rows, n_features) features, e.g. `FeatureStore.features`.
+    - strata: list, the metadata columns defining the strata.
+    - operation: str, one of `CONSENSUS_OPERATIONS`.
+    - trim: float, the fraction cut from each end of a stratum by "trimmed_mean".
+    - dtype: numpy dtype of the consensus profiles.
+    - n_jobs: int, number of threads reducing strata concurrently.
+
+    Returns:
+    - profiles: numpy.ndarray, (n_strata, n_features) consensus profiles.
+    - counts: numpy.ndarray, the number of rows of each stratum.
+    - keys: pandas.DataFrame, the strata columns of each stratum.
+    """
+    if operation not in CONSENSUS_OPERATIONS:
+        raise ValueError(
+            f"Unknown operation {operation!r}, expected one of {CONSENSUS_OPERATIONS}."
+        )
+
+    order, offsets, keys = stratum_offsets(meta, strata)
+    X_sorted = np.asarray(X)[order]
+    counts = np.diff(offsets)
+
+    if operation == "mean":
+        present = ~np.isnan(X_sorted)
+        sums = np.add.reduceat(
+            np.where(present, X_sorted, 0), offsets[:-1], axis=0, dtype=np.float64
+        )
+        n = np.add.reduceat(present, offsets[:-1], axis=0, dtype=np.int64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (sums / n).astype(dtype), counts, keys
+
+    profiles = np.empty((len(counts), X_sorted.shape[1]), dtype=dtype)
+
+    def reduce_stratum(stratum):
+        block = X_sorted[offsets[stratum] : offsets[stratum + 1]]
+        if operation == "median":
+            with warnings.catch_warnings():
+                # All-NaN columns stay NaN
+                warnings.simplefilter("ignore", RuntimeWarning)
+                profiles[stratum] = np.nanmedian(block.astype(np.float64), axis=0)
+        else:
+            profiles[stratum] = _trimmed_mean(block, trim)
+
+    if n_jobs == 1:
+        for stratum in range(len(counts)):
+            reduce_stratum(stratum)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(reduce_stratum, range(len(counts))))
+
+    return profiles, counts, keys
+
+
+@timed("aggregation")
+def consensus_profiles(
+    df,
+    strata=None,
+    features="infer",
+    operation="median",
+    trim=0.1,
+    image_features=False,
+    count_col="Metadata_Count",
+    dtype=np.float32,
+    n_jobs=1,
+):
+    """
+    Build consensus profiles of strata, like `pycytominer.aggregate`.
+
+    Same strata and features as `pycytominer.aggregate`, plus the trimmed mean
+    and the number of profiles of each stratum. The features are reduced as
+    a float32 matrix by `aggregate_features`.
+
+    Parameters:
+    - df: pandas.DataFrame, the profiles.
+    - strata: list, the columns defining the strata, e.g.
+      ["Metadata_LINE_ID", "Metadata_GENOTYPE"] (["Metadata_Plate",
+      "Metadata_Well"] by default).
+    - features: list or "infer", the feature columns.
+    - operation: str, one of `CONSENSUS_OPERATIONS`.
+    - trim: float, the fraction cut from each end of a stratum by "trimmed_mean".
+    - image_features: bool, whether inferred features include the Image features.
+    - count_col: str, the column holding the number of profiles of each stratum.
+    - dtype: numpy dtype of the consensus profiles.
+    - n_jobs: int, number of threads reducing strata concurrently.
+
+    Returns:
+    - pandas.DataFrame, the strata, count and consensus feature columns.
+    """
+    strata = ["Metadata_Plate", "Metadata_Well"] if strata is None else list(strata)
+    if features == "infer":
+        features = infer_features(
+            ColumnIndex(df.columns), image_features=image_features
+        )
+
+    profiles, counts, keys = aggregate_features(
+        df[strata],
+        df[features].to_numpy(dtype=dtype),
+        strata,
+        operation=operation,
+        trim=trim,
+        dtype=dtype,
+        n_jobs=n_jobs,
+    )
+
+    keys[count_col] = counts
+    return pd.concat(
+        [keys, pd.DataFrame(profiles, columns=features, copy=False)], axis=1
+    )
@@ -0,0 +1,153 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from data_management import ColumnIndex
+from instrumentation import timed
+from normalization import group_offsets, infer_features
+
+
+def regress_out(X, covariate):
+    """
+    Regress a covariate out of every column of a block.
+
+    Fits `X[:, j] = intercept[j] + slope[j] * covariate` by least squares for
+    all the columns at once: with a single covariate the solution only needs
+    the column sums of X, X * covariate and the mask of present values, i.e.
+    a few matrix products. Missing values are left out of their column's fit
+    and stay missing.
+
+    Parameters:
+    - X: numpy.ndarray, (n_samples, n_features) block.
+    - covariate: numpy.ndarray, (n_samples,) covariate.
+
+    Returns:
+    - residuals: numpy.ndarray, float64 (n_samples, n_features) residuals.
+    - r_squared: numpy.ndarray, the coefficient of determination of each fit
+      (NaN for constant columns).
+    - slope: numpy.ndarray, the slope of each fit (0 if the covariate is constant).
+    - intercept: numpy.ndarray, the intercept of each fit.
+    - n: numpy.ndarray, the number of samples in each fit.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    covariate = np.asarray(covariate, dtype=np.float64)
+
+    # Rows without a covariate are left out of every fit
+    present = ~np.isnan(X) & ~np.isnan(covariate)[:, None]
+
+    # Center the covariate to keep the sums of squares well conditioned
+    shift = np.nanmean(covariate) if present.any() else 0.0
+    c = np.where(np.isnan(covariate), 0.0, covariate - shift)
+    Xz = np.where(present, X, 0.0)
+    mask = present.astype(np.float64)
+
+    n = present.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_c = (c @ mask) / n
+        mean_x = Xz.sum(axis=0) / n
+        s_cc = (c**2) @ mask - n * mean_c**2
+        s_cx = c @ Xz - n * mean_c * mean_x
+        s_xx = (Xz**2).sum(axis=0) - n * mean_x**2
+
+        slope = np.where(s_cc > 0, s_cx / s_cc, 0.0)
+        r_squared = np.where(
+            (s_cc > 0) & (s_xx > 0), s_cx**2 / (s_cc * s_xx), np.nan
+        ).clip(max=1.0)
+
+    intercept = mean_x - slope * mean_c
+    residuals = X - intercept - np.outer(covariate - shift, slope)
+
+    return residuals, r_squared, slope, intercept - slope * shift, n
+
+
+@timed("regress_out")
+def regress_out_covariate(
+    df,
+    covariate="Cells_Number_Object_Number",
+    group_col=None,
+    features="infer",
+    image_features=False,
+    dtype=np.float32,
+    n_jobs=1,
+):
+    """
+    Regress a covariate, such as the cell count, out of every feature.
+
+    Replaces the per-feature `LinearRegression` loop of the
+    `Progenitors_04_regressing_out_cell_count` notebook with `regress_out`,
+    optionally fitting each group (e.g. plate or cell type) separately.
+
+    Parameters:
+    - df: pandas.DataFrame, the profiles.
+    - covariate: str or array-like, the covariate column (e.g.
+      "Cells_Number_Object_Number" or "Metadata_Object_Count") or its values,
+      aligned with the rows of `df`, e.g. a column of another frame.
+    - group_col: str, the column to fit each group of separately, or None for
+      a single fit.
+    - features: list or "infer", the feature columns. The covariate column,
+      or the column named like a covariate Series, is never residualized.
+    - image_features: bool, whether inferred features include the Image features.
+    - dtype: numpy dtype of the residualized features.
+    - n_jobs: int, number of threads fitting groups concurrently.
+
+    Returns:
+    - residualized: pandas.DataFrame, `df` with the features replaced by their
+      residuals, in the original row order. Rows with a missing group are dropped.
+    - fits: pandas.DataFrame, the group (if any), feature, r_squared, slope,
+      intercept and number of samples of each fit.
+    """
+    if features == "infer":
+        features = infer_features(
+            ColumnIndex(df.columns), image_features=image_features
+        )
+
+    if isinstance(covariate, str):
+        covariate = df[covariate]
+    features = [col for col in features if col != getattr(covariate, "name", None)]
+    covariate = np.asarray(covariate, dtype=np.float64)
+
+    if group_col is None:
+        order = np.arange(len(df))
+        offsets = np.array([0, len(df)])
+        groups = [None]
+    else:
+        order, offsets, groups = group_offsets(df[group_col].to_numpy())
+
+    values = df[features].to_numpy(dtype=np.float64)
+    residuals = np.empty((len(df), len(features)), dtype=dtype)
+    fits = [None] * len(groups)
+
+    def fit_group(group):
+        rows = order[offsets[group] : offsets[group + 1]]
+        residuals[rows], *fits[group] = regress_out(values[rows], covariate[rows])
+
+    if n_jobs == 1:
+        for group in range(len(groups)):
+            fit_group(group)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(fit_group, range(len(groups))))
+
+    kept = np.sort(order)
+    residualized = df.iloc[kept].copy()
+    residualized[features] = pd.DataFrame(
+        residuals[kept], columns=features, index=residualized.index, copy=False
+    )
+
+    fit_frames = []
+    for group, (r_squared, slope, intercept, n) in zip(groups, fits):
+        fit = pd.DataFrame(
+            {
+                "feature": features,
+                "r_squared": r_squared,
+                "slope": slope,
+                "intercept": intercept,
+                "n": n,
+            }
+        )
+        if group_col is not None:
+            fit.insert(0, group_col, group)
+        fit_frames.append(fit)
+
+    return residualized, pd.concat(fit_frames, ignore_index=True)
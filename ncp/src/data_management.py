@@ -1,43 +1,269 @@
+import bisect
+import hashlib
+import os
+import re
+import shutil
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from instrumentation import timed
+
+# Parquet copies of the CSV.gz profiles, keyed by file hash
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ncp", "profiles")
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 hex digest of a file's content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_parquet_path(csv_path, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Return the Parquet copy of a CSV(.gz) file, building it on first use.
+
+    The copy is keyed by the hash of the CSV content, so it is rebuilt
+    whenever the CSV changes.
+    """
+    name = os.path.basename(csv_path).split(".")[0]
+    parquet_path = os.path.join(cache_dir, f"{name}_{file_hash(csv_path)[:16]}.parquet")
+
+    if not os.path.exists(parquet_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+        pd.read_csv(csv_path).to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, parquet_path)
+
+    return parquet_path
+
+
+class ColumnIndex:
+    """
+    Index of a dataset's column names, built once and reused for selections.
+
+    Prefix lookups bisect a sorted copy of the names, so they cost time
+    proportional to the number of matches rather than to the number of
+    columns. Regex selections are memoized per pattern. All selections return
+    names in the original column order.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self._position = {col: i for i, col in enumerate(self.columns)}
+        self._sorted = sorted(self.columns)
+        self._pattern_cache = {}
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __contains__(self, col):
+        return col in self._position
+
+    def _in_order(self, cols):
+        return sorted(set(cols), key=self._position.__getitem__)
+
+    def exact(self, names):
+        """Return the names that are columns."""
+        return self._in_order(name for name in names if name in self._position)
+
+    def prefix(self, prefixes):
+        """Return the columns starting with any of the prefixes."""
+        if isinstance(prefixes, str):
+            prefixes = [prefixes]
+
+        matches = []
+        for prefix in prefixes:
+            i = bisect.bisect_left(self._sorted, prefix)
+            while i < len(self._sorted) and self._sorted[i].startswith(prefix):
+                matches.append(self._sorted[i])
+                i += 1
+
+        return self._in_order(matches)
+
+    def pattern(self, pattern):
+        """Return the columns containing a match of the regular expression."""
+        if pattern not in self._pattern_cache:
+            regex = re.compile(pattern)
+            self._pattern_cache[pattern] = [
+                col for col in self.columns if regex.search(col)
+            ]
+        return list(self._pattern_cache[pattern])
+
+    def select(self, exact=(), prefixes=(), pattern=None):
+        """Return the union of an exact, a prefix, and a regex selection."""
+        cols = self.exact(exact) + self.prefix(prefixes)
+        if pattern is not None:
+            cols += self.pattern(pattern)
+        return self._in_order(cols)
 
 
-def load_dataframe(base_path, batch, plate, data_level):
+def diff_schemas(dfs_list):
+    """
+    Compare the columns of dataframes against the first one in a single pass.
+
+    Parameters:
+    - dfs_list: list of DataFrames (or of column lists).
+
+    Returns:
+    - DataFrame with one row per mismatch and the columns "frame" (1-based
+      position in `dfs_list`), "column", and "status" ("extra" or "missing").
+    """
+    columns_list = [getattr(df, "columns", df) for df in dfs_list]
+    reference_columns = list(columns_list[0])
+    reference_set = set(reference_columns)
+
+    rows = []
+    for idx, columns in enumerate(columns_list[1:], 2):
+        current_set = set(columns)
+        rows += [(idx, col, "extra") for col in columns if col not in reference_set]
+        rows += [
+            (idx, col, "missing") for col in reference_columns if col not in current_set
+        ]
+
+    return pd.DataFrame(rows, columns=["frame", "column", "status"])
+
+
+def select_columns(all_columns, columns, prefixes=None):
+    """
+    Select column names by exact name, prefix, or regular expression.
+
+    Metadata columns are always kept.
+
+    Parameters:
+    - all_columns: list or ColumnIndex, the available column names.
+    - columns: None, a regex string (e.g. "Cells_|Cytoplasm_|Nuclei_"), or a
+      list of exact column names.
+    - prefixes: None, or a list of column name prefixes (e.g. ["Cells_AreaShape_"]).
+      All columns are selected if neither `columns` nor `prefixes` is given.
+
+    Returns:
+    - list, the selected column names in their original order.
+    """
+    if isinstance(all_columns, ColumnIndex):
+        index = all_columns
+    else:
+        index = ColumnIndex(all_columns)
+
+    if columns is None and prefixes is None:
+        return list(index.columns)
+
+    prefixes = ["Metadata_"] + list(prefixes or [])
+    if isinstance(columns, str):
+        return index.select(prefixes=prefixes, pattern=columns)
+
+    return index.select(exact=columns or (), prefixes=prefixes)
+
+
+def profile_path(base_path, batch, plate, data_level):
+    """
+    Return the path of a plate's CSV.gz profiles at a given data level.
+    """
+    return f"{base_path}/{batch}/{plate}/{plate}_{data_level}.csv.gz"
+
+
+@timed("loading")
+def load_dataframe(
+    base_path,
+    batch,
+    plate,
+    data_level,
+    columns=None,
+    prefixes=None,
+    filters=None,
+    feature_dtype=None,
+    categorical_metadata=False,
+    cache_dir=DEFAULT_CACHE_DIR,
+):
     """
     Load a dataframe given the base path, batch name, plate name, and data level.
+
+    The CSV.gz is parsed once into a Parquet copy in `cache_dir`, keyed by the
+    hash of the CSV.gz. Later loads read only the requested columns and rows
+    from that copy.
+
+    Parameters:
+    - base_path: str, the profiles directory.
+    - batch: str, the batch name.
+    - plate: str, the plate name.
+    - data_level: str, the data level, e.g. "augmented".
+    - columns: None, a regex string (e.g. "Cells_|Cytoplasm_|Nuclei_"), or a
+      list of exact column names. Metadata columns are always kept.
+    - prefixes: None, or a list of column name prefixes to select as well, see
+      `select_columns`. All columns are loaded if neither is given.
+    - filters: list, optional row predicates in pyarrow format, e.g.
+      [("Metadata_line_source", "==", "human")].
+    - feature_dtype: str, optional dtype of the feature columns, e.g. "float32".
+    - categorical_metadata: bool, whether to load string metadata columns as category.
+    - cache_dir: str, the directory of the Parquet copies. If None, the CSV.gz
+      is read directly.
+
+    Returns:
+    - df: DataFrame, the profiles.
     """
-    path = f"{base_path}/{batch}/{plate}/{plate}_{data_level}.csv.gz"
-    return pd.read_csv(path)
+    path = profile_path(base_path, batch, plate, data_level)
+
+    if cache_dir is None:
+        df = pd.read_csv(path)
+        df = df[select_columns(df.columns, columns, prefixes)]
+        if filters is not None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            df = table.filter(pq.filters_to_expression(filters)).to_pandas()
+    else:
+        parquet_path = cached_parquet_path(path, cache_dir)
+        selected = select_columns(pq.read_schema(parquet_path).names, columns, prefixes)
+        df = pd.read_parquet(parquet_path, columns=selected, filters=filters)
+
+    if feature_dtype is not None:
+        feature_cols = [col for col in df.columns if not col.startswith("Metadata_")]
+        df[feature_cols] = df[feature_cols].astype(feature_dtype)
+
+    if categorical_metadata:
+        metadata_cols = [
+            col
+            for col in df.columns
+            if col.startswith("Metadata_")
+            and not pd.api.types.is_numeric_dtype(df[col])
+        ]
+        df[metadata_cols] = df[metadata_cols].astype("category")
+
+    return df
 
 
 def check_matching_columns(dfs_list):
     """
     Check if all dataframes in the list have the same columns.
     If not, report the columns that are different and raise an error.
+
+    Returns the mismatches as a DataFrame, see `diff_schemas`.
     """
-    reference_columns = set(dfs_list[0].columns)
+    schema_diff = diff_schemas(dfs_list)
     mismatch_info = []
 
-    for idx, df in enumerate(
-        dfs_list[1:], 2
-    ):  # Start from 2 to account for 0-based indexing + reference df
-        current_columns = set(df.columns)
-
-        extra_columns = current_columns - reference_columns
-        missing_columns = reference_columns - current_columns
-
-        if extra_columns or missing_columns:
-            info = f"DataFrame {idx} Mismatch:\n"
-            if extra_columns:
-                info += (
-                    f"{len(extra_columns)} Extra Columns:\n\t"
-                    + "\n\t".join(extra_columns)
-                    + "\n"
-                )
-            if missing_columns:
-                info += f"{len(missing_columns)} Missing Columns:\n\t" + "\n\t".join(
-                    missing_columns
-                )
-            mismatch_info.append(info)
+    # Frames are numbered from 2 to account for 0-based indexing + reference df
+    for idx, frame_diff in schema_diff.groupby("frame", sort=True):
+        extra_columns = frame_diff.query("status == 'extra'")["column"].tolist()
+        missing_columns = frame_diff.query("status == 'missing'")["column"].tolist()
+
+        info = f"DataFrame {idx} Mismatch:\n"
+        if extra_columns:
+            info += (
+                f"{len(extra_columns)} Extra Columns:\n\t"
+                + "\n\t".join(extra_columns)
+                + "\n"
+            )
+        if missing_columns:
+            info += f"{len(missing_columns)} Missing Columns:\n\t" + "\n\t".join(
+                missing_columns
+            )
+        mismatch_info.append(info)
 
     if mismatch_info:
         detailed_error = "Dataframes have different columns:\n" + "\n".join(
@@ -47,53 +273,59 @@ def check_matching_columns(dfs_list):
         # don't raise error for now just print
         print(detailed_error)
 
+    return schema_diff
 
-def drop_columns(df, columns_to_drop):
+
+def drop_columns(df, columns_to_drop, index=None):
     """
     Drop specified columns or columns matching patterns if they exist in the dataframe.
-    """
-    exact_columns_to_drop = [col for col in columns_to_drop if col in df.columns]
 
-    # Identify columns based on patterns
-    pattern_columns_to_drop = []
-    for pattern in columns_to_drop:
-        matched_columns = [col for col in df.columns if col.startswith(pattern)]
-        pattern_columns_to_drop.extend(matched_columns)
+    An existing ColumnIndex of the dataframe's columns can be passed as `index`.
+    """
+    if index is None:
+        index = ColumnIndex(df.columns)
 
-    all_columns_to_drop = set(exact_columns_to_drop + pattern_columns_to_drop)
-    return df.drop(columns=all_columns_to_drop, axis=1)
+    # Exact names are prefixes of themselves
+    return df.drop(columns=index.prefix(columns_to_drop))
 
 
-def process_dataframes_by_cell_type(dfs, cell_type_data):
+def transform_dataframe(df, cell_type_data):
     """
-    Process dataframes for a specific cell type:
+    Apply the transforms configured for a cell type to one dataframe:
     - Drop specified columns
     - Rename specified columns
     - Add new columns with default values
-    - Check if columns match (if multiple dataframes)
-    - Concatenate dataframes for the cell type
+    - Compute new columns from expressions
     """
-    cell_dfs = [dfs[key] for key in cell_type_data["keys"]]
-
     # Drop columns
-    columns_to_drop = cell_type_data.get("columns_to_drop", [])
-    cell_dfs = [drop_columns(df, columns_to_drop) for df in cell_dfs]
+    df = drop_columns(df, cell_type_data.get("columns_to_drop", []))
 
     # Rename columns
-    columns_to_rename = cell_type_data.get("columns_to_rename", {})
-    cell_dfs = [df.rename(columns=columns_to_rename) for df in cell_dfs]
+    df = df.rename(columns=cell_type_data.get("columns_to_rename", {}))
 
     # Add new columns with default values
-    columns_to_add = cell_type_data.get("columns_to_add", {})
-    for col, default_val in columns_to_add.items():
-        for df in cell_dfs:
-            df[col] = default_val
+    for col, default_val in cell_type_data.get("columns_to_add", {}).items():
+        df[col] = default_val
 
     # Compute new columns based on expressions involving existing columns
-    columns_to_compute = cell_type_data.get("columns_to_compute", {})
-    for new_col, expression in columns_to_compute.items():
-        for df in cell_dfs:
-            df[new_col] = df.eval(expression)
+    for new_col, expression in cell_type_data.get("columns_to_compute", {}).items():
+        df[new_col] = df.eval(expression)
+
+    return df
+
+
+def process_dataframes_by_cell_type(dfs, cell_type_data):
+    """
+    Process dataframes for a specific cell type:
+    - Drop specified columns
+    - Rename specified columns
+    - Add new columns with default values
+    - Check if columns match (if multiple dataframes)
+    - Concatenate dataframes for the cell type
+    """
+    cell_dfs = [
+        transform_dataframe(dfs[key], cell_type_data) for key in cell_type_data["keys"]
+    ]
 
     # Check columns if there are multiple dataframes for the cell type
     if len(cell_dfs) > 1:
@@ -101,3 +333,162 @@ def process_dataframes_by_cell_type(dfs, cell_type_data):
 
     # Concatenate dataframes for the cell type
     return pd.concat(cell_dfs)
+
+
+def _arrow_type(dtype):
+    """
+    Map a pandas dtype to the Arrow type used in the merged dataset.
+    """
+    if pd.api.types.is_bool_dtype(dtype):
+        return pa.bool_()
+    if pd.api.types.is_numeric_dtype(dtype):
+        return pa.from_numpy_dtype(dtype)
+    return pa.string()
+
+
+def _unify_schema(frames, leading_columns=()):
+    """
+    Compute one Arrow schema covering the columns of all frames.
+
+    Numeric types are promoted to a common type, integer and boolean columns
+    missing from some frames become float64 (they will hold NaN), and
+    conflicting non-numeric types become strings. `leading_columns` come
+    first; the other columns follow sorted by name.
+    """
+    columns = set(col for df in frames for col in df.columns)
+    columns = [col for col in leading_columns if col in columns] + sorted(
+        columns - set(leading_columns)
+    )
+
+    fields = []
+    for col in columns:
+        dtypes = [df[col].dtype for df in frames if col in df.columns]
+        types = {_arrow_type(dtype) for dtype in dtypes}
+        if len(types) == 1:
+            arrow_type = types.pop()
+        elif all(pd.api.types.is_numeric_dtype(dtype) for dtype in dtypes):
+            arrow_type = pa.from_numpy_dtype(np.result_type(*dtypes))
+        else:
+            arrow_type = pa.string()
+
+        if len(dtypes) < len(frames) and (
+            pa.types.is_integer(arrow_type) or pa.types.is_boolean(arrow_type)
+        ):
+            arrow_type = pa.float64()
+
+        fields.append(pa.field(col, arrow_type))
+
+    return pa.schema(fields)
+
+
+def _to_arrow_table(df, schema):
+    """
+    Convert a dataframe to an Arrow table with exactly the given schema.
+    """
+    arrays = []
+    for field in schema:
+        if field.name not in df.columns:
+            arrays.append(pa.nulls(len(df), type=field.type))
+            continue
+
+        values = df[field.name]
+        if pa.types.is_string(field.type) and pd.api.types.is_numeric_dtype(values):
+            values = values.map(lambda v: None if pd.isna(v) else str(v))
+        arrays.append(pa.array(values, type=field.type, from_pandas=True))
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_cell_types_dataset(
+    datasets,
+    cell_types_data,
+    output_path,
+    metadata_lookup=None,
+    leading_columns=(),
+    cache_dir=DEFAULT_CACHE_DIR,
+):
+    """
+    Merge the plates of all cell types into one Parquet file.
+
+    Plates are loaded, transformed with `transform_dataframe`, and appended
+    one at a time, so no more than one plate is held in memory. The unified
+    schema is computed up front from the Parquet schemas of the cached
+    plates. Each plate is written as its own row groups, in the order of
+    `cell_types_data`, to a temporary file that replaces `output_path` once
+    complete; a directory left at `output_path` (e.g. an earlier partitioned
+    dataset) is removed first.
+
+    Parameters:
+    - datasets: list of dicts with the keys "key", "base_path", "batch", "plate",
+      and "data_level".
+    - cell_types_data: dict, the transforms of each cell type, as used by
+      `process_dataframes_by_cell_type`; "keys" refer to `datasets`.
+    - output_path: str, the Parquet file, e.g. `combined.parquet`.
+    - metadata_lookup: DataFrame, optional. Its columns are mapped onto every
+      plate from the column named by its index, e.g. a table indexed by
+      `Metadata_line_ID` with a `Metadata_line_condition` column.
+    - leading_columns: list, columns to put first; the other columns follow
+      sorted by name.
+    - cache_dir: str, the directory of the Parquet copies of the CSV.gz files.
+
+    Returns:
+    - schema: pyarrow.Schema, the unified schema of the file.
+    """
+    datasets = {dataset["key"]: dataset for dataset in datasets}
+    plates = [
+        (cell_type, datasets[key])
+        for cell_type, cell_type_data in cell_types_data.items()
+        for key in cell_type_data["keys"]
+    ]
+
+    def transform(df, cell_type):
+        df = transform_dataframe(df, cell_types_data[cell_type])
+        df["Metadata_cell_type"] = cell_type
+        if metadata_lookup is not None:
+            keys = df[metadata_lookup.index.name]
+            for col in metadata_lookup.columns:
+                df[col] = keys.map(metadata_lookup[col])
+        return df
+
+    # Compute the unified schema from empty frames with each plate's columns
+    empty_frames = {}
+    for cell_type, dataset in plates:
+        path = profile_path(
+            dataset["base_path"],
+            dataset["batch"],
+            dataset["plate"],
+            dataset["data_level"],
+        )
+        empty_df = pq.read_schema(cached_parquet_path(path, cache_dir))
+        empty_frames.setdefault(cell_type, []).append(
+            transform(empty_df.empty_table().to_pandas(), cell_type)
+        )
+
+    for cell_type, frames in empty_frames.items():
+        if len(frames) > 1:
+            check_matching_columns(frames)
+
+    schema = _unify_schema(
+        [df for frames in empty_frames.values() for df in frames], leading_columns
+    )
+
+    if os.path.isdir(output_path):
+        shutil.rmtree(output_path)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for cell_type, dataset in plates:
+            print(f"Writing {cell_type}: {dataset['plate']}")
+            df = load_dataframe(
+                dataset["base_path"],
+                dataset["batch"],
+                dataset["plate"],
+                dataset["data_level"],
+                cache_dir=cache_dir,
+            )
+            writer.write_table(_to_arrow_table(transform(df, cell_type), schema))
+            del df
+    os.replace(tmp_path, output_path)
+
+    return schema
@@ -0,0 +1,359 @@
+import numpy as np
+
+from instrumentation import timed
+from normalization import infer_features
+
+FEATURE_SELECT_OPERATIONS = ["variance_threshold", "correlation_threshold"]
+
+
+def _column_blocks(n_columns, block_size):
+    """Yield consecutive column ranges of at most `block_size` columns."""
+    for start in range(0, n_columns, block_size):
+        yield slice(start, min(start + block_size, n_columns))
+
+
+def _value_counts(block):
+    """
+    Count the distinct non-NaN values of each column of a block.
+
+    Parameters:
+    - block: numpy.ndarray, (n_samples, n_columns) block.
+
+    Returns:
+    - n_unique: numpy.ndarray, the number of distinct values of each column.
+    - max_count: numpy.ndarray, the count of the most common value (0 if none).
+    - second_count: numpy.ndarray, the count of the second most common value (0 if none).
+    """
+    n_columns = block.shape[1]
+    sorted_values = np.sort(block, axis=0).T
+
+    # Runs of equal values start where the value changes; NaNs (sorted last)
+    # never compare equal, so each one is a run of its own
+    starts = np.ones(sorted_values.shape, dtype=bool)
+    starts[:, 1:] = sorted_values[:, 1:] != sorted_values[:, :-1]
+    run_starts = np.flatnonzero(starts)
+    run_lengths = np.diff(np.append(run_starts, sorted_values.size))
+
+    valid = ~np.isnan(sorted_values.ravel()[run_starts])
+    run_columns = run_starts[valid] // sorted_values.shape[1]
+    run_lengths = run_lengths[valid]
+
+    n_unique = np.bincount(run_columns, minlength=n_columns)
+
+    # Runs of each column by decreasing count
+    order = np.lexsort((-run_lengths, run_columns))
+    run_lengths = np.append(run_lengths[order], 0)
+    first = np.searchsorted(run_columns[order], np.arange(n_columns))
+
+    max_count = np.where(n_unique > 0, run_lengths[first], 0)
+    second_count = np.where(
+        n_unique > 1, run_lengths[np.minimum(first + 1, len(order))], 0
+    )
+
+    return n_unique, max_count, second_count
+
+
+def variance_threshold(
+    population_df, features, freq_cut=0.05, unique_cut=0.01, block_size=256
+):
+    """
+    Find features with near-zero variance, as `pycytominer`'s `variance_threshold`.
+
+    A feature is excluded if the count of its second most common value is less
+    than `freq_cut` times the count of its most common value, or if its number of
+    distinct values is less than `unique_cut` times the number of samples. The
+    columns are processed in blocks of `block_size`, so only one block is copied
+    at a time.
+
+    Parameters:
+    - population_df: pandas.DataFrame, the profiles.
+    - features: list, the feature columns.
+    - freq_cut: float, the minimum ratio of the second most to the most common value count.
+    - unique_cut: float, the minimum ratio of distinct values to samples.
+    - block_size: int, the number of columns processed at a time.
+
+    Returns:
+    - list, the excluded features.
+    """
+    excluded = []
+
+    for block in _column_blocks(len(features), block_size):
+        block_features = features[block]
+        n_unique, max_count, second_count = _value_counts(
+            population_df[block_features].to_numpy()
+        )
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            low_freq = (n_unique < 2) | (second_count / max_count < freq_cut)
+        low_unique = n_unique / len(population_df) < unique_cut
+
+        excluded += [
+            feature
+            for feature, exclude in zip(block_features, low_freq | low_unique)
+            if exclude
+        ]
+
+    return excluded
+
+
+def _standardize(X):
+    """
+    Center the columns of a float64 block and scale them to unit norm, so that
+    the correlation of two columns is their dot product. Constant columns are
+    set to zero.
+    """
+    X = X - X.mean(axis=0)
+    norms = np.sqrt(np.einsum("ij,ij->j", X, X))
+    return np.divide(X, norms, out=np.zeros_like(X), where=norms > 0)
+
+
+def _masked_correlation(Xa, Xb):
+    """
+    Pearson correlation of the columns of two float64 blocks over the rows where
+    both columns are observed, as `DataFrame.corr`.
+
+    Parameters:
+    - Xa: numpy.ndarray, (n_samples, a) block, possibly with NaNs.
+    - Xb: numpy.ndarray, (n_samples, b) block, possibly with NaNs.
+
+    Returns:
+    - numpy.ndarray, (a, b) correlations; NaN where a column is constant over
+      the shared rows.
+    """
+    Ma = (~np.isnan(Xa)).astype(np.float64)
+    Mb = (~np.isnan(Xb)).astype(np.float64)
+    Xa = np.nan_to_num(Xa, nan=0.0)
+    Xb = np.nan_to_num(Xb, nan=0.0)
+
+    n = Ma.T @ Mb
+    sum_a = Xa.T @ Mb
+    sum_b = Ma.T @ Xb
+    sum_aa = (Xa * Xa).T @ Mb
+    sum_bb = Ma.T @ (Xb * Xb)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = Xa.T @ Xb - sum_a * sum_b / n
+        var_a = sum_aa - sum_a**2 / n
+        var_b = sum_bb - sum_b**2 / n
+
+        # Treat variances lost to cancellation as zero
+        constant = (var_a <= 1e-12 * sum_aa) | (var_b <= 1e-12 * sum_bb)
+        corr = cov / np.sqrt(var_a * var_b)
+
+    corr[constant | (n < 1)] = np.nan
+
+    return corr
+
+
+def _pair_correlation(x, y):
+    """Two-pass Pearson correlation of two columns over their shared rows."""
+    shared = ~np.isnan(x) & ~np.isnan(y)
+    if not shared.any():
+        return np.nan
+
+    dx = x[shared] - x[shared].mean()
+    dy = y[shared] - y[shared].mean()
+    divisor = np.sqrt(np.dot(dx, dx) * np.dot(dy, dy))
+
+    return np.dot(dx, dy) / divisor if divisor != 0 else np.nan
+
+
+def _correlation_sums(population_df, features, targets, block_size):
+    """Sum of absolute float64 correlations of the target features with all features."""
+    sums = np.zeros(len(targets))
+
+    for target_block in _column_blocks(len(targets), block_size):
+        X_target = population_df[[features[i] for i in targets[target_block]]]
+        X_target = X_target.to_numpy(dtype=np.float64)
+
+        for block in _column_blocks(len(features), block_size):
+            corr = _masked_correlation(
+                population_df[features[block]].to_numpy(dtype=np.float64), X_target
+            )
+            sums[target_block] += np.nansum(np.abs(corr), axis=0)
+
+    return sums
+
+
+def correlation_threshold(
+    population_df, features, threshold=0.9, block_size=256, tolerance=1e-4
+):
+    """
+    Find features correlated above a threshold, as `pycytominer`'s `correlation_threshold`.
+
+    For each pair of features with a (signed) Pearson correlation above
+    `threshold`, the feature with the larger sum of absolute correlations with
+    all features is excluded.
+
+    The correlation matrix is never materialized. Features without missing
+    values are standardized once into a float32 matrix, whose products with
+    column blocks give the correlations one block at a time; features with
+    missing values use pairwise-complete float64 correlations. Only the sums of
+    absolute correlations (accumulated in float64) and the pairs above
+    `threshold - tolerance` are kept. Pairs within `tolerance` of the threshold,
+    and pairs whose correlation sums may be reordered by float32 rounding, are
+    recomputed in float64.
+
+    Parameters:
+    - population_df: pandas.DataFrame, the profiles.
+    - features: list, the feature columns.
+    - threshold: float, the correlation above which one feature of a pair is excluded.
+    - block_size: int, the number of columns processed at a time.
+    - tolerance: float, the float32 error allowed on a correlation.
+
+    Returns:
+    - list, the excluded features.
+    """
+    n_features = len(features)
+    has_nan = np.zeros(n_features, dtype=bool)
+    for block in _column_blocks(n_features, block_size):
+        has_nan[block] = population_df[features[block]].isna().any().to_numpy()
+
+    complete = np.flatnonzero(~has_nan)
+    incomplete = np.flatnonzero(has_nan)
+
+    sums = np.zeros(n_features)
+    pair_a, pair_b, pair_corr = [], [], []
+
+    def add_pairs(rows, columns, corr):
+        # Keep each pair once, ordered as the lower triangle of the matrix
+        i, j = np.nonzero(corr > threshold - tolerance)
+        a, b = np.maximum(rows[i], columns[j]), np.minimum(rows[i], columns[j])
+        pair_a.append(a)
+        pair_b.append(b)
+        pair_corr.append(corr[i, j].astype(np.float64))
+
+    # Features without missing values: float32 blocks of the correlation matrix
+    Z = np.empty((len(population_df), len(complete)), dtype=np.float32)
+    for block in _column_blocks(len(complete), block_size):
+        X = population_df[[features[i] for i in complete[block]]]
+        Z[:, block] = _standardize(X.to_numpy(dtype=np.float64))
+
+    for block in _column_blocks(len(complete), block_size):
+        corr = Z.T @ Z[:, block]
+        sums[complete] += np.abs(corr).sum(axis=1, dtype=np.float64)
+
+        lower = complete[:, None] > complete[block][None, :]
+        add_pairs(complete, complete[block], np.where(lower, corr, np.nan))
+
+    del Z
+
+    # Features with missing values: pairwise-complete float64 correlations
+    for block in _column_blocks(len(incomplete), block_size):
+        X_block = population_df[[features[i] for i in incomplete[block]]]
+        X_block = X_block.to_numpy(dtype=np.float64)
+
+        for rows in _column_blocks(n_features, block_size):
+            row_features = np.arange(n_features)[rows]
+            corr = _masked_correlation(
+                population_df[features[rows]].to_numpy(dtype=np.float64), X_block
+            )
+            abs_corr = np.abs(corr)
+            sums[row_features] += np.nansum(abs_corr, axis=1)
+
+            # Sums of the incomplete features over the complete ones
+            sums[incomplete[block]] += np.nansum(abs_corr[~has_nan[rows]], axis=0)
+
+            # Pairs of two incomplete features are seen from both sides
+            seen = has_nan[row_features][:, None] & (
+                row_features[:, None] <= incomplete[block][None, :]
+            )
+            add_pairs(row_features, incomplete[block], np.where(seen, np.nan, corr))
+
+    pair_a = np.concatenate(pair_a)
+    pair_b = np.concatenate(pair_b)
+    pair_corr = np.concatenate(pair_corr)
+
+    # Recompute the correlations close to the threshold in float64
+    recheck = np.flatnonzero(pair_corr <= threshold + tolerance)
+    for k in recheck:
+        pair_corr[k] = _pair_correlation(
+            population_df[features[pair_a[k]]].to_numpy(dtype=np.float64),
+            population_df[features[pair_b[k]]].to_numpy(dtype=np.float64),
+        )
+
+    above = pair_corr > threshold
+    pair_a, pair_b = pair_a[above], pair_b[above]
+
+    if len(pair_a) == 0:
+        return []
+
+    # Recompute the sums that float32 rounding could reorder in float64
+    close = np.abs(sums[pair_a] - sums[pair_b]) <= tolerance * n_features
+    targets = np.union1d(pair_a[close], pair_b[close])
+    if len(targets) > 0:
+        sums[targets] = _correlation_sums(population_df, features, targets, block_size)
+
+    # The lower the rank, the less correlated to all features; exclude the higher
+    rank = np.empty(n_features, dtype=np.int64)
+    rank[np.argsort(sums)] = np.arange(n_features)
+    excluded = np.where(rank[pair_a] > rank[pair_b], pair_a, pair_b)
+
+    return [features[i] for i in np.unique(excluded)]
+
+
+@timed("feature_selection")
+def feature_select(
+    profiles,
+    features="infer",
+    image_features=False,
+    operation=FEATURE_SELECT_OPERATIONS,
+    freq_cut=0.05,
+    unique_cut=0.01,
+    corr_threshold=0.9,
+    block_size=256,
+):
+    """
+    Drop features with near-zero variance and highly correlated features.
+
+    Equivalent to `pycytominer.feature_select` with the same operations, but
+    without building the feature-by-feature correlation matrix. Operations are
+    applied in order, each on the features kept by the previous ones.
+
+    Parameters:
+    - profiles: pandas.DataFrame, the profiles.
+    - features: list or "infer", the feature columns.
+    - image_features: bool, whether inferred features include the Image features.
+    - operation: str or list, "variance_threshold" and/or "correlation_threshold".
+    - freq_cut: float, see `variance_threshold`.
+    - unique_cut: float, see `variance_threshold`.
+    - corr_threshold: float, see `correlation_threshold`.
+    - block_size: int, the number of columns processed at a time.
+
+    Returns:
+    - pandas.DataFrame, the profiles without the excluded features.
+    """
+    if isinstance(operation, str):
+        operation = [operation]
+
+    unknown = set(operation) - set(FEATURE_SELECT_OPERATIONS)
+    if unknown:
+        raise ValueError(
+            f"Unsupported operations {sorted(unknown)}, "
+            f"expected any of {FEATURE_SELECT_OPERATIONS}"
+        )
+
+    if features == "infer":
+        features = infer_features(profiles.columns, image_features=image_features)
+    features = list(features)
+
+    excluded_features = []
+    for op in operation:
+        if op == "variance_threshold":
+            exclude = variance_threshold(
+                profiles,
+                features,
+                freq_cut=freq_cut,
+                unique_cut=unique_cut,
+                block_size=block_size,
+            )
+        else:
+            exclude = correlation_threshold(
+                profiles, features, threshold=corr_threshold, block_size=block_size
+            )
+
+        excluded_features += exclude
+        exclude = set(exclude)
+        features = [x for x in features if x not in exclude]
+
+    return profiles.drop(columns=list(set(excluded_features)))
@@ -0,0 +1,215 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from data_management import ColumnIndex
+from instrumentation import timed
+from normalization import infer_features
+
+FEATURES_FILE = "features.npy"
+METADATA_FILE = "metadata.parquet"
+MANIFEST_FILE = "manifest.json"
+
+
+def default_store_dir(data_path):
+    """Return the feature store of a `combined.parquet` level, next to it."""
+    return os.path.join(os.path.dirname(os.path.abspath(data_path)), "feature_store")
+
+
+def _source_stamp(data_path):
+    stat = os.stat(data_path)
+    return {
+        "source": os.path.abspath(data_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+class FeatureStore:
+    """
+    Profiles of a data level, split into a memory-mapped feature matrix and a
+    small metadata frame.
+
+    The feature columns (Cells, Cytoplasm, Nuclei) are stored once as a
+    (n_rows, n_features) array, float32 by default, which every stage and
+    worker process memory-maps instead of converting the DataFrame again. All
+    the other columns are kept in `metadata`, whose rows match the matrix rows.
+    """
+
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+
+        self.store_dir = store_dir
+        self.feature_cols = manifest["feature_cols"]
+        self.features = np.load(os.path.join(store_dir, FEATURES_FILE), mmap_mode="r")
+        self.metadata = pd.read_parquet(os.path.join(store_dir, METADATA_FILE))
+        self.columns = ColumnIndex(self.feature_cols)
+        self._positions = {col: i for i, col in enumerate(self.feature_cols)}
+
+    def __len__(self):
+        return len(self.metadata)
+
+    @classmethod
+    def build(cls, data_path, store_dir=None, dtype=np.float32, batch_size=65536):
+        """
+        Build the feature store of a Parquet file, reading it in row batches.
+
+        Parameters:
+        - data_path: str, the Parquet file (e.g. `combined.parquet`).
+        - store_dir: str, the store directory (next to the file by default).
+        - dtype: numpy dtype of the feature matrix.
+        - batch_size: int, the number of rows read at a time.
+
+        Returns:
+        - FeatureStore
+        """
+        store_dir = store_dir or default_store_dir(data_path)
+        os.makedirs(store_dir, exist_ok=True)
+
+        parquet_file = pq.ParquetFile(data_path)
+        columns = parquet_file.schema_arrow.names
+        feature_cols = infer_features(columns)
+        feature_set = set(feature_cols)
+        metadata_cols = [col for col in columns if col not in feature_set]
+
+        # The manifest is written last and marks the store as complete
+        manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        features_path = os.path.join(store_dir, FEATURES_FILE)
+        tmp_path = f"{features_path}.{os.getpid()}.tmp.npy"
+        features = np.lib.format.open_memmap(
+            tmp_path,
+            mode="w+",
+            dtype=dtype,
+            shape=(parquet_file.metadata.num_rows, len(feature_cols)),
+        )
+
+        start = 0
+        for batch in parquet_file.iter_batches(
+            batch_size=batch_size, columns=feature_cols
+        ):
+            stop = start + batch.num_rows
+            for i, column in enumerate(batch.columns):
+                features[start:stop, i] = column.to_numpy(zero_copy_only=False)
+            start = stop
+
+        features.flush()
+        del features
+        os.replace(tmp_path, features_path)
+
+        pd.read_parquet(data_path, columns=metadata_cols).reset_index(
+            drop=True
+        ).to_parquet(os.path.join(store_dir, METADATA_FILE))
+
+        manifest = {
+            **_source_stamp(data_path),
+            "dtype": np.dtype(dtype).name,
+            "feature_cols": feature_cols,
+        }
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f)
+
+        return cls(store_dir)
+
+    @classmethod
+    @timed(
+        "loading.feature_store",
+        counts=lambda store: {
+            "n_rows": len(store),
+            "n_features": len(store.feature_cols),
+        },
+    )
+    def load(cls, data_path, store_dir=None, dtype=np.float32):
+        """
+        Open the feature store of a Parquet file, (re)building it if it is
+        missing or older than the file.
+        """
+        store_dir = store_dir or default_store_dir(data_path)
+        manifest_path = os.path.join(store_dir, MANIFEST_FILE)
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            stamp = {**_source_stamp(data_path), "dtype": np.dtype(dtype).name}
+            if all(manifest.get(key) == value for key, value in stamp.items()):
+                return cls(store_dir)
+
+        return cls.build(data_path, store_dir, dtype=dtype)
+
+    def column_positions(self, columns):
+        """Return the positions of feature columns in the matrix."""
+        return np.array([self._positions[col] for col in columns], dtype=np.int64)
+
+    def take(self, rows=None, columns=None):
+        """
+        Select rows and feature columns of the matrix.
+
+        Contiguous selections (including all rows or all columns) are views of
+        the memory map; other selections read only the requested cells.
+
+        Parameters:
+        - rows: array-like of row positions, or None for all rows.
+        - columns: list of feature columns, or None for all features.
+
+        Returns:
+        - numpy.ndarray, (n_rows, n_columns) features.
+        """
+        row_index = _as_index(rows)
+        col_index = _as_index(
+            None if columns is None else self.column_positions(columns)
+        )
+
+        if isinstance(row_index, slice) or isinstance(col_index, slice):
+            return self.features[row_index, col_index]
+
+        return self.features[np.ix_(row_index, col_index)]
+
+    def frame(self, rows=None, columns=None, metadata_cols=None):
+        """
+        Build a DataFrame of metadata and feature columns.
+
+        Parameters:
+        - rows: array-like of row positions, or None for all rows.
+        - columns: list of feature columns, or None for all features.
+        - metadata_cols: list of metadata columns, or None for all of them.
+
+        Returns:
+        - pandas.DataFrame, the metadata columns followed by the feature columns.
+        """
+        columns = self.feature_cols if columns is None else list(columns)
+        metadata = (
+            self.metadata if metadata_cols is None else self.metadata[metadata_cols]
+        )
+        if rows is not None:
+            metadata = metadata.iloc[np.asarray(rows)]
+
+        features = pd.DataFrame(
+            self.take(rows, columns),
+            columns=columns,
+            index=metadata.index,
+            copy=False,
+        )
+        return pd.concat([metadata, features], axis=1)
+
+
+def _as_index(positions):
+    """Turn positions into a slice when they are a contiguous increasing range."""
+    if positions is None:
+        return slice(None)
+
+    positions = np.asarray(positions)
+    if positions.dtype == bool:
+        positions = np.flatnonzero(positions)
+
+    if len(positions) and np.array_equal(
+        positions, np.arange(positions[0], positions[0] + len(positions))
+    ):
+        return slice(positions[0], positions[0] + len(positions))
+
+    return positions
@@ -0,0 +1,210 @@
+"""
+Lightweight timing and memory instrumentation of the pipeline stages.
+
+Stages are recorded while a run report is active:
+
+    with run_report("analysis", "output/reports/analysis.json"):
+        run_analysis(data_level)
+
+Outside of a run report, `stage` and `timed` cost a couple of clock reads.
+Stages run in worker processes are not recorded; the stage wrapping the
+pool in the parent process covers them.
+"""
+
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+# Active run report and the names of the open stages
+_report = None
+_stack = []
+
+
+def peak_rss_mb():
+    """Return the high-water mark of the process resident memory, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+class RunReport:
+    """
+    The stage records of one run.
+
+    Each record holds the stage name, its parent stage, start offset, wall
+    and CPU time, the resident memory high-water mark at its end and how much
+    the stage raised it, and the row, column or feature counts and other
+    details given to `stage` or derived by `timed`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.perf_start = time.perf_counter()
+        self.records = []
+
+    def to_frame(self):
+        """Return the stage records as a DataFrame, in the order stages ended."""
+        return pd.DataFrame(self.records)
+
+    def save(self, path):
+        """Save the report as JSON or, for a `.parquet` path, Parquet."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        if path.endswith(".parquet"):
+            self.to_frame().assign(run=self.name).to_parquet(path)
+            return
+
+        with open(path, "w") as f:
+            json.dump(
+                {"run": self.name, "started": self.started, "stages": self.records},
+                f,
+                indent=2,
+                default=str,
+            )
+
+
+@contextmanager
+def stage(name, n_rows=None, n_features=None, **details):
+    """
+    Time a pipeline stage and record it in the active run report.
+
+    Parameters:
+    - name: str, the stage name.
+    - n_rows: int, the number of rows the stage processes.
+    - n_features: int, the number of features the stage processes.
+    - **details: other JSON-serializable details of the stage.
+
+    Yields:
+    - dict, the stage record; counts known only inside the stage can be set on it.
+    """
+    record = {
+        "stage": name,
+        "parent": _stack[-1] if _stack else None,
+        "n_rows": n_rows,
+        "n_features": n_features,
+        **details,
+    }
+    if _report is None:
+        yield record
+        return
+
+    _stack.append(name)
+    start_rss = peak_rss_mb()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        wall_time = time.perf_counter() - start
+        _stack.pop()
+        record.update(
+            start_s=start - _report.perf_start,
+            wall_time_s=wall_time,
+            cpu_time_s=time.process_time() - start_cpu,
+            peak_rss_mb=peak_rss_mb(),
+            peak_rss_increase_mb=peak_rss_mb() - start_rss,
+        )
+        _report.records.append(record)
+
+
+def shape_counts(result):
+    """Count the rows and columns of a 2-D result (DataFrame or array)."""
+    shape = getattr(result, "shape", None)
+    if shape is None or len(shape) != 2:
+        return {}
+    return {"n_rows": shape[0], "n_columns": shape[1]}
+
+
+def timed(name=None, counts=shape_counts):
+    """
+    Decorate a function so that each call is recorded as a stage.
+
+    Parameters:
+    - name: str, the stage name (the function name by default).
+    - counts: callable, returns a dict of counts of the function result that
+      is added to the stage record.
+    """
+
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name) as record:
+                result = func(*args, **kwargs)
+                record.update(counts(result))
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def run_report(name, path=None, profile=None):
+    """
+    Record the stages run inside the block.
+
+    Parameters:
+    - name: str, the run name.
+    - path: str, the report file (`.json` or `.parquet`), or None to only
+      return the report.
+    - profile: None, "cprofile" or "pyinstrument", a profiler to run over
+      the block. Its output is saved next to the report (`.prof` statistics
+      or `.html`).
+
+    Yields:
+    - RunReport, the report being recorded.
+    """
+    global _report
+
+    if _report is not None:
+        raise RuntimeError(f"Run report {_report.name!r} is already active.")
+
+    profiler = None
+    if profile == "cprofile":
+        profiler = cProfile.Profile()
+    elif profile == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError as e:
+            raise ImportError(
+                "pyinstrument is required for profile='pyinstrument'."
+            ) from e
+        profiler = Profiler()
+    elif profile is not None:
+        raise ValueError(f"Unknown profiler {profile!r}.")
+
+    report = RunReport(name)
+    _report = report
+    if profile == "cprofile":
+        profiler.enable()
+    elif profile == "pyinstrument":
+        profiler.start()
+
+    try:
+        with stage(name):
+            yield report
+    finally:
+        if profile == "cprofile":
+            profiler.disable()
+        elif profile == "pyinstrument":
+            profiler.stop()
+        _report = None
+
+        if path is not None:
+            report.save(path)
+            base = os.path.splitext(path)[0]
+            if profile == "cprofile":
+                profiler.dump_stats(f"{base}.prof")
+            elif profile == "pyinstrument":
+                with open(f"{base}.html", "w") as f:
+                    f.write(profiler.output_html())
@@ -1,17 +1,295 @@
 # See https://github.com/cytomining/copairs/issues/36 for details on why this file is needed
 
-import itertools
 import logging
 
 import numpy as np
 import pandas as pd
 
 from copairs import compute
-from copairs.map import create_matcher, build_rank_lists
+from copairs.map import aggregate
+
+from instrumentation import stage
+from null_distributions import DEFAULT_NULL_CACHE_DIR, p_values
 
 logger = logging.getLogger("copairs")
 
 
+def encode_columns(meta, columns):
+    """
+    Encode metadata columns as integer codes.
+
+    Parameters:
+    - meta: pandas.DataFrame, the metadata.
+    - columns: str or list, the columns to encode.
+
+    Returns:
+    - numpy.ndarray, (n_rows, n_columns) int64 codes; -1 marks missing values.
+    """
+    if isinstance(columns, str):
+        columns = [columns]
+
+    codes = np.empty((len(meta), len(columns)), dtype=np.int64)
+    for i, col in enumerate(columns):
+        codes[:, i] = pd.factorize(meta[col])[0]
+
+    return codes
+
+
+def _as_list(columns):
+    return [columns] if isinstance(columns, str) else list(columns)
+
+
+def pair_mask(same_codes, diff_codes, queries, candidates):
+    """
+    Flag the (query, candidate) pairs matching `sameby` and `diffby`.
+
+    Parameters:
+    - same_codes: numpy.ndarray, codes of the `sameby` columns (see `encode_columns`).
+    - diff_codes: numpy.ndarray, codes of the `diffby` columns.
+    - queries: numpy.ndarray, row positions of the queries.
+    - candidates: numpy.ndarray, row positions of the candidates.
+
+    Returns:
+    - numpy.ndarray, (n_queries, n_candidates) boolean mask, False for a row
+      paired with itself.
+    """
+    mask = queries[:, None] != candidates[None, :]
+
+    for col in range(same_codes.shape[1]):
+        a = same_codes[queries, col][:, None]
+        b = same_codes[candidates, col][None, :]
+        mask &= (a == b) & (a >= 0)
+
+    for col in range(diff_codes.shape[1]):
+        a = diff_codes[queries, col][:, None]
+        b = diff_codes[candidates, col][None, :]
+        mask &= (a != b) | (a < 0) | (b < 0)
+
+    return mask
+
+
+def iter_similarity_blocks(meta, feats, shared_sameby, block_size=256):
+    """
+    Compute cosine similarities between query blocks and their candidate rows.
+
+    Rows can only pair with rows sharing their `shared_sameby` values, so rows
+    are grouped by these columns and each block of queries is compared to its
+    group only. Features are L2-normalized once and the similarities of a block
+    are a single matrix product, rounded to float32 as `compute.pairwise_cosine`.
+
+    Parameters:
+    - meta: pandas.DataFrame, the metadata, with a default index.
+    - feats: numpy.ndarray, (n_rows, n_features) features.
+    - shared_sameby: list, the `sameby` columns common to all pair definitions.
+    - block_size: int, the number of queries per block.
+
+    Yields:
+    - queries: numpy.ndarray, row positions of the queries.
+    - candidates: numpy.ndarray, row positions of the candidates.
+    - sims: numpy.ndarray, (n_queries, n_candidates) float32 similarities.
+    """
+    feats = np.asarray(feats)
+    feats = feats.astype(np.result_type(feats.dtype, np.float32), copy=False)
+    feats = feats / np.linalg.norm(feats, axis=1, keepdims=True)
+
+    same_codes = encode_columns(meta, shared_sameby)
+    valid = np.flatnonzero((same_codes >= 0).all(axis=1))
+    _, groups = np.unique(same_codes[valid], axis=0, return_inverse=True)
+    groups = groups.ravel()
+
+    order = valid[np.argsort(groups, kind="stable")]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(groups))])
+
+    for group in range(len(offsets) - 1):
+        candidates = order[offsets[group] : offsets[group + 1]]
+        candidate_feats = feats[candidates]
+
+        for start in range(0, len(candidates), block_size):
+            queries = candidates[start : start + block_size]
+            sims = feats[queries] @ candidate_feats.T
+            yield queries, candidates, sims.astype(np.float32, copy=False)
+
+
+def rank_block(sims):
+    """
+    Sort the candidates of each query of a similarity block by decreasing
+    similarity, once for all the pair specifications.
+
+    Returns:
+    - order: numpy.ndarray, the candidate order of each query.
+    - run: numpy.ndarray, the index of each sorted candidate's run of tied similarities.
+    """
+    # Rank on 1 - similarity in float32, as `copairs.map.build_rank_lists`
+    keys = 1 - sims
+    order = np.argsort(keys, axis=1, kind="stable")
+    keys = np.take_along_axis(keys, order, axis=1)
+
+    run = np.zeros(sims.shape, dtype=np.int64)
+    run[:, 1:] = np.cumsum(keys[:, 1:] != keys[:, :-1], axis=1)
+
+    return order, run
+
+
+def block_average_precision(sims, pos_mask, neg_mask, ranking=None):
+    """
+    Compute the average precision of each query of a similarity block.
+
+    The positive and negative candidates of each query are ranked by decreasing
+    similarity, positives first on ties, as `copairs.map.build_rank_lists`.
+
+    Parameters:
+    - sims: numpy.ndarray, (n_queries, n_candidates) float32 similarities.
+    - pos_mask: numpy.ndarray, boolean mask of the positive pairs.
+    - neg_mask: numpy.ndarray, boolean mask of the negative pairs.
+    - ranking: tuple, the output of `rank_block(sims)`, to share across calls.
+
+    Returns:
+    - paired: numpy.ndarray, boolean mask of the queries with at least one pair.
+    - ap_scores: numpy.ndarray, the average precision of the paired queries.
+    - null_confs: numpy.ndarray, (n_paired, 2) number of positive and total pairs.
+    """
+    if ranking is None or (pos_mask & neg_mask).any():
+        # Pairs both positive and negative are ranked twice, as in copairs
+        pos_query, pos_candidate = np.nonzero(pos_mask)
+        neg_query, neg_candidate = np.nonzero(neg_mask)
+
+        query = np.concatenate([pos_query, neg_query])
+        sim_all = np.concatenate(
+            [sims[pos_query, pos_candidate], sims[neg_query, neg_candidate]]
+        )
+        labels = np.concatenate(
+            [
+                np.ones(len(pos_query), dtype=np.int32),
+                np.zeros(len(neg_query), dtype=np.int32),
+            ]
+        )
+
+        ix_sort = np.lexsort([1 - labels, 1 - sim_all, query])
+        rel_k_list = labels[ix_sort]
+    else:
+        order, run = ranking
+        pos_sorted = np.take_along_axis(pos_mask, order, axis=1)
+        paired_sorted = pos_sorted | np.take_along_axis(neg_mask, order, axis=1)
+
+        query, position = np.nonzero(paired_sorted)
+        rel_k_list = pos_sorted[query, position].astype(np.int32)
+
+        # Move positives before negatives with the same similarity
+        run = run[query, position]
+        tied = (query[1:] == query[:-1]) & (run[1:] == run[:-1])
+        if (tied & (rel_k_list[1:] > rel_k_list[:-1])).any():
+            rel_k_list = rel_k_list[np.lexsort([1 - rel_k_list, run, query])]
+
+    counts = np.bincount(query, minlength=sims.shape[0])
+    paired = counts > 0
+    if not paired.any():
+        return paired, np.empty(0), np.empty((0, 2), dtype=np.int64)
+
+    ap_scores, null_confs = compute.compute_ap_contiguos(rel_k_list, counts[paired])
+
+    return paired, ap_scores, null_confs
+
+
+PAIR_SPEC_KEYS = ("pos_sameby", "pos_diffby", "neg_sameby", "neg_diffby")
+
+
+def _spec_codes(meta, spec):
+    """Encode the columns of a pair specification."""
+    spec = {key: _as_list(spec[key]) for key in PAIR_SPEC_KEYS}
+    if not (spec["pos_sameby"] or spec["pos_diffby"]) or not (
+        spec["neg_sameby"] or spec["neg_diffby"]
+    ):
+        raise ValueError("sameby, diffby: at least one should be provided")
+
+    pos_codes = (
+        encode_columns(meta, spec["pos_sameby"]),
+        encode_columns(meta, spec["pos_diffby"]),
+    )
+    neg_codes = (
+        encode_columns(meta, spec["neg_sameby"]),
+        encode_columns(meta, spec["neg_diffby"]),
+    )
+    return pos_codes, neg_codes
+
+
+def streaming_average_precision_specs(meta, feats, specs, block_size=256):
+    """
+    Compute the average precision of every row for several pair specifications,
+    computing each similarity block once.
+
+    Parameters:
+    - meta: pandas.DataFrame, the metadata, with a default index.
+    - feats: numpy.ndarray, (n_rows, n_features) features.
+    - specs: list of dicts with the keys `pos_sameby`, `pos_diffby`,
+      `neg_sameby` and `neg_diffby`.
+    - block_size: int, the number of queries per similarity block.
+
+    Returns:
+    - list of (ap_scores, null_confs) tuples, one per specification (see
+      `streaming_average_precision`).
+    """
+    codes = [_spec_codes(meta, spec) for spec in specs]
+
+    # Rows pair only with rows sharing the sameby columns of every definition
+    shared_sameby = [
+        col
+        for col in _as_list(specs[0]["pos_sameby"])
+        if all(
+            col in _as_list(spec[key])
+            for spec in specs
+            for key in ("pos_sameby", "neg_sameby")
+        )
+    ]
+
+    results = [
+        (np.full(len(meta), np.nan), np.zeros((len(meta), 2), dtype=np.int64))
+        for _ in specs
+    ]
+
+    for queries, candidates, sims in iter_similarity_blocks(
+        meta, feats, shared_sameby, block_size
+    ):
+        ranking = rank_block(sims)
+
+        for (pos_codes, neg_codes), (ap_scores, null_confs) in zip(codes, results):
+            paired, block_ap, block_confs = block_average_precision(
+                sims,
+                pair_mask(*pos_codes, queries, candidates),
+                pair_mask(*neg_codes, queries, candidates),
+                ranking,
+            )
+            ap_scores[queries[paired]] = block_ap
+            null_confs[queries[paired]] = block_confs
+
+    return results
+
+
+def streaming_average_precision(
+    meta, feats, pos_sameby, pos_diffby, neg_sameby, neg_diffby, block_size=256
+):
+    """
+    Compute the average precision of every row without materializing the pairs.
+
+    Parameters:
+    - meta: pandas.DataFrame, the metadata, with a default index.
+    - feats: numpy.ndarray, (n_rows, n_features) features.
+    - pos_sameby, pos_diffby: str or list, the definition of positive pairs.
+    - neg_sameby, neg_diffby: str or list, the definition of negative pairs.
+    - block_size: int, the number of queries per similarity block.
+
+    Returns:
+    - ap_scores: numpy.ndarray, the average precision of each row (NaN if unpaired).
+    - null_confs: numpy.ndarray, (n_rows, 2) number of positive and total pairs.
+    """
+    spec = dict(
+        pos_sameby=pos_sameby,
+        pos_diffby=pos_diffby,
+        neg_sameby=neg_sameby,
+        neg_diffby=neg_diffby,
+    )
+    return streaming_average_precision_specs(meta, feats, [spec], block_size)[0]
+
+
 def my_run_pipeline(
     meta,
     feats,
@@ -20,51 +298,106 @@ def my_run_pipeline(
     neg_sameby,
     neg_diffby,
     null_size,
-    batch_size=20000,
+    block_size=256,
     seed=0,
+    null_cache_dir=DEFAULT_NULL_CACHE_DIR,
+    n_jobs=1,
 ) -> pd.DataFrame:
     # Critical!, otherwise the indexing wont work
     meta = meta.reset_index(drop=True).copy()
-    logger.info("Indexing metadata...")
-    matcher = create_matcher(meta, pos_sameby, pos_diffby, neg_sameby, neg_diffby)
-
-    logger.info("Finding positive pairs...")
-    pos_pairs = matcher.get_all_pairs(sameby=pos_sameby, diffby=pos_diffby)
-    pos_total = sum(len(p) for p in pos_pairs.values())
-    pos_pairs = np.fromiter(
-        itertools.chain.from_iterable(pos_pairs.values()),
-        dtype=np.dtype((np.int32, 2)),
-        count=pos_total,
-    )
-
-    logger.info("Finding negative pairs...")
-    neg_pairs = matcher.get_all_pairs(sameby=neg_sameby, diffby=neg_diffby)
-    total_neg = sum(len(p) for p in neg_pairs.values())
-    neg_pairs = np.fromiter(
-        itertools.chain.from_iterable(neg_pairs.values()),
-        dtype=np.dtype((np.int32, 2)),
-        count=total_neg,
-    )
-
-    logger.info("Computing positive similarities...")
-    pos_dists = compute.pairwise_cosine(feats, pos_pairs, batch_size)
-
-    logger.info("Computing negative similarities...")
-    neg_dists = compute.pairwise_cosine(feats, neg_pairs, batch_size)
-
-    logger.info("Building rank lists...")
-    rel_k_list, counts = build_rank_lists(pos_pairs, neg_pairs, pos_dists, neg_dists)
+    counts = {"n_rows": len(meta), "n_features": feats.shape[1]}
 
     logger.info("Computing average precision...")
-    ap_scores, null_confs = compute.compute_ap_contiguos(rel_k_list, counts)
+    with stage("map.average_precision", **counts):
+        ap_scores, null_confs = streaming_average_precision(
+            meta, feats, pos_sameby, pos_diffby, neg_sameby, neg_diffby, block_size
+        )
 
     logger.info("Computing p-values...")
-    p_values = compute.compute_p_values(ap_scores, null_confs, null_size, seed=seed)
+    with stage("map.p_values", null_size=null_size, **counts):
+        pvals = p_values(
+            ap_scores,
+            null_confs,
+            null_size,
+            seed=seed,
+            cache_dir=null_cache_dir,
+            n_jobs=n_jobs,
+        )
 
     logger.info("Creating result DataFrame...")
     meta["average_precision"] = ap_scores
-    meta["p_value"] = p_values
+    meta["p_value"] = pvals
     meta["n_pos_pairs"] = null_confs[:, 0]
     meta["n_neg_pairs"] = null_confs[:, 1]
     logger.info("Finished.")
     return meta
+
+
+def my_run_pipelines(
+    meta,
+    feats,
+    specs,
+    null_size,
+    threshold=0.05,
+    block_size=256,
+    seed=0,
+    null_cache_dir=DEFAULT_NULL_CACHE_DIR,
+    n_jobs=1,
+):
+    """
+    Run `my_run_pipeline` for several pair specifications of the same profiles.
+
+    The similarities are computed once for all specifications, and the null
+    distributions of all their configurations are generated together.
+
+    Parameters:
+    - meta: pandas.DataFrame, the metadata.
+    - feats: numpy.ndarray, (n_rows, n_features) features.
+    - specs: dict mapping a name to a dict with the keys `pos_sameby`,
+      `pos_diffby`, `neg_sameby`, `neg_diffby`, and optionally `agg_sameby`
+      (the columns to aggregate the scores by, `pos_sameby` by default).
+    - null_size: int, the number of samples of each null distribution.
+    - threshold: float, the p-value threshold of `copairs.map.aggregate`.
+    - block_size, seed, null_cache_dir, n_jobs: see `my_run_pipeline`.
+
+    Returns:
+    - results: dict mapping each name to its `my_run_pipeline` result.
+    - aggregated: dict mapping each name to its `copairs.map.aggregate` result.
+    """
+    # Critical!, otherwise the indexing wont work
+    meta = meta.reset_index(drop=True).copy()
+    names = list(specs)
+    counts = {"n_rows": len(meta), "n_features": feats.shape[1], "n_specs": len(names)}
+
+    logger.info("Computing average precision...")
+    with stage("map.average_precision", **counts):
+        scores = streaming_average_precision_specs(
+            meta, feats, [specs[name] for name in names], block_size
+        )
+
+    logger.info("Computing p-values...")
+    with stage("map.p_values", null_size=null_size, **counts):
+        pvals = p_values(
+            np.concatenate([ap_scores for ap_scores, _ in scores]),
+            np.concatenate([null_confs for _, null_confs in scores]),
+            null_size,
+            seed=seed,
+            cache_dir=null_cache_dir,
+            n_jobs=n_jobs,
+        )
+
+    logger.info("Creating result DataFrames...")
+    results, aggregated = {}, {}
+    for i, (name, (ap_scores, null_confs)) in enumerate(zip(names, scores)):
+        result = meta.copy()
+        result["average_precision"] = ap_scores
+        result["p_value"] = pvals[i * len(meta) : (i + 1) * len(meta)]
+        result["n_pos_pairs"] = null_confs[:, 0]
+        result["n_neg_pairs"] = null_confs[:, 1]
+        results[name] = result
+
+        agg_sameby = specs[name].get("agg_sameby", specs[name]["pos_sameby"])
+        aggregated[name] = aggregate(result, agg_sameby, threshold=threshold)
+
+    logger.info("Finished.")
+    return results, aggregated
@@ -0,0 +1,146 @@
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from data_management import ColumnIndex
+from instrumentation import timed
+
+# Compartments whose measurements are profile features, as in pycytominer
+COMPARTMENTS = ("Cells", "Nuclei", "Cytoplasm")
+
+# Consistency constant of the MAD for normally distributed data
+MAD_SCALE = 1.4826
+
+
+def infer_features(columns, image_features=False):
+    """
+    Infer the feature columns of a profile, following `pycytominer.cyto_utils.infer_cp_features`.
+
+    Parameters:
+    - columns: list or ColumnIndex, the column names of the profile.
+    - image_features: bool, whether to include the Image features.
+
+    Returns:
+    - list, the feature columns in their original order.
+    """
+    if not isinstance(columns, ColumnIndex):
+        columns = ColumnIndex(columns)
+
+    compartments = COMPARTMENTS + ("Image",) if image_features else COMPARTMENTS
+    features = columns.prefix(compartments)
+
+    assert len(features) > 0, (
+        "No CP features found. Are you sure this dataframe is from CellProfiler?"
+    )
+
+    return features
+
+
+def group_offsets(keys):
+    """
+    Sort rows by group so that each group occupies a contiguous range.
+
+    Rows with a missing key are dropped, as in `DataFrame.groupby`.
+
+    Parameters:
+    - keys: array-like, the group key of each row.
+
+    Returns:
+    - order: numpy.ndarray, the row positions sorted by group (stable within a group).
+    - offsets: numpy.ndarray, the start of each group in `order`, followed by the number of rows.
+    - groups: pandas.Index, the sorted group keys.
+    """
+    codes, groups = pd.factorize(keys, sort=True)
+    order = np.argsort(codes, kind="stable")
+    order = order[codes[order] >= 0]
+
+    counts = np.bincount(codes[order], minlength=len(groups))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    return order, offsets, groups
+
+
+def robust_mad(X, epsilon=1e-18):
+    """
+    Robustize the columns of a block by their median and MAD, as `pycytominer`'s `RobustMAD`.
+
+    Parameters:
+    - X: numpy.ndarray, float64 (n_samples, n_features) block.
+    - epsilon: float, added to the MAD to avoid division by zero.
+
+    Returns:
+    - numpy.ndarray, the robustized block.
+    """
+    with warnings.catch_warnings():
+        # All-NaN columns stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        median = np.nanmedian(X, axis=0)
+        mad = np.nanmedian(np.abs(X - median), axis=0) / (1 / MAD_SCALE)
+
+    return (X - median) / (mad + epsilon)
+
+
+@timed("normalization")
+def mad_robustize_by_group(
+    df,
+    group_col="Metadata_Plate",
+    features="infer",
+    meta_features="infer",
+    image_features=False,
+    epsilon=1e-18,
+    dtype=np.float32,
+    n_jobs=1,
+):
+    """
+    Normalize the features of each group by its median and MAD.
+
+    Equivalent to `apply_function_to_groups(df, group_col, pycytominer.normalize,
+    method="mad_robustize", samples="all", ...)`, but sorts the rows by group once
+    and writes every group into its slice of a single preallocated block instead
+    of concatenating per-group copies.
+
+    Parameters:
+    - df: pandas.DataFrame, the profiles.
+    - group_col: str, the column to group by.
+    - features: list or "infer", the feature columns.
+    - meta_features: list or "infer", the metadata columns to keep.
+    - image_features: bool, whether inferred features include the Image features.
+    - epsilon: float, added to the MAD to avoid division by zero.
+    - dtype: numpy dtype of the normalized features.
+    - n_jobs: int, number of threads normalizing groups concurrently.
+
+    Returns:
+    - pandas.DataFrame, the metadata and normalized features with rows ordered by group.
+    """
+    index = ColumnIndex(df.columns)
+
+    if features == "infer":
+        features = infer_features(index, image_features=image_features)
+    if meta_features == "infer":
+        meta_features = index.prefix("Metadata_")
+
+    order, offsets, _ = group_offsets(df[group_col].to_numpy())
+
+    values = df[features].to_numpy(dtype=np.float64)
+    normalized = np.empty((len(order), len(features)), dtype=dtype)
+
+    def normalize_group(group):
+        rows = order[offsets[group] : offsets[group + 1]]
+        normalized[offsets[group] : offsets[group + 1]] = robust_mad(
+            values[rows], epsilon=epsilon
+        )
+
+    groups = range(len(offsets) - 1)
+    if n_jobs == 1:
+        for group in groups:
+            normalize_group(group)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(normalize_group, groups))
+
+    meta_df = df[meta_features].iloc[order].reset_index(drop=True)
+    feature_df = pd.DataFrame(normalized, columns=features, copy=False)
+
+    return pd.concat([meta_df, feature_df], axis=1)
@@ -0,0 +1,207 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Sorted null AP distributions, one file per configuration
+DEFAULT_NULL_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "ncp", "null_distributions"
+)
+
+# Maximum number of random ranks drawn at once when sampling a null distribution
+_MAX_SAMPLE_BLOCK = 1 << 22
+
+
+def configuration_seed(seed, n_pos, total):
+    """
+    Derive the seed of a configuration's null distribution.
+
+    The seed depends only on the configuration, so a cached null distribution
+    is the same whichever run generated it.
+    """
+    return np.random.default_rng([seed, n_pos, total]).integers(2**63)
+
+
+def random_average_precision(n_pos, total, null_size, seed):
+    """
+    Sample the average precision of rankings with random positive positions.
+
+    Parameters:
+    - n_pos: int, the number of positive pairs.
+    - total: int, the total number of pairs.
+    - null_size: int, the number of samples.
+    - seed: int, the random seed.
+
+    Returns:
+    - numpy.ndarray, the sorted float32 samples.
+    """
+    rng = np.random.default_rng(seed)
+    null = np.empty(null_size, dtype=np.float32)
+    precision_rank = np.arange(1, n_pos + 1)
+
+    block = max(1, _MAX_SAMPLE_BLOCK // total)
+    for start in range(0, null_size, block):
+        size = min(block, null_size - start)
+
+        # 1-based ranks of the positives in random rankings
+        ranks = rng.random((size, total)).argpartition(n_pos - 1, axis=1)[:, :n_pos]
+        ranks = np.sort(ranks, axis=1) + 1
+
+        null[start : start + size] = (precision_rank / ranks).mean(axis=1)
+
+    null.sort()
+    return null
+
+
+def null_cache_path(cache_dir, n_pos, total, null_size, seed):
+    """Return the cache file of a configuration's null distribution."""
+    return os.path.join(cache_dir, f"seed{seed}_ns{null_size}_k{n_pos}_n{total}.npy")
+
+
+def _generate_null(n_pos, total, null_size, seed, path=None):
+    null = random_average_precision(
+        n_pos, total, null_size, configuration_seed(seed, n_pos, total)
+    )
+
+    if path is not None:
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, null)
+        os.replace(tmp_path, path)
+
+    return null
+
+
+def evict_null_cache(cache_dir, max_bytes, keep=()):
+    """
+    Delete the least recently used null distributions until the cache fits in `max_bytes`.
+
+    Files in `keep` are never deleted.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npy") and entry.path not in keep:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    size = sum(os.path.getsize(path) for path in keep if os.path.exists(path)) + sum(
+        entry_size for _, entry_size, _ in entries
+    )
+
+    for _, entry_size, path in sorted(entries):
+        if size <= max_bytes:
+            break
+        os.remove(path)
+        size -= entry_size
+
+
+def null_distributions(
+    confs,
+    null_size,
+    seed=0,
+    cache_dir=DEFAULT_NULL_CACHE_DIR,
+    max_cache_bytes=1 << 30,
+    n_jobs=1,
+):
+    """
+    Get the null distributions of (n_pos, total) configurations.
+
+    Distributions are read from `cache_dir` when available; missing ones are
+    generated in parallel and cached. Reading a distribution marks it as
+    recently used, and the least recently used ones are evicted when the cache
+    exceeds `max_cache_bytes`.
+
+    Parameters:
+    - confs: numpy.ndarray, (n_confs, 2) number of positive and total pairs.
+    - null_size: int, the number of samples of each distribution.
+    - seed: int, the random seed.
+    - cache_dir: str or None, the cache directory (None disables the cache).
+    - max_cache_bytes: int, the maximum size of the cache.
+    - n_jobs: int, number of processes generating missing distributions.
+
+    Returns:
+    - numpy.ndarray, (n_confs, null_size) sorted float32 null distributions.
+    """
+    confs = [(int(n_pos), int(total)) for n_pos, total in confs]
+    paths = [None] * len(confs)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        paths = [null_cache_path(cache_dir, *conf, null_size, seed) for conf in confs]
+
+    nulls = np.empty((len(confs), null_size), dtype=np.float32)
+    missing = []
+    for i, path in enumerate(paths):
+        if path is not None and os.path.exists(path):
+            nulls[i] = np.load(path)
+            os.utime(path)
+        else:
+            missing.append(i)
+
+    if n_jobs == 1:
+        for i in missing:
+            nulls[i] = _generate_null(*confs[i], null_size, seed, paths[i])
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {
+                i: executor.submit(_generate_null, *confs[i], null_size, seed, paths[i])
+                for i in missing
+            }
+            for i, future in futures.items():
+                nulls[i] = future.result()
+
+    if cache_dir is not None and missing:
+        evict_null_cache(cache_dir, max_cache_bytes, keep=set(paths))
+
+    return nulls
+
+
+def p_values(
+    ap_scores,
+    null_confs,
+    null_size,
+    seed=0,
+    cache_dir=DEFAULT_NULL_CACHE_DIR,
+    max_cache_bytes=1 << 30,
+    n_jobs=1,
+):
+    """
+    Compute the p-values of average precision scores against cached null distributions.
+
+    Same as `copairs.compute.compute_p_values`, except that each configuration
+    is sampled from its own seed (see `configuration_seed`) so that its null
+    distribution can be reused across runs.
+
+    Parameters:
+    - ap_scores: numpy.ndarray, the average precision scores.
+    - null_confs: numpy.ndarray, (n, 2) number of positive and total pairs of each score.
+    - null_size: int, the number of samples of each null distribution.
+    - seed: int, the random seed.
+    - cache_dir, max_cache_bytes, n_jobs: see `null_distributions`.
+
+    Returns:
+    - numpy.ndarray, the float64 p-values (NaN without positive pairs).
+    """
+    null_confs = np.asarray(null_confs)
+    pvals = np.full(len(ap_scores), np.nan, dtype=np.float64)
+
+    has_pos = null_confs[:, 0] > 0
+    if not has_pos.any():
+        return pvals
+
+    confs, rev_ix = np.unique(null_confs[has_pos], axis=0, return_inverse=True)
+    nulls = null_distributions(
+        confs, null_size, seed, cache_dir, max_cache_bytes, n_jobs=n_jobs
+    )
+
+    # Rows of each configuration
+    rev_ix = rev_ix.ravel()
+    rows = np.flatnonzero(has_pos)[np.argsort(rev_ix, kind="stable")]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(rev_ix))])
+
+    for ix in range(len(confs)):
+        conf_rows = rows[offsets[ix] : offsets[ix + 1]]
+        # Reverse to get from hi to low
+        num = null_size - np.searchsorted(nulls[ix], ap_scores[conf_rows])
+        pvals[conf_rows] = (num + 1) / (null_size + 1)
+
+    return pvals
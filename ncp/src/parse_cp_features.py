@@ -1,3 +1,23 @@
+import json
+import os
+from functools import lru_cache
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+FEATURE_CATALOG_COLUMNS = [
+    "feature",
+    "compartment",
+    "feature_group",
+    "feature_type",
+    "channel",
+]
+
+# Parquet metadata key of the channels a saved catalog was parsed with
+CATALOG_CHANNELS_METADATA_KEY = b"ncp_feature_catalog_channels"
+
+
 def parse_cp_features(
     feature: str, channels: list = ["DNA", "RNA", "AGP", "Mito", "ER", "mito_tubeness"]
 ):
@@ -27,6 +47,15 @@ def parse_cp_features(
     if not isinstance(channels, list):
         raise ValueError(f"Expected a list, got {type(channels).__name__}")
 
+    # Return a copy so callers cannot alter the cached result
+    return dict(_parse_cp_features_cached(feature, tuple(channels)))
+
+
+# Bounded to about the number of features of a profile
+@lru_cache(maxsize=4096)
+def _parse_cp_features_cached(feature: str, channels: tuple):
+    """Cached implementation of `parse_cp_features`, keyed by feature and channels."""
+
     def channel_standardizer(channel):
         channel = channel.replace("Orig", "")
         return channel
@@ -113,3 +142,83 @@ def parse_cp_features(
         "feature_type": feature_type,
         "channel": channel,
     }
+
+
+def parse_cp_feature_catalog(
+    features, channels: list = ["DNA", "RNA", "AGP", "Mito", "ER", "mito_tubeness"]
+):
+    """Parses a collection of CellProfiler feature strings into a catalog.
+    Every distinct feature is parsed once through the cached parser, so repeated
+    calls over the same columns only cost dictionary lookups.
+    Parameters
+    ----------
+    features : iterable of str
+        The CellProfiler feature strings to parse, e.g. a DataFrame column index.
+    channels : list, optional
+        A list of channel names to use when parsing the feature strings. The default is ['DNA', 'RNA', 'AGP', 'Mito', 'ER', "mito_tubeness"].
+    Returns
+    -------
+    pandas.DataFrame
+        One row per input feature, in input order, with the columns 'feature', 'compartment',
+        'feature_group', 'feature_type', 'channel'. All columns but 'feature' are categorical.
+    """
+    features = list(features)
+    parsed = {
+        feature: parse_cp_features(feature, channels)
+        for feature in dict.fromkeys(features)
+    }
+    catalog = pd.DataFrame(
+        [parsed[feature] for feature in features], columns=FEATURE_CATALOG_COLUMNS
+    )
+    return catalog.astype({col: "category" for col in FEATURE_CATALOG_COLUMNS[1:]})
+
+
+def load_feature_catalog(
+    data_path: str,
+    channels: list = ["DNA", "RNA", "AGP", "Mito", "ER", "mito_tubeness"],
+):
+    """Loads the feature catalog of a Parquet profile file, building it if needed.
+    The catalog is stored as `feature_catalog.parquet` next to `data_path` (typically a
+    `combined.parquet`), with the channels it was parsed with in its Parquet metadata. It
+    is rebuilt whenever its features no longer match the columns of `data_path` or it was
+    parsed with other channels. Only the Parquet schema is read, not the data.
+    Parameters
+    ----------
+    data_path : str
+        Path to the Parquet profile file.
+    channels : list, optional
+        A list of channel names to use when parsing the feature strings. The default is ['DNA', 'RNA', 'AGP', 'Mito', 'ER', "mito_tubeness"].
+    Returns
+    -------
+    pandas.DataFrame
+        The feature catalog of the non-metadata columns, see `parse_cp_feature_catalog`.
+    """
+    features = [
+        col
+        for col in pq.read_schema(data_path).names
+        if not col.startswith("Metadata_")
+    ]
+    catalog_path = os.path.join(os.path.dirname(data_path), "feature_catalog.parquet")
+
+    if os.path.exists(catalog_path):
+        metadata = pq.read_schema(catalog_path).metadata or {}
+        saved_channels = metadata.get(CATALOG_CHANNELS_METADATA_KEY)
+        if saved_channels is not None and json.loads(saved_channels) == list(channels):
+            catalog = pd.read_parquet(catalog_path)
+            if catalog["feature"].tolist() == features:
+                return catalog
+
+    catalog = parse_cp_feature_catalog(features, channels)
+
+    table = pa.Table.from_pandas(catalog, preserve_index=False)
+    table = table.replace_schema_metadata(
+        {
+            **(table.schema.metadata or {}),
+            CATALOG_CHANNELS_METADATA_KEY: json.dumps(list(channels)).encode(),
+        }
+    )
+    tmp_path = f"{catalog_path}.{os.getpid()}.tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, catalog_path)
+
+    return catalog
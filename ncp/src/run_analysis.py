@@ -0,0 +1,360 @@
+"""
+Run the analyses of `utils.run_analysis` as a resumable batch job.
+
+The (comparison, category) units of a data level are listed in a manifest
+next to their results. A unit writes a completion marker with the hash of
+its inputs and the run options once its test results are saved. When the
+job is restarted, units whose marker matches their current inputs and
+options are skipped. Run from the directory holding `output/`, e.g.
+
+    python ../ncp/src/run_analysis.py --data-level normalized_feature_select --jobs 8
+"""
+
+import argparse
+import json
+import os
+from fnmatch import fnmatch
+
+from analysis import TEST_MODES, save_summary_results
+from instrumentation import run_report, stage
+from stats_index import GroupStatsIndex
+from utils import (
+    _analysis_units,
+    analysis_inputs,
+    inspect_analysis,
+    run_analysis_units,
+    unit_input_hashes,
+)
+
+MANIFEST_FILE = "manifest.json"
+
+
+def results_root(data_level):
+    """Return the directory holding the analysis results of a data level."""
+    return f"output/analysis_results/{data_level}/"
+
+
+def comparison_name(data_level, comparison):
+    """Name a comparison by its output directory, e.g. `cell_type_a_vs_b/stem_vs_neuron`."""
+    return os.path.relpath(comparison["output_dir"], results_root(data_level))
+
+
+def marker_path(output_dir, category):
+    """Return the completion marker of a unit."""
+    return os.path.join(output_dir, f".done_{category}.json")
+
+
+def _write_json_atomic(obj, path):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=2, default=lambda value: value.item())
+    os.replace(tmp_path, path)
+
+
+def write_marker(output_dir, category, summary, options):
+    """Record that a unit is done, with the hash of its inputs and the run options."""
+    marker = {
+        "input_hash": summary["input_hash"],
+        "options": options,
+        "summary": summary,
+    }
+    _write_json_atomic(marker, marker_path(output_dir, category))
+
+
+def read_marker(output_dir, category, input_hash, options):
+    """
+    Return the summary recorded by a unit's completion marker, or None if
+    there is no marker or it was written for other inputs or options.
+    """
+    path = marker_path(output_dir, category)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path) as f:
+            marker = json.load(f)
+    except json.JSONDecodeError:
+        return None
+
+    if marker.get("input_hash") != input_hash or marker.get("options") != options:
+        return None
+
+    return marker["summary"]
+
+
+def build_manifest(data_level, comparisons, units, input_hashes, options):
+    """
+    List the units of a data level and whether they are done.
+
+    Parameters:
+    - data_level: str, the data level.
+    - comparisons: list of dicts, see `utils.analysis_inputs`.
+    - units: list of (comparison index, category) tuples.
+    - input_hashes: dict mapping each unit to the hash of its current inputs,
+      see `utils.unit_input_hashes`.
+    - options: dict, the run options recorded in the markers.
+
+    Returns:
+    - list of dicts with the comparison name, category, output directory and
+      status of each unit; a unit whose marker is outdated is pending.
+    """
+    manifest = []
+    for idx, category in units:
+        output_dir = comparisons[idx]["output_dir"]
+        marker = read_marker(
+            output_dir, category, input_hashes[(idx, category)], options
+        )
+        done = marker is not None
+        manifest.append(
+            {
+                "comparison": comparison_name(data_level, comparisons[idx]),
+                "category": str(category),
+                "output_dir": output_dir,
+                "status": "done" if done else "pending",
+            }
+        )
+
+    return manifest
+
+
+def select_units(manifest, only=(), skip=()):
+    """
+    Filter the manifest entries with glob patterns.
+
+    A pattern matches either the comparison name (`cell_type_a_vs_b/*`) or
+    `comparison:category` (`control_vs_deletion:stem`).
+
+    Returns:
+    - list of bool, whether each entry is selected.
+    """
+
+    def matches(entry, patterns):
+        unit_name = f"{entry['comparison']}:{entry['category']}"
+        return any(
+            fnmatch(entry["comparison"], pattern) or fnmatch(unit_name, pattern)
+            for pattern in patterns
+        )
+
+    return [
+        (not only or matches(entry, only)) and not matches(entry, skip)
+        for entry in manifest
+    ]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the control vs deletion and cell type analyses of a data level."
+    )
+    parser.add_argument(
+        "--data-level", required=True, help="data level under output/processed/"
+    )
+    parser.add_argument(
+        "--feature-cols-pattern",
+        default="Cells_|Cytoplasm_|Nuclei_",
+        help="regular expression selecting the feature columns",
+    )
+    parser.add_argument(
+        "--random-subset-features",
+        action="store_true",
+        help="analyze 30 random features only",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="number of worker processes"
+    )
+    parser.add_argument(
+        "--permutations",
+        type=int,
+        default=0,
+        help="number of label permutations for the accuracy p-values",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        help="number of cell line bootstrap resamples for the effect size intervals",
+    )
+    parser.add_argument(
+        "--only",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="run only the matching units (comparison or comparison:category glob)",
+    )
+    parser.add_argument(
+        "--skip",
+        action="append",
+        default=[],
+        metavar="PATTERN",
+        help="skip the matching units (comparison or comparison:category glob)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="rerun units that have a completion marker",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="recompute units even if their results match their inputs",
+    )
+    parser.add_argument(
+        "--test-mode",
+        choices=TEST_MODES,
+        default="well",
+        help="test the wells, or the median profiles of the cell lines",
+    )
+    parser.add_argument(
+        "--test-permutations",
+        type=int,
+        default=0,
+        help="number of line permutations for the p-values of the line test mode",
+    )
+    parser.add_argument(
+        "--stats-index",
+        action="store_true",
+        help="merge the U-tests from the per-group statistics index of the level",
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        help="print the manifest and exit",
+    )
+    parser.add_argument(
+        "--inspect",
+        action="store_true",
+        help="save the plots of the results once every unit is done",
+    )
+    parser.add_argument(
+        "--report",
+        metavar="PATH",
+        help="save the timing and memory of each stage (.json or .parquet)",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "pyinstrument"],
+        help="profile the run, saving the profile next to the report",
+    )
+    args = parser.parse_args(argv)
+    if args.profile and not args.report:
+        parser.error("--profile requires --report")
+    return args
+
+
+def run(args):
+    store, rows, comparisons = analysis_inputs(
+        args.data_level, args.feature_cols_pattern, args.random_subset_features
+    )
+    units = _analysis_units(store.metadata.iloc[rows], comparisons)
+    options = {
+        "n_permutations": args.permutations,
+        "n_bootstrap": args.bootstrap,
+        "test_mode": args.test_mode,
+        "n_test_permutations": args.test_permutations,
+    }
+
+    root = results_root(args.data_level)
+    os.makedirs(root, exist_ok=True)
+    manifest_file = os.path.join(root, MANIFEST_FILE)
+
+    # Markers of other inputs or options are outdated
+    with stage("analysis.input_hashes", n_units=len(units)):
+        input_hashes = unit_input_hashes(store, comparisons, units, rows, **options)
+    manifest = build_manifest(
+        args.data_level, comparisons, units, input_hashes, options
+    )
+    selected = select_units(manifest, args.only, args.skip)
+    _write_json_atomic(manifest, manifest_file)
+
+    if args.list:
+        for entry, is_selected in zip(manifest, selected):
+            flag = " " if is_selected else "-"
+            print(
+                f"{flag} {entry['status']:8} {entry['comparison']}:{entry['category']}"
+            )
+        return
+
+    pending = [
+        i
+        for i, entry in enumerate(manifest)
+        if selected[i] and (args.force or entry["status"] != "done")
+    ]
+    print(
+        f"{len(pending)} units to run, "
+        f"{sum(selected) - len(pending)} already done, "
+        f"{len(manifest) - sum(selected)} filtered out"
+    )
+
+    stats_index = None
+    if args.stats_index and pending:
+        stats_index = GroupStatsIndex.load(store, rows, n_jobs=args.jobs)
+
+    position = {unit: i for i, unit in enumerate(units)}
+    with stage(
+        "analysis",
+        n_rows=len(rows),
+        n_features=len(comparisons[0]["feature_cols"]),
+        data_level=args.data_level,
+        n_jobs=args.jobs,
+        n_units=len(pending),
+    ):
+        for unit, summary in run_analysis_units(
+            store,
+            comparisons,
+            [units[i] for i in pending],
+            n_jobs=args.jobs,
+            rows=rows,
+            use_cache=not args.no_cache,
+            stats_index=stats_index,
+            **options,
+        ):
+            entry = manifest[position[unit]]
+            write_marker(entry["output_dir"], unit[1], summary, options)
+            entry["status"] = "done"
+            _write_json_atomic(manifest, manifest_file)
+            print(f"Finished {entry['comparison']}: {entry['category']}")
+
+    # Assemble the summary of every comparison whose units are all done
+    complete = True
+    for comparison_idx, comparison in enumerate(comparisons):
+        summaries = [
+            read_marker(
+                comparison["output_dir"],
+                category,
+                input_hashes[(idx, category)],
+                options,
+            )
+            for idx, category in units
+            if idx == comparison_idx
+        ]
+        if any(summary is None for summary in summaries):
+            name = comparison_name(args.data_level, comparison)
+            print(
+                f"Skipping the summary of {name}: "
+                "some units are not done for these inputs and options"
+            )
+            complete = False
+            continue
+        save_summary_results(summaries, comparison["output_dir"])
+
+    if args.inspect:
+        if complete:
+            inspect_analysis(args.data_level, headless=True, n_jobs=args.jobs)
+        else:
+            print("Skipping inspection: some units are not done")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.report is None:
+        run(args)
+        return
+
+    with run_report(
+        f"run_analysis {args.data_level}", args.report, profile=args.profile
+    ):
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
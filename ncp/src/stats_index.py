@@ -0,0 +1,520 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from analysis import (
+    _sorted_runs,
+    _tie_term,
+    mann_whitney_p_values,
+    mann_whitney_results,
+)
+from consensus import stratum_offsets
+from data_management import ColumnIndex
+from feature_store import MANIFEST_FILE as STORE_MANIFEST_FILE
+from instrumentation import timed
+
+# Finest groups of the index; every comparison of `run_analysis` is a union of them
+GROUP_COLS = [
+    "Metadata_cell_type",
+    "Metadata_line_condition",
+    "Metadata_line_ID",
+    "Metadata_Plate",
+]
+
+SORTED_FILE = "sorted_features.npy"
+BLOCK_SORTED_FILE = "block_sorted_features.npy"
+STATS_FILE = "group_stats.npz"
+GROUPS_FILE = "groups.parquet"
+MANIFEST_FILE = "manifest.json"
+
+
+def default_index_dir(store_dir):
+    """Return the statistics index of a feature store, next to it."""
+    return os.path.join(os.path.dirname(os.path.abspath(store_dir)), "stats_index")
+
+
+def _index_stamp(store, rows, group_cols):
+    """Identify the store, rows and groups an index is built from."""
+    with open(os.path.join(store.store_dir, STORE_MANIFEST_FILE)) as f:
+        store_manifest = json.load(f)
+
+    return {
+        "store": {
+            key: store_manifest[key] for key in ("source", "size", "mtime_ns", "dtype")
+        },
+        "rows": hashlib.sha256(np.asarray(rows, dtype=np.int64).tobytes()).hexdigest(),
+        "group_cols": list(group_cols),
+        "block_cols": list(group_cols[:2]),
+        "feature_cols": store.feature_cols,
+    }
+
+
+def _column_keys(sorted_values):
+    """
+    Order-preserving integer keys of float32 columns, prefixed by the column
+    position so that the columns, flattened one after the other, are sorted
+    as a whole.
+    """
+    # Adding zero turns -0.0 into 0.0, which compare equal
+    values = np.ascontiguousarray((sorted_values + np.float32(0)).T)
+    bits = values.view(np.uint32).astype(np.uint64)
+    keys = np.where(bits >> 31, bits ^ 0xFFFFFFFF, bits | 0x80000000)
+    keys |= np.arange(values.shape[0], dtype=np.uint64)[:, None] << 32
+    return keys.ravel()
+
+
+def _searchsorted_columns(sorted_values, values):
+    """
+    Search values in the sorted columns of the same features, column by
+    column.
+
+    Returns:
+    - below: ndarray, per value, the number of sorted values below it.
+    - not_above: ndarray, per value, the number of sorted values not above it.
+    """
+    n_sorted, n_columns = sorted_values.shape
+    if values.dtype != np.float32 or sorted_values.dtype != np.float32:
+        below = np.empty(values.shape, dtype=np.int64)
+        not_above = np.empty(values.shape, dtype=np.int64)
+        for j in range(n_columns):
+            below[:, j] = np.searchsorted(sorted_values[:, j], values[:, j], "left")
+            not_above[:, j] = np.searchsorted(
+                sorted_values[:, j], values[:, j], "right"
+            )
+        return below, not_above
+
+    # A single binary search over all columns
+    sorted_keys = _column_keys(sorted_values)
+    keys = _column_keys(values)
+    column_starts = (np.arange(n_columns) * n_sorted)[:, None]
+    below = np.searchsorted(sorted_keys, keys, "left").reshape(n_columns, -1)
+    not_above = np.searchsorted(sorted_keys, keys, "right").reshape(n_columns, -1)
+    return (below - column_starts).T, (not_above - column_starts).T
+
+
+class GroupStatsIndex:
+    """
+    Sufficient statistics of the finest groups of a data level.
+
+    For every (cell type, condition, line, plate) group the index holds the
+    number of rows, and for every feature the number of present values, their
+    sum, sum of squares and median. It also holds two copies of the feature
+    matrix, memory-mapped like the feature store, whose rows are ordered by
+    group and whose columns are sorted within each group, and within each
+    block of groups sharing the first two group columns (cell type and
+    condition).
+
+    Any comparison of `run_analysis` opposes two blocks, so its U-tests,
+    moments and medians are read from the index instead of being recomputed
+    from the raw rows; other unions of groups merge their sorted columns.
+    """
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+
+        self.index_dir = index_dir
+        self.feature_cols = manifest["feature_cols"]
+        self.group_cols = manifest["group_cols"]
+        self.groups = pd.read_parquet(os.path.join(index_dir, GROUPS_FILE))
+        self.sorted_features = np.load(
+            os.path.join(index_dir, SORTED_FILE), mmap_mode="r"
+        )
+        self.block_sorted_features = np.load(
+            os.path.join(index_dir, BLOCK_SORTED_FILE), mmap_mode="r"
+        )
+
+        with np.load(os.path.join(index_dir, STATS_FILE)) as stats:
+            self.offsets = stats["offsets"]
+            self.group_blocks = stats["group_blocks"]
+            self.block_offsets = stats["block_offsets"]
+            self.n_present = stats["n_present"]
+            self.sums = stats["sums"]
+            self.sums_sq = stats["sums_sq"]
+            self.medians = stats["medians"]
+
+        self.columns = ColumnIndex(self.feature_cols)
+        self._positions = {col: i for i, col in enumerate(self.feature_cols)}
+
+    def __len__(self):
+        return len(self.groups)
+
+    @classmethod
+    def build(cls, store, rows=None, group_cols=GROUP_COLS, index_dir=None, n_jobs=1):
+        """
+        Build the statistics index of rows of a feature store.
+
+        Each group's rows are read from the store once; the groups are
+        reduced concurrently with `n_jobs` threads.
+
+        Parameters:
+        - store: FeatureStore, the data.
+        - rows: array-like, the positions of the rows to index (all by default).
+        - group_cols: list, the metadata columns defining the groups.
+        - index_dir: str, the index directory (next to the store by default).
+        - n_jobs: int, number of threads reducing groups concurrently.
+
+        Returns:
+        - GroupStatsIndex
+        """
+        index_dir = index_dir or default_index_dir(store.store_dir)
+        os.makedirs(index_dir, exist_ok=True)
+        rows = np.arange(len(store)) if rows is None else np.asarray(rows)
+
+        # The manifest is written last and marks the index as complete
+        manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        metadata = store.metadata.iloc[rows].reset_index(drop=True)
+        order, offsets, groups = stratum_offsets(metadata, group_cols)
+        groups["n_rows"] = np.diff(offsets)
+
+        n_groups, n_features = len(groups), len(store.feature_cols)
+        n_present = np.empty((n_groups, n_features), dtype=np.int64)
+        sums = np.empty((n_groups, n_features), dtype=np.float64)
+        sums_sq = np.empty((n_groups, n_features), dtype=np.float64)
+        medians = np.empty((n_groups, n_features), dtype=np.float64)
+
+        sorted_path = os.path.join(index_dir, SORTED_FILE)
+        tmp_path = f"{sorted_path}.{os.getpid()}.tmp.npy"
+        sorted_features = np.lib.format.open_memmap(
+            tmp_path,
+            mode="w+",
+            dtype=store.features.dtype,
+            shape=(len(rows), n_features),
+        )
+
+        def reduce_group(group):
+            start, stop = offsets[group], offsets[group + 1]
+            block = np.sort(store.take(rows[order[start:stop]]), axis=0)
+
+            present = ~np.isnan(block)
+            values = np.where(present, block, 0).astype(np.float64)
+            n = present.sum(axis=0)
+            n_present[group] = n
+            sums[group] = values.sum(axis=0)
+            sums_sq[group] = (values**2).sum(axis=0)
+
+            # The median of the present values, read off the sorted block
+            lo = np.take_along_axis(values, np.maximum(n - 1, 0)[None, :] // 2, axis=0)
+            hi = np.take_along_axis(values, n[None, :] // 2, axis=0)
+            medians[group] = np.where(n > 0, (lo[0] + hi[0]) / 2, np.nan)
+
+            return block
+
+        # Missing values sort last in each group block
+        if n_jobs == 1:
+            for group in range(n_groups):
+                sorted_features[offsets[group] : offsets[group + 1]] = reduce_group(
+                    group
+                )
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                for group, block in enumerate(
+                    executor.map(reduce_group, range(n_groups))
+                ):
+                    sorted_features[offsets[group] : offsets[group + 1]] = block
+
+        sorted_features.flush()
+
+        # Blocks of consecutive groups sharing their first two group columns
+        keys = groups[list(group_cols[:2])]
+        changes = ~(keys.eq(keys.shift()) | (keys.isna() & keys.shift().isna()))
+        group_blocks = np.cumsum(changes.any(axis=1).to_numpy()) - 1
+        block_starts = np.flatnonzero(np.diff(group_blocks, prepend=-1))
+        block_offsets = np.append(offsets[block_starts], offsets[-1])
+
+        block_sorted_path = os.path.join(index_dir, BLOCK_SORTED_FILE)
+        block_tmp_path = f"{block_sorted_path}.{os.getpid()}.tmp.npy"
+        block_sorted_features = np.lib.format.open_memmap(
+            block_tmp_path,
+            mode="w+",
+            dtype=store.features.dtype,
+            shape=(len(rows), n_features),
+        )
+        for start, stop in zip(block_offsets[:-1], block_offsets[1:]):
+            # Merging the sorted group runs is cheap for the stable sort
+            block_sorted_features[start:stop] = np.sort(
+                sorted_features[start:stop], axis=0, kind="stable"
+            )
+
+        block_sorted_features.flush()
+        del sorted_features, block_sorted_features
+        os.replace(tmp_path, sorted_path)
+        os.replace(block_tmp_path, block_sorted_path)
+
+        np.savez(
+            os.path.join(index_dir, STATS_FILE),
+            offsets=offsets,
+            group_blocks=group_blocks,
+            block_offsets=block_offsets,
+            n_present=n_present,
+            sums=sums,
+            sums_sq=sums_sq,
+            medians=medians,
+        )
+        groups.to_parquet(os.path.join(index_dir, GROUPS_FILE))
+
+        with open(manifest_path, "w") as f:
+            json.dump(_index_stamp(store, rows, group_cols), f)
+
+        return cls(index_dir)
+
+    @classmethod
+    @timed(
+        "loading.stats_index",
+        counts=lambda index: {
+            "n_groups": len(index),
+            "n_features": len(index.feature_cols),
+        },
+    )
+    def load(cls, store, rows=None, group_cols=GROUP_COLS, index_dir=None, n_jobs=1):
+        """
+        Open the statistics index of rows of a feature store, (re)building it
+        if it is missing or was built from other data, rows or groups.
+        """
+        index_dir = index_dir or default_index_dir(store.store_dir)
+        manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+        rows = np.arange(len(store)) if rows is None else np.asarray(rows)
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest == _index_stamp(store, rows, group_cols):
+                return cls(index_dir)
+
+        return cls.build(store, rows, group_cols, index_dir, n_jobs=n_jobs)
+
+    def column_positions(self, columns):
+        """Return the positions of feature columns in the index."""
+        if columns is None:
+            return np.arange(len(self.feature_cols))
+        return np.array([self._positions[col] for col in columns], dtype=np.int64)
+
+    def select(self, **filters):
+        """
+        Select the groups matching metadata values.
+
+        Parameters:
+        - **filters: group column -> value or list of values, e.g.
+          `select(Metadata_cell_type="stem", Metadata_line_condition="control")`.
+
+        Returns:
+        - numpy.ndarray, the positions of the matching groups.
+        """
+        mask = np.ones(len(self.groups), dtype=bool)
+        for col, values in filters.items():
+            if isinstance(values, (list, tuple, set, np.ndarray)):
+                mask &= self.groups[col].isin(list(values)).to_numpy()
+            else:
+                mask &= (self.groups[col] == values).to_numpy()
+
+        return np.flatnonzero(mask)
+
+    def _sorted_values(self, groups, positions):
+        """
+        Merge the sorted feature columns of several groups, in the dtype of
+        the store; whole blocks of groups are read presorted.
+        """
+        groups = np.unique(np.asarray(groups, dtype=np.int64))
+        blocks = np.unique(self.group_blocks[groups])
+        if np.isin(self.group_blocks, blocks).sum() == len(groups):
+            runs = [
+                self.block_sorted_features[
+                    self.block_offsets[block] : self.block_offsets[block + 1]
+                ]
+                for block in blocks
+            ]
+        else:
+            runs = [
+                self.sorted_features[self.offsets[group] : self.offsets[group + 1]]
+                for group in groups
+            ]
+        if not runs:
+            return np.empty((0, len(positions)), dtype=self.sorted_features.dtype)
+
+        merged = np.concatenate([run[:, positions] for run in runs], axis=0)
+        if len(runs) > 1:
+            # Merging sorted runs is cheap for the stable (run-detecting) sort
+            merged.sort(axis=0, kind="stable")
+
+        return merged
+
+    def values(self, groups, columns=None):
+        """
+        Merge the sorted feature columns of several groups.
+
+        Parameters:
+        - groups: array-like, the group positions (see `select`).
+        - columns: list of feature columns, or None for all features.
+
+        Returns:
+        - numpy.ndarray, float64 (n_rows, n_columns) values of the groups, each
+          column sorted with its missing values last.
+        """
+        return self._sorted_values(groups, self.column_positions(columns)).astype(
+            np.float64
+        )
+
+    def n_missing(self, groups, columns=None):
+        """Count the missing values of each feature over several groups."""
+        groups = np.asarray(groups, dtype=np.int64)
+        positions = self.column_positions(columns)
+        n_rows = self.groups["n_rows"].to_numpy()[groups].sum()
+        return n_rows - self.n_present[np.ix_(groups, positions)].sum(axis=0)
+
+    def moments(self, groups, columns=None):
+        """
+        Merge the moments of each feature over several groups.
+
+        Missing values are ignored.
+
+        Parameters:
+        - groups: array-like, the group positions (see `select`).
+        - columns: list of feature columns, or None for all features.
+
+        Returns:
+        - n: numpy.ndarray, the number of present values of each feature.
+        - mean: numpy.ndarray, the mean of each feature.
+        - var: numpy.ndarray, the sample variance (ddof=1) of each feature.
+        """
+        index = np.ix_(
+            np.asarray(groups, dtype=np.int64), self.column_positions(columns)
+        )
+        n = self.n_present[index].sum(axis=0)
+        sums = self.sums[index].sum(axis=0)
+        sums_sq = self.sums_sq[index].sum(axis=0)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = sums / n
+            var = np.maximum(sums_sq - n * mean**2, 0) / (n - 1)
+
+        return n, mean, var
+
+    def median(self, groups, columns=None):
+        """
+        Median of each feature over several groups, ignoring missing values.
+
+        The median of a single group is read from the index; the median of a
+        union of groups is read off their merged sorted columns.
+        """
+        groups = np.asarray(groups, dtype=np.int64)
+        if len(groups) == 1:
+            return self.medians[groups[0], self.column_positions(columns)]
+
+        merged = self.values(groups, columns)
+        n = (~np.isnan(merged)).sum(axis=0)
+        if not len(merged):
+            return np.full(merged.shape[1], np.nan)
+
+        lo = np.take_along_axis(merged, np.maximum(n - 1, 0)[None, :] // 2, axis=0)
+        hi = np.take_along_axis(merged, n[None, :] // 2, axis=0)
+        return np.where(n > 0, (lo[0] + hi[0]) / 2, np.nan)
+
+    def summary(self, by, columns=None):
+        """
+        Summarize each feature over the groups sharing values of `by`.
+
+        Parameters:
+        - by: list, group columns to summarize over, e.g. ["Metadata_cell_type"].
+        - columns: list of feature columns, or None for all features.
+
+        Returns:
+        - pandas.DataFrame, the `by` values, feature, number of present values,
+          mean, standard deviation and median of each (`by` values, feature).
+        """
+        columns = self.feature_cols if columns is None else list(columns)
+
+        frames = []
+        for key, groups in self.groups.groupby(by, sort=True).indices.items():
+            n, mean, var = self.moments(groups, columns)
+            frame = pd.DataFrame(
+                {
+                    "feature": columns,
+                    "n": n,
+                    "mean": mean,
+                    "std": np.sqrt(var),
+                    "median": self.median(groups, columns),
+                }
+            )
+            key = key if isinstance(key, tuple) else (key,)
+            for col, value in reversed(list(zip(by, key))):
+                frame.insert(0, col, value)
+            frames.append(frame)
+
+        return pd.concat(frames, ignore_index=True)
+
+    def mann_whitney_u(self, groups_1, groups_2, columns=None):
+        """
+        Mann-Whitney U-test of every feature between two unions of groups.
+
+        Same results as `analysis.batch_mann_whitney_u` on the raw rows. The
+        U statistic counts, for each value of the first side, the values of
+        the second side below it (ties count half) by binary search in its
+        sorted columns; the tie correction adds the ties within each side to
+        those between the sides, so the sides are never merged.
+
+        Parameters:
+        - groups_1: array-like, the group positions of the first side.
+        - groups_2: array-like, the group positions of the second side.
+        - columns: list of feature columns, or None for all features.
+
+        Returns:
+        - u_statistic: ndarray, the U statistic of the first side per feature.
+        - p_value: ndarray, two-sided p-values per feature.
+        """
+        if not len(groups_1) or not len(groups_2):
+            raise ValueError(
+                "One or more target_groups do not exist in the group column."
+            )
+
+        positions = self.column_positions(columns)
+        data_cond1 = self._sorted_values(groups_1, positions)
+        data_cond2 = self._sorted_values(groups_2, positions)
+
+        has_nan = (self.n_missing(groups_1, columns) > 0) | (
+            self.n_missing(groups_2, columns) > 0
+        )
+
+        below, not_above = _searchsorted_columns(data_cond2, data_cond1)
+        u1 = (below.sum(axis=0) + not_above.sum(axis=0)) / 2
+        u1[has_nan] = np.nan
+
+        # Ties between the sides: each run of the first side meets the
+        # values of the second side equal to it
+        first, last = _sorted_runs(data_cond1)
+        run_starts = first == np.arange(len(data_cond1))[:, None]
+        n_1 = last - first + 1
+        n_2 = not_above - below
+        cross_ties = np.where(run_starts, 3 * n_1 * n_2 * (n_1 + n_2), 0).sum(axis=0)
+        tie_term = (
+            _tie_term(first, last) + _tie_term(*_sorted_runs(data_cond2)) + cross_ties
+        )
+
+        p = mann_whitney_p_values(
+            u1,
+            tie_term,
+            data_cond1.astype(np.float64),
+            data_cond2.astype(np.float64),
+        )
+        p[has_nan] = np.nan
+
+        return u1, p
+
+    def mann_whitney_u_test(self, groups_1, groups_2, columns=None):
+        """
+        Perform the Mann-Whitney U-test between two unions of groups, as
+        `analysis.mann_whitney_u_test` with `groups_1` encoded as 0.
+
+        Returns:
+        - results: DataFrame, test statistics, p-values and q-values for each feature.
+        """
+        columns = self.feature_cols if columns is None else list(columns)
+        list_u, list_p = self.mann_whitney_u(groups_1, groups_2, columns)
+
+        return mann_whitney_results(columns, list_u, list_p)
@@ -0,0 +1,202 @@
+from itertools import combinations, product
+
+import numpy as np
+import pandas as pd
+
+from normalization import COMPARTMENTS
+
+CELL_TYPES = ["stem", "neuron", "progen", "astro"]
+CHANNELS = ["DNA", "RNA", "AGP", "Mito", "ER"]
+
+AREA_SHAPE = [
+    "Area",
+    "Perimeter",
+    "Eccentricity",
+    "FormFactor",
+    "Solidity",
+    "Extent",
+    "MajorAxisLength",
+    "MinorAxisLength",
+    "Compactness",
+]
+INTENSITY = [
+    "MeanIntensity",
+    "MedianIntensity",
+    "StdIntensity",
+    "IntegratedIntensity",
+    "MaxIntensity",
+    "MinIntensity",
+    "MADIntensity",
+    "LowerQuartileIntensity",
+    "UpperQuartileIntensity",
+]
+TEXTURE = [
+    "AngularSecondMoment",
+    "Contrast",
+    "Correlation",
+    "Entropy",
+    "InverseDifferenceMoment",
+    "SumAverage",
+    "SumEntropy",
+    "Variance",
+]
+CORRELATION = ["Correlation", "K", "Overlap", "Manders"]
+RADIAL_DISTRIBUTION = ["FracAtD", "MeanFrac", "RadialCV"]
+
+
+def _compartment_features(compartment):
+    """List CellProfiler-style feature names of one compartment."""
+    features = [f"{compartment}_AreaShape_{name}" for name in AREA_SHAPE]
+    features += [
+        f"{compartment}_AreaShape_Zernike_{n}_{m}"
+        for n in range(10)
+        for m in range(n % 2, n + 1, 2)
+    ]
+    features += [
+        f"{compartment}_Intensity_{name}_{channel}"
+        for name, channel in product(INTENSITY, CHANNELS)
+    ]
+    features += [
+        f"{compartment}_Granularity_{scale}_{channel}"
+        for scale, channel in product(range(1, 17), CHANNELS)
+    ]
+    features += [
+        f"{compartment}_Correlation_{name}_{channel_0}_{channel_1}"
+        for name, (channel_0, channel_1) in product(
+            CORRELATION, combinations(CHANNELS, 2)
+        )
+    ]
+    features += [
+        f"{compartment}_RadialDistribution_{name}_{channel}_{ring}of4"
+        for name, channel, ring in product(RADIAL_DISTRIBUTION, CHANNELS, range(1, 5))
+    ]
+    features += [
+        f"{compartment}_Texture_{name}_{channel}_{scale}_{direction:02d}_256"
+        for name, channel, scale, direction in product(
+            TEXTURE, CHANNELS, (3, 5, 10), range(4)
+        )
+    ]
+    return features
+
+
+def synthetic_feature_names(n_features):
+    """
+    Generate CellProfiler-style feature names, split evenly across compartments.
+
+    Parameters:
+    - n_features: int, the number of features.
+
+    Returns:
+    - list, the feature names grouped by compartment.
+    """
+    per_compartment = [
+        len(range(i, n_features, len(COMPARTMENTS))) for i in range(len(COMPARTMENTS))
+    ]
+
+    features = []
+    for compartment, n in zip(sorted(COMPARTMENTS), per_compartment):
+        names = _compartment_features(compartment)
+        if n > len(names):
+            raise ValueError(
+                f"At most {len(names) * len(COMPARTMENTS)} synthetic features are available."
+            )
+        features += names[:n]
+
+    return features
+
+
+def _well_names(n_wells):
+    """Name the wells of a 96- or 384-well plate layout (A01, A02, ...)."""
+    n_rows, n_cols = (8, 12) if n_wells <= 96 else (16, 24)
+    wells = [
+        f"{chr(ord('A') + row)}{col:02d}"
+        for row, col in product(range(n_rows), range(1, n_cols + 1))
+    ]
+    if n_wells > len(wells):
+        raise ValueError(f"At most {len(wells)} wells are available per plate.")
+    return wells[:n_wells]
+
+
+def synthetic_profiles(
+    n_plates=4,
+    n_wells=96,
+    n_cell_types=4,
+    n_lines=16,
+    n_features=300,
+    nan_fraction=0.001,
+    nonhuman_fraction=0.1,
+    effect_fraction=0.1,
+    effect_size=0.5,
+    dtype=np.float64,
+    seed=0,
+):
+    """
+    Generate well-level profiles shaped like the NCP combined profiles.
+
+    Each plate holds one cell type (assigned in turn) and each well one cell
+    line (assigned in turn across the plate). Half of the lines are controls
+    and half deletions. Features combine a per-feature baseline, plate and
+    cell type shifts, a deletion shift on a fraction of the features, and
+    noise; a fraction of the values are missing.
+
+    Parameters:
+    - n_plates: int, the number of plates.
+    - n_wells: int, the number of wells per plate (up to 384).
+    - n_cell_types: int, the number of cell types.
+    - n_lines: int, the number of cell lines.
+    - n_features: int, the number of features.
+    - nan_fraction: float, the fraction of missing feature values.
+    - nonhuman_fraction: float, the fraction of lines whose source is not human.
+    - effect_fraction: float, the fraction of features shifted in deletion lines.
+    - effect_size: float, the shift of those features, in noise standard deviations.
+    - dtype: numpy dtype of the features.
+    - seed: int, the random seed.
+
+    Returns:
+    - pandas.DataFrame, the `Metadata_` columns followed by the features.
+    """
+    rng = np.random.default_rng(seed)
+
+    cell_types = CELL_TYPES[:n_cell_types] + [
+        f"cell_type_{i}" for i in range(len(CELL_TYPES), n_cell_types)
+    ]
+    plates = [f"BR{132670 + plate:08d}" for plate in range(n_plates)]
+    lines = [f"NCP{line:03d}" for line in range(n_lines)]
+
+    # Layout: one cell type per plate, lines assigned in turn across the wells
+    plate_idx = np.repeat(np.arange(n_plates), n_wells)
+    cell_type_idx = plate_idx % n_cell_types
+    line_idx = (np.tile(np.arange(n_wells), n_plates) + plate_idx) % n_lines
+    is_deletion = line_idx >= n_lines // 2
+    is_human = rng.random(n_lines) >= nonhuman_fraction
+
+    n_rows = len(plate_idx)
+    meta = pd.DataFrame(
+        {
+            "Metadata_Plate": np.array(plates)[plate_idx],
+            "Metadata_Well": np.tile(_well_names(n_wells), n_plates),
+            "Metadata_cell_type": np.array(cell_types)[cell_type_idx],
+            "Metadata_line_ID": np.array(lines)[line_idx],
+            "Metadata_line_condition": np.where(is_deletion, "deletion", "control"),
+            "Metadata_line_source": np.where(is_human[line_idx], "human", "mouse"),
+            "Metadata_Site_Count": 9,
+            "Metadata_Object_Count": rng.poisson(2000, n_rows),
+        }
+    )
+
+    feature_cols = synthetic_feature_names(n_features)
+    baseline = rng.normal(0, 5, n_features)
+    scale = rng.lognormal(0, 0.5, n_features)
+    plate_shift = rng.normal(0, 0.3, (n_plates, n_features))
+    cell_type_shift = rng.normal(0, 1, (n_cell_types, n_features))
+    deletion_shift = effect_size * (rng.random(n_features) < effect_fraction)
+
+    values = rng.standard_normal((n_rows, n_features))
+    values += plate_shift[plate_idx] + cell_type_shift[cell_type_idx]
+    values += np.outer(is_deletion, deletion_shift)
+    values = (baseline + scale * values).astype(dtype)
+
+    values[rng.random((n_rows, n_features)) < nan_fraction] = np.nan
+
+    features = pd.DataFrame(values, columns=feature_cols, copy=False)
+    return pd.concat([meta, features], axis=1)
@@ -1,8 +1,26 @@
-import pandas as pd
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from itertools import combinations
 
-from analysis import perform_and_save_analysis
-from visualization import visualize_results
+import numpy as np
+import pandas as pd
+
+from analysis import (
+    analysis_input_hash,
+    analyze_category,
+    perform_and_save_analysis,
+    save_summary_results,
+)
+from feature_store import FeatureStore
+from instrumentation import stage
+from stats_index import GroupStatsIndex
+from visualization import render_results, visualize_results
+
+# Shared state of the analysis worker processes, set by `_init_analysis_worker`
+_worker_store = None
+_worker_rows = None
+_worker_metadata = None
+_worker_index = None
 
 
 def apply_function_to_groups(df, group_col, func, *args, **kwargs):
@@ -34,49 +52,37 @@ def apply_function_to_groups(df, group_col, func, *args, **kwargs):
     return pd.concat(results, ignore_index=True)
 
 
-def run_analysis(
-    data_level,
-    feature_cols_pattern="Cells_|Cytoplasm_|Nuclei_",
-    random_subset_features=False,
-):
-    data_path = f"output/processed/{data_level}/combined.parquet"
-
-    df = pd.read_parquet(data_path)
+def _analysis_comparisons(data_level, feature_cols):
+    """
+    List the comparisons run by `run_analysis`.
 
-    # select only rows where the Metadata_line_source is "human"
-    df = df.query("Metadata_line_source == 'human'")
-    feature_cols = df.columns[
-        df.columns.str.contains(feature_cols_pattern, regex=True)
-    ].tolist()
+    Parameters:
+    - data_level: str, the data level to analyze.
+    - feature_cols: list, the feature columns selected for the data level.
 
+    Returns:
+    - comparisons: list of dicts with the arguments of `perform_and_save_analysis`
+      (except `df`).
+    """
     cols_to_drop_stem_cell = [
         "Nuclei_ObjectSkeleton_NumberNonTrunkBranches_CellImageSkel",
         "Nuclei_ObjectSkeleton_NumberBranchEnds_CellImageSkel",
         "Nuclei_ObjectSkeleton_TotalObjectSkeletonLength_CellImageSkel",
     ]
 
-    if random_subset_features:
-        import random
-
-        print("WARNING: Randomly selecting 30 features")
-
-        random.seed(42)
-        random.shuffle(feature_cols)
-        feature_cols = feature_cols[:30]
-
     # ------------------------------------------------------------
     # Control vs Deletion, per cell type
     # ------------------------------------------------------------
 
-    target_col_mapping_dict = {"control": 0, "deletion": 1}
-    perform_and_save_analysis(
-        df=df,
-        category_col="Metadata_cell_type",
-        target_col="Metadata_line_condition",
-        target_col_mapping_dict=target_col_mapping_dict,
-        feature_cols=feature_cols,
-        output_dir=f"output/analysis_results/{data_level}/control_vs_deletion/",
-    )
+    comparisons = [
+        {
+            "category_col": "Metadata_cell_type",
+            "target_col": "Metadata_line_condition",
+            "target_col_mapping_dict": {"control": 0, "deletion": 1},
+            "feature_cols": feature_cols,
+            "output_dir": f"output/analysis_results/{data_level}/control_vs_deletion/",
+        }
+    ]
 
     # ------------------------------------------------------------
     # Cell type A vs B, per condition
@@ -88,53 +94,426 @@ def run_analysis(
     # Create all unique pairs of cell types
     cell_type_pairs = list(combinations(cell_types, 2))
 
-    # Perform analysis for each pair
     for cell_type_0, cell_type_1 in cell_type_pairs:
         cols_to_drop = (
             cols_to_drop_stem_cell if "stem" in [cell_type_0, cell_type_1] else []
         )
 
-        target_col_mapping_dict = {cell_type_0: 0, cell_type_1: 1}
+        comparisons.append(
+            {
+                "category_col": "Metadata_line_condition",
+                "target_col": "Metadata_cell_type",
+                "target_col_mapping_dict": {cell_type_0: 0, cell_type_1: 1},
+                "feature_cols": [
+                    col for col in feature_cols if col not in cols_to_drop
+                ],
+                "output_dir": f"output/analysis_results/{data_level}/cell_type_a_vs_b/{cell_type_0}_vs_{cell_type_1}/",
+            }
+        )
 
-        output_dir = f"output/analysis_results/{data_level}/cell_type_a_vs_b/{cell_type_0}_vs_{cell_type_1}/"
+    return comparisons
 
-        perform_and_save_analysis(
-            df=df.drop(columns=cols_to_drop, errors="ignore"),
-            category_col="Metadata_line_condition",
-            target_col="Metadata_cell_type",
-            target_col_mapping_dict=target_col_mapping_dict,
-            feature_cols=feature_cols,
-            output_dir=output_dir,
+
+def _init_analysis_worker(store_dir, rows, index_dir=None):
+    """
+    Attach a worker process to the memory-mapped feature store and, if any,
+    statistics index.
+    """
+    global _worker_store, _worker_rows, _worker_metadata, _worker_index
+
+    _worker_store = FeatureStore(store_dir)
+    _worker_rows = rows
+    _worker_metadata = _worker_store.metadata.iloc[rows].reset_index(drop=True)
+    _worker_index = None if index_dir is None else GroupStatsIndex(index_dir)
+
+
+def _unit_frame(store, rows, metadata, comparison, category):
+    """
+    Read the rows and columns of one (comparison, category) unit from the
+    memory-mapped feature matrix, with its target encoded by the mapping.
+
+    Returns:
+    - category_df: DataFrame, the features, cell line and encoded target.
+    - target_col_encoded: str, the encoded target column.
+    """
+    target_col = comparison["target_col"]
+    target_col_encoded = f"{target_col}_encoded"
+    feature_cols = comparison["feature_cols"]
+
+    encoded = metadata[target_col].map(comparison["target_col_mapping_dict"])
+    unit_rows = np.flatnonzero(
+        (metadata[comparison["category_col"]] == category).to_numpy()
+        & encoded.notna().to_numpy()
+    )
+
+    category_df = pd.DataFrame(
+        store.take(rows[unit_rows], feature_cols),
+        columns=feature_cols,
+        copy=False,
+    )
+    category_df["Metadata_line_ID"] = metadata["Metadata_line_ID"].to_numpy()[unit_rows]
+    category_df[target_col_encoded] = encoded.to_numpy()[unit_rows]
+
+    return category_df, target_col_encoded
+
+
+def _analyze_unit(comparison, category, **options):
+    """
+    Analyze one (comparison, category) unit inside a worker process.
+
+    Only the rows and columns of the unit are read from the memory-mapped
+    feature matrix. With a statistics index, the well-level U-test is merged
+    from the index groups of the unit instead. The options are passed on to
+    `analyze_category`.
+    """
+    target_col = comparison["target_col"]
+    feature_cols = comparison["feature_cols"]
+    category_df, target_col_encoded = _unit_frame(
+        _worker_store, _worker_rows, _worker_metadata, comparison, category
+    )
+
+    test_results = None
+    if _worker_index is not None and options.get("test_mode", "well") == "well":
+        sides = [[], []]
+        for value, code in comparison["target_col_mapping_dict"].items():
+            sides[code].append(value)
+        test_results = _worker_index.mann_whitney_u_test(
+            *[
+                _worker_index.select(
+                    **{comparison["category_col"]: category, target_col: side}
+                )
+                for side in sides
+            ],
+            columns=feature_cols,
+        )
+
+    return analyze_category(
+        category_df,
+        category=category,
+        target_col=target_col_encoded,
+        feature_cols=feature_cols,
+        output_dir=comparison["output_dir"],
+        test_results=test_results,
+        **options,
+    )
+
+
+def _analysis_units(metadata, comparisons):
+    """
+    List the (comparison index, category) units of several analyses, in the
+    order `perform_and_save_analysis` would run them.
+    """
+    units = []
+    for comparison_idx, comparison in enumerate(comparisons):
+        for category in metadata[comparison["category_col"]].unique():
+            units.append((comparison_idx, category))
+
+    return units
+
+
+def unit_input_hashes(
+    store,
+    comparisons,
+    units,
+    rows=None,
+    n_permutations=0,
+    n_bootstrap=0,
+    test_mode="well",
+    n_test_permutations=0,
+):
+    """
+    Hash the inputs of (comparison, category) units as `analyze_category`
+    does, without analyzing them.
+
+    See `run_analysis_units` for the parameters.
+
+    Returns:
+    - dict mapping each unit to its `analysis.analysis_input_hash`.
+    """
+    rows = np.arange(len(store)) if rows is None else np.asarray(rows)
+    metadata = store.metadata.iloc[rows].reset_index(drop=True)
+
+    hashes = {}
+    for idx, category in units:
+        category_df, target_col_encoded = _unit_frame(
+            store, rows, metadata, comparisons[idx], category
+        )
+        hashes[(idx, category)] = analysis_input_hash(
+            category_df,
+            category,
+            target_col_encoded,
+            comparisons[idx]["feature_cols"],
+            n_permutations,
+            n_bootstrap,
+            test_mode,
+            n_test_permutations,
         )
 
+    return hashes
+
+
+def run_analysis_units(
+    store,
+    comparisons,
+    units,
+    n_jobs=1,
+    rows=None,
+    n_permutations=0,
+    use_cache=True,
+    stats_index=None,
+    n_bootstrap=0,
+    test_mode="well",
+    n_test_permutations=0,
+):
+    """
+    Run (comparison, category) units of several analyses.
+
+    With `n_jobs` > 1 the units run in a process pool, where every worker
+    memory-maps the feature store so the data is never pickled to the workers.
+    Each unit writes its own test results.
+
+    Parameters:
+    - store: FeatureStore, the data.
+    - comparisons: list of dicts with the arguments of `perform_and_save_analysis`
+      (except `df`).
+    - units: list of (comparison index, category) tuples to run.
+    - n_jobs: int, the number of worker processes.
+    - rows: array-like, the positions of the rows to analyze (all by default).
+    - n_permutations: int, number of label permutations for the classifier
+      accuracy p-value of each unit.
+    - use_cache: bool, whether to skip the units whose inputs did not change
+      since their results were saved.
+    - stats_index: GroupStatsIndex of the same rows, to merge the U-tests from
+      (see `GroupStatsIndex.load`), or None to test the raw rows.
+    - n_bootstrap: int, number of cell line bootstrap resamples for the effect
+      size intervals of each unit. No effect sizes are added if 0.
+    - test_mode: str, "well" to test the wells or "line" to test the cell
+      lines, see `analysis.analyze_category`.
+    - n_test_permutations: int, number of line permutations of the "line" mode.
+
+    Yields:
+    - (unit, summary) tuples, in the order the units finish.
+    """
+    rows = np.arange(len(store)) if rows is None else np.asarray(rows)
+    index_dir = None if stats_index is None else stats_index.index_dir
+    options = {
+        "n_permutations": n_permutations,
+        "use_cache": use_cache,
+        "n_bootstrap": n_bootstrap,
+        "test_mode": test_mode,
+        "n_test_permutations": n_test_permutations,
+    }
+
+    for comparison_idx, _ in units:
+        os.makedirs(comparisons[comparison_idx]["output_dir"], exist_ok=True)
+
+    if n_jobs == 1:
+        _init_analysis_worker(store.store_dir, rows, index_dir)
+        for idx, category in units:
+            summary = _analyze_unit(comparisons[idx], category, **options)
+            yield (idx, category), summary
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        initializer=_init_analysis_worker,
+        initargs=(store.store_dir, rows, index_dir),
+    ) as executor:
+        futures = {}
+        for idx, category in units:
+            future = executor.submit(
+                _analyze_unit, comparisons[idx], category, **options
+            )
+            futures[future] = (idx, category)
+
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def run_analysis_parallel(
+    store,
+    comparisons,
+    n_jobs,
+    rows=None,
+    n_permutations=0,
+    use_cache=True,
+    stats_index=None,
+    n_bootstrap=0,
+    test_mode="well",
+    n_test_permutations=0,
+):
+    """
+    Run the (comparison, category) units of several analyses in a process pool.
+
+    The summary of each comparison is assembled once all of its units are
+    done. See `run_analysis_units` for the parameters.
+    """
+    metadata = store.metadata if rows is None else store.metadata.iloc[rows]
+    units = _analysis_units(metadata, comparisons)
+
+    summaries = {}
+    for unit, summary in run_analysis_units(
+        store,
+        comparisons,
+        units,
+        n_jobs=n_jobs,
+        rows=rows,
+        n_permutations=n_permutations,
+        use_cache=use_cache,
+        stats_index=stats_index,
+        n_bootstrap=n_bootstrap,
+        test_mode=test_mode,
+        n_test_permutations=n_test_permutations,
+    ):
+        idx, category = unit
+        print(f"Finished {comparisons[idx]['output_dir']}: {category}")
+        summaries[unit] = summary
+
+    for comparison_idx, comparison in enumerate(comparisons):
+        save_summary_results(
+            [summaries[unit] for unit in units if unit[0] == comparison_idx],
+            comparison["output_dir"],
+        )
+
+
+def analysis_inputs(
+    data_level,
+    feature_cols_pattern="Cells_|Cytoplasm_|Nuclei_",
+    random_subset_features=False,
+):
+    """
+    Load the data of a level and list the comparisons `run_analysis` runs on it.
+
+    Returns:
+    - store: FeatureStore, the data.
+    - rows: numpy.ndarray, the positions of the human rows.
+    - comparisons: list of dicts, see `_analysis_comparisons`.
+    """
+    data_path = f"output/processed/{data_level}/combined.parquet"
+
+    store = FeatureStore.load(data_path)
+
+    # select only rows where the Metadata_line_source is "human"
+    rows = np.flatnonzero(store.metadata["Metadata_line_source"] == "human")
+    feature_cols = store.columns.pattern(feature_cols_pattern)
 
-def inspect_analysis(data_level):
+    if random_subset_features:
+        import random
+
+        print("WARNING: Randomly selecting 30 features")
+
+        random.seed(42)
+        random.shuffle(feature_cols)
+        feature_cols = feature_cols[:30]
+
+    return store, rows, _analysis_comparisons(data_level, feature_cols)
+
+
+def run_analysis(
+    data_level,
+    feature_cols_pattern="Cells_|Cytoplasm_|Nuclei_",
+    random_subset_features=False,
+    n_jobs=1,
+    n_permutations=0,
+    use_cache=True,
+    use_stats_index=False,
+    n_bootstrap=0,
+    test_mode="well",
+    n_test_permutations=0,
+):
+    store, rows, comparisons = analysis_inputs(
+        data_level, feature_cols_pattern, random_subset_features
+    )
+
+    # Built once per data level, the index serves the U-tests of every comparison
+    stats_index = (
+        GroupStatsIndex.load(store, rows, n_jobs=n_jobs) if use_stats_index else None
+    )
+
+    with stage(
+        "analysis",
+        n_rows=len(rows),
+        n_features=len(comparisons[0]["feature_cols"]),
+        data_level=data_level,
+        n_jobs=n_jobs,
+    ):
+        # Fan the (comparison, category) units out to a process pool
+        if n_jobs > 1 or stats_index is not None:
+            run_analysis_parallel(
+                store,
+                comparisons,
+                n_jobs,
+                rows=rows,
+                n_permutations=n_permutations,
+                use_cache=use_cache,
+                stats_index=stats_index,
+                n_bootstrap=n_bootstrap,
+                test_mode=test_mode,
+                n_test_permutations=n_test_permutations,
+            )
+            return
+
+        # The first comparison uses all the selected features
+        df = store.frame(rows=rows, columns=comparisons[0]["feature_cols"])
+        for comparison in comparisons:
+            perform_and_save_analysis(
+                df=df,
+                n_permutations=n_permutations,
+                use_cache=use_cache,
+                n_bootstrap=n_bootstrap,
+                test_mode=test_mode,
+                n_test_permutations=n_test_permutations,
+                **comparison,
+            )
+
+
+def inspect_analysis(data_level, headless=False, n_jobs=1, force=False):
+    """
+    Plot the results of `run_analysis` for a data level.
+
+    Parameters:
+    - data_level: str, the data level.
+    - headless: bool, whether to only save the plots, rendering them in a
+      process pool and skipping the plots that are up to date.
+    - n_jobs: int, the number of worker processes of the headless mode.
+    - force: bool, whether the headless mode redraws up-to-date plots.
+    """
     # ------------------------------------------------------------
     # Control vs Deletion, per cell type
     # ------------------------------------------------------------
 
-    output_dir = f"output/analysis_results/{data_level}/control_vs_deletion/"
-    results_file = f"{output_dir}/summary_results.parquet"
-
-    visualize_results(
-        input_file=results_file,
-        output_dir=output_dir,
-    )
+    output_dirs = {
+        f"{data_level}:control_vs_deletion": f"output/analysis_results/{data_level}/control_vs_deletion/"
+    }
 
     # ------------------------------------------------------------
     # Cell type A vs B, per condition
     # ------------------------------------------------------------
 
-    from itertools import combinations
-
     cell_types = ["stem", "neuron", "progen", "astro"]
 
     cell_type_pairs = list(combinations(cell_types, 2))
 
     for cell_type_0, cell_type_1 in cell_type_pairs:
-        print(f"{data_level}:{cell_type_0}_vs_{cell_type_1}")
+        output_dirs[f"{data_level}:{cell_type_0}_vs_{cell_type_1}"] = (
+            f"output/analysis_results/{data_level}/cell_type_a_vs_b/{cell_type_0}_vs_{cell_type_1}/"
+        )
+
+    if headless:
+        written = render_results(
+            [
+                (f"{output_dir}/summary_results.parquet", output_dir)
+                for output_dir in output_dirs.values()
+            ],
+            n_jobs=n_jobs,
+            force=force,
+            verbose=False,
+        )
+        print(f"{data_level}: rendered {len(written)} plots")
+        return
 
-        output_dir = f"output/analysis_results/{data_level}/cell_type_a_vs_b/{cell_type_0}_vs_{cell_type_1}/"
+    for name, output_dir in output_dirs.items():
+        print(name)
 
         results_file = f"{output_dir}/summary_results.parquet"
 
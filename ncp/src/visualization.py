@@ -1,22 +1,30 @@
-from parse_cp_features import parse_cp_features
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from parse_cp_features import parse_cp_feature_catalog
 import pandas as pd
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import seaborn as sns
 
+from instrumentation import timed
+
 
-def visualize_channels(significant_features):
+def visualize_channels(significant_features, ax=None):
     """
     Visualize the distribution of channels for significant features.
 
     Parameters:
     - significant_features: list, features found to be significant.
+    - ax: matplotlib.axes.Axes, the axes to draw on (a new pyplot figure by default).
 
     Returns:
     - ax: matplotlib.axes._axes.Axes, axes object of the plot.
     """
 
-    channel_list = [parse_cp_features(feat)["channel"] for feat in significant_features]
-    df_channel = pd.DataFrame(channel_list, columns=["channel"])
+    channel_list = parse_cp_feature_catalog(significant_features)["channel"]
+    df_channel = pd.DataFrame({"channel": channel_list.astype(str)})
     df_channel_count = df_channel.groupby("channel").size().reset_index(name="counts")
     df_channel_count["percentage"] = (
         df_channel_count["counts"] / df_channel_count["counts"].sum()
@@ -26,27 +34,58 @@ def visualize_channels(significant_features):
         by=["sort", "percentage"], ascending=False
     )
 
-    plt.figure(figsize=(10, 5))
-    ax = sns.barplot(x="channel", y="percentage", data=df_channel_count)
+    if ax is None:
+        _, ax = plt.subplots(figsize=(10, 5))
+    sns.barplot(x="channel", y="percentage", data=df_channel_count, ax=ax)
     ax.set_xticklabels(ax.get_xticklabels(), rotation=40, ha="right")
-    plt.tight_layout()
+    ax.figure.tight_layout()
 
     return ax
 
 
-def visualize_results(input_file, output_dir):
+def visualize_accuracy_vs_significant_features(results_df, ax=None):
     """
-    Visualize the results of the analysis.
+    Plot the classifier accuracy against the number of significant features of
+    each category.
 
     Parameters:
-    - input_file: str, path to the input file.
-    - output_dir: str, path to the output directory.
+    - results_df: pandas.DataFrame, the summary results.
+    - ax: matplotlib.axes.Axes, the axes to draw on (the current pyplot axes by default).
 
     Returns:
-    - None, saves the plots to the output directory.
+    - ax: matplotlib.axes._axes.Axes, axes object of the plot.
     """
+    if ax is None:
+        ax = plt.gca()
 
-    # Load the results
+    sns.scatterplot(
+        data=results_df,
+        x="logistic_regression_accuracy_mean",
+        y="num_significant_features",
+        hue="category",
+        palette="deep",
+        s=100,
+        ax=ax,
+    )
+    # Add error bars
+    ax.errorbar(
+        results_df["logistic_regression_accuracy_mean"],
+        results_df["num_significant_features"],
+        xerr=results_df["logistic_regression_accuracy_std"],
+        fmt=".",
+        color="gray",
+        capsize=3,  # Adds caps to the error bars
+    )
+
+    ax.set_xlim(0.5, 1)
+    ax.set_title("Logistic Regression Accuracy vs Number of Significant Features")
+    ax.set_xlabel("Logistic Regression Accuracy")
+    ax.set_ylabel("Number of Significant Features")
+
+    return ax
+
+
+def _load_results(input_file):
     results_df = pd.read_parquet(input_file)
 
     # Convert the significant_features back to lists from strings
@@ -54,46 +93,139 @@ def visualize_results(input_file, output_dir):
         lambda x: x.split(",") if pd.notnull(x) else []
     )
 
+    return results_df
+
+
+def _print_row(row):
+    print(f"\nCategory: {row['category']}")
+    print(
+        f"Logistic Regression Accuracy Score: {row['logistic_regression_accuracy_mean']:.4f}"
+    )
+    print(f"Number of Significant Features: {row['num_significant_features']}")
+
+
+def _channels_file(output_dir, category):
+    return f"{output_dir}/significant_features_{category}.png"
+
+
+def _summary_file(output_dir):
+    return f"{output_dir}/classification_vs_significant_features.png"
+
+
+@timed("plotting")
+def visualize_results(input_file, output_dir):
+    """
+    Visualize the results of the analysis.
+
+    Parameters:
+    - input_file: str, path to the input file.
+    - output_dir: str, path to the output directory.
+
+    Returns:
+    - None, saves the plots to the output directory.
+    """
+
+    # Load the results
+    results_df = _load_results(input_file)
+
     # Print the results
     for _, row in results_df.iterrows():
-        print(f"\nCategory: {row['category']}")
-        print(
-            f"Logistic Regression Accuracy Score: {row['logistic_regression_accuracy_mean']:.4f}"
-        )
-        print(f"Number of Significant Features: {row['num_significant_features']}")
+        _print_row(row)
 
         if row["num_significant_features"] > 0:
             ax = visualize_channels(row["significant_features"])
-            output_file = f"{output_dir}/significant_features_{row['category']}.png"
+            output_file = _channels_file(output_dir, row["category"])
             ax.figure.savefig(output_file)  # save the plot to a file
             plt.show()  # show the plot
+            plt.close(ax.figure)
 
         print(70 * "=")
 
-    sns.scatterplot(
-        data=results_df,
-        x="logistic_regression_accuracy_mean",
-        y="num_significant_features",
-        hue="category",
-        palette="deep",
-        s=100,
-    )
-    # Add error bars
-    for index, row in results_df.iterrows():
-        plt.errorbar(
-            row["logistic_regression_accuracy_mean"],
-            row["num_significant_features"],
-            xerr=row["logistic_regression_accuracy_std"],
-            fmt=".",
-            color="gray",
-            capsize=3,  # Adds caps to the error bars
-        )
-
-    plt.xlim(0.5, 1)
-    plt.title("Logistic Regression Accuracy vs Number of Significant Features")
-    plt.xlabel("Logistic Regression Accuracy")
-    plt.ylabel("Number of Significant Features")
-
-    output_file = f"{output_dir}/classification_vs_significant_features.png"
-    plt.savefig(output_file)
+    ax = visualize_accuracy_vs_significant_features(results_df)
+
+    output_file = _summary_file(output_dir)
+    ax.figure.savefig(output_file)
     plt.show()
+    plt.close(ax.figure)
+
+
+def _new_figure(figsize=None):
+    """
+    Create a figure on an Agg canvas, independent of pyplot and its backend.
+
+    The figure is not registered with pyplot, so it is freed as soon as it is
+    no longer referenced.
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _render_channels(significant_features, output_file):
+    fig = _new_figure(figsize=(10, 5))
+    visualize_channels(significant_features, ax=fig.subplots())
+    fig.savefig(output_file)
+    fig.clear()
+    return output_file
+
+
+def _render_summary(input_file, output_file):
+    fig = _new_figure()
+    visualize_accuracy_vs_significant_features(
+        _load_results(input_file), ax=fig.subplots()
+    )
+    fig.savefig(output_file)
+    fig.clear()
+    return output_file
+
+
+def _is_up_to_date(output_file, input_file):
+    """Whether a plot is newer than the results it was drawn from."""
+    return os.path.exists(output_file) and os.path.getmtime(
+        output_file
+    ) >= os.path.getmtime(input_file)
+
+
+@timed("plotting", counts=lambda written: {"n_plots": len(written)})
+def render_results(results, n_jobs=1, force=False, verbose=True):
+    """
+    Render the plots of several analyses without displaying them.
+
+    The plots are drawn on Agg figures in a process pool. Plots newer than
+    their summary results are not drawn again.
+
+    Parameters:
+    - results: list of (input_file, output_dir) tuples, as in `visualize_results`.
+    - n_jobs: int, the number of worker processes.
+    - force: bool, whether to redraw the plots that are up to date.
+    - verbose: bool, whether to print the results of each category.
+
+    Returns:
+    - list, the plot files that were written.
+    """
+    tasks = []
+    for input_file, output_dir in results:
+        results_df = _load_results(input_file)
+
+        for _, row in results_df.iterrows():
+            if verbose:
+                _print_row(row)
+                print(70 * "=")
+
+            if row["num_significant_features"] > 0:
+                output_file = _channels_file(output_dir, row["category"])
+                if force or not _is_up_to_date(output_file, input_file):
+                    tasks.append(
+                        (_render_channels, row["significant_features"], output_file)
+                    )
+
+        output_file = _summary_file(output_dir)
+        if force or not _is_up_to_date(output_file, input_file):
+            tasks.append((_render_summary, input_file, output_file))
+
+    if n_jobs == 1:
+        return [func(*args) for func, *args in tasks]
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(func, *args) for func, *args in tasks]
+        return [future.result() for future in futures]